@@ -0,0 +1,285 @@
+"""
+Admission control: how many pages are OCR'd and how many LLM calls run at
+the same time in this process.
+
+Synchronous /ocr-processing requests (and in-process jobs) take a share of
+ADMISSION_MAX_PAGES weighted by their page count and wait in a bounded queue
+when it is used up. Callers, keyed on their bearer token, are served in
+turn (the one with the fewest pages in flight first), so one bulk upload
+cannot hold everybody else back. A request is refused right away with 429
+and Retry-After when the queue, or the caller's share of it, is full, and
+after waiting ADMISSION_QUEUE_TIMEOUT seconds. LLM calls go through the
+same kind of fair queue, limited to OPENAI_CONCURRENCY (llm_response).
+
+    current_caller.set(caller_key(authorization))
+    async with page_admission.acquire(current_caller.get(), await count_pages(documents)):
+        ...
+"""
+from fastapi import HTTPException
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from typing import Optional, List, Dict, Any
+import asyncio
+import hashlib
+import math
+import os
+import time
+
+from metrics import admission_wait_seconds, admission_rejected
+
+ADMISSION_ENABLED = os.getenv("ADMISSION_ENABLED", "true").lower() == "true"
+# Pages being processed at the same time (a larger request runs alone)
+ADMISSION_MAX_PAGES = int(os.getenv("ADMISSION_MAX_PAGES", "32"))
+# Requests waiting for pages, in total and per caller (0: no per-caller limit)
+ADMISSION_MAX_QUEUE = int(os.getenv("ADMISSION_MAX_QUEUE", "64"))
+ADMISSION_MAX_QUEUED_PER_CALLER = int(os.getenv("ADMISSION_MAX_QUEUED_PER_CALLER", "16"))
+# How long a request waits for pages before a 429
+ADMISSION_QUEUE_TIMEOUT = float(os.getenv("ADMISSION_QUEUE_TIMEOUT", "30"))
+# Upper bound of the Retry-After estimate
+ADMISSION_RETRY_AFTER_MAX = int(os.getenv("ADMISSION_RETRY_AFTER_MAX", "60"))
+
+# Caller of the request being processed, for the fair queueing of its LLM calls
+current_caller = ContextVar("admission_caller", default="anonymous")
+
+
+def caller_key(authorization: Optional[str]) -> str:
+    """Fairness key of a caller: a hash of its bearer token, never the token itself"""
+    if not authorization:
+        return "anonymous"
+    token = authorization.replace("Bearer ", "") if authorization.startswith("Bearer ") else authorization
+    return hashlib.sha256(token.encode()).hexdigest()[:16]
+
+
+async def count_pages(documents: List[Dict[str, Any]]) -> int:
+    """
+    Pages of a request: the page count of each PDF (kept on the document for
+    the read stage) and one per photo
+    """
+    from helper_functions import get_pdf_page_count
+    from uploads import document_source
+
+    pages = 0
+    for document in documents:
+        if document["mime_type"] != "application/pdf":
+            pages += 1
+            continue
+        if document.get("page_count") is None:
+            try:
+                document["page_count"] = await asyncio.to_thread(get_pdf_page_count, document_source(document))
+            except Exception:
+                # Unreadable, the read stage reports it
+                pages += 1
+                continue
+        pages += document["page_count"]
+    return pages
+
+
+class _Waiter:
+    __slots__ = ("caller", "weight", "future", "queued_at")
+
+    def __init__(self, caller: str, weight: int):
+        self.caller = caller
+        self.weight = weight
+        self.future = asyncio.get_running_loop().create_future()
+        self.queued_at = time.perf_counter()
+
+
+class FairLimiter:
+    """
+    Weighted concurrency limit with a fair wait queue per caller.
+    Waiters are granted in order of the capacity their caller already holds,
+    then by arrival; a waiter that does not fit yet blocks the ones behind it,
+    so large requests are not starved by a stream of small ones.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        capacity: int,
+        max_queue: Optional[int] = None,
+        max_queued_per_caller: Optional[int] = None,
+        timeout: Optional[float] = None,
+        enabled: bool = True
+    ):
+        self.name = name
+        self.capacity = max(1, capacity)
+        self.max_queue = max_queue
+        self.max_queued_per_caller = max_queued_per_caller or None
+        self.timeout = timeout
+        self.enabled = enabled
+        self.in_use = 0
+        self._in_use_by = {}  # caller -> capacity held
+        self._queues = OrderedDict()  # caller -> deque of waiters
+        self.queued = 0
+
+        # Counters
+        self.admitted = 0
+        self.rejected = 0
+        self.timed_out = 0
+        self.waited = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        # Moving average of how long capacity is held, for Retry-After
+        self.avg_hold = 1.0
+
+    @asynccontextmanager
+    async def acquire(self, caller: str = "anonymous", weight: int = 1, bounded: bool = True):
+        """
+        Hold weight units of capacity for the block. bounded=False waits as
+        long as it takes instead of being refused (queued jobs, LLM calls).
+        """
+        if not self.enabled:
+            yield
+            return
+        # A request larger than the limit runs alone
+        weight = min(max(1, weight), self.capacity)
+        await self._admit(caller, weight, bounded)
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self._release(caller, weight, time.perf_counter() - started)
+
+    def _fits(self, weight: int) -> bool:
+        return self.in_use + weight <= self.capacity
+
+    async def _admit(self, caller: str, weight: int, bounded: bool):
+        if not self.queued and self._fits(weight):
+            self._grant(caller, weight)
+            admission_wait_seconds.observe(0.0, queue=self.name, outcome="admitted")
+            return
+
+        if bounded:
+            self.check_room(caller, weight)
+
+        waiter = _Waiter(caller, weight)
+        self._queues.setdefault(caller, deque()).append(waiter)
+        self.queued += 1
+        try:
+            await asyncio.wait({waiter.future}, timeout=self.timeout if bounded else None)
+        except BaseException:
+            # Cancelled (client gone, shutdown): leave the queue or give back what was granted
+            self._abandon(waiter)
+            raise
+
+        waited = time.perf_counter() - waiter.queued_at
+        if not waiter.future.done():
+            self._abandon(waiter)
+            self.timed_out += 1
+            admission_wait_seconds.observe(waited, queue=self.name, outcome="timed_out")
+            self._reject("timeout", weight)
+
+        self.waited += 1
+        self.total_wait += waited
+        self.max_wait = max(self.max_wait, waited)
+        admission_wait_seconds.observe(waited, queue=self.name, outcome="admitted")
+
+    def _refusal(self, caller: str, weight: int) -> Optional[str]:
+        """Why a new request of caller would be refused instead of queued, if it would"""
+        if not self.queued and self._fits(weight):
+            # Runs right away
+            return None
+        if self.max_queue is not None and self.queued >= self.max_queue:
+            return "queue_full"
+        if self.max_queued_per_caller and len(self._queues.get(caller, ())) >= self.max_queued_per_caller:
+            return "caller_queue_full"
+        return None
+
+    def check_room(self, caller: str, weight: int = 1):
+        """
+        Raise the 429 a new request of caller would get because the queue (or
+        its share of it) is full. Cheap enough to run before the uploads are read.
+        """
+        if not self.enabled:
+            return
+        reason = self._refusal(caller, min(max(1, weight), self.capacity))
+        if reason:
+            self._reject(reason, weight)
+
+    def _grant(self, caller: str, weight: int):
+        self.in_use += weight
+        self._in_use_by[caller] = self._in_use_by.get(caller, 0) + weight
+        self.admitted += 1
+
+    def _release(self, caller: str, weight: int, held: Optional[float] = None):
+        self.in_use -= weight
+        remaining = self._in_use_by.get(caller, 0) - weight
+        if remaining > 0:
+            self._in_use_by[caller] = remaining
+        else:
+            self._in_use_by.pop(caller, None)
+        if held is not None:
+            self.avg_hold = 0.9 * self.avg_hold + 0.1 * held
+        self._dispatch()
+
+    def _dequeue(self, waiter: _Waiter):
+        queue = self._queues[waiter.caller]
+        queue.remove(waiter)
+        self.queued -= 1
+        if not queue:
+            del self._queues[waiter.caller]
+
+    def _dispatch(self):
+        """Grant capacity to waiters, fairest first, while they fit"""
+        while self._queues:
+            # The caller holding the least goes first (the longest waiting on ties)
+            caller = min(self._queues, key=lambda key: (self._in_use_by.get(key, 0), self._queues[key][0].queued_at))
+            waiter = self._queues[caller][0]
+            if not self._fits(waiter.weight):
+                return
+            self._dequeue(waiter)
+            self._grant(caller, waiter.weight)
+            waiter.future.set_result(None)
+
+    def _abandon(self, waiter: _Waiter):
+        if waiter.future.done():
+            # Granted in the meantime, hand it on
+            self._release(waiter.caller, waiter.weight)
+            return
+        waiter.future.cancel()
+        self._dequeue(waiter)
+        # It may have been blocking smaller waiters behind it
+        self._dispatch()
+
+    def retry_after(self, weight: int = 1) -> int:
+        """Seconds until the queue ahead (and this request) has likely gone through"""
+        queued_weight = sum(waiter.weight for queue in self._queues.values() for waiter in queue)
+        estimate = self.avg_hold * (queued_weight + weight) / self.capacity
+        return max(1, min(ADMISSION_RETRY_AFTER_MAX, math.ceil(estimate)))
+
+    def _reject(self, reason: str, weight: int):
+        self.rejected += 1
+        admission_rejected.inc(queue=self.name, reason=reason)
+        raise HTTPException(
+            status_code=429,
+            detail=f"Too busy to take this request ({reason.replace('_', ' ')}), retry later",
+            headers={"Retry-After": str(self.retry_after(weight))}
+        )
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "enabled": self.enabled,
+            "capacity": self.capacity,
+            "in_use": self.in_use,
+            "queued": self.queued,
+            "callers_queued": len(self._queues),
+            "callers_in_flight": len(self._in_use_by),
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+            "timed_out": self.timed_out,
+            "avg_wait_ms": round(self.total_wait / self.waited * 1000, 1) if self.waited else 0.0,
+            "max_wait_ms": round(self.max_wait * 1000, 1),
+            "avg_hold_s": round(self.avg_hold, 2)
+        }
+
+
+# Process-wide page budget of /ocr-processing requests and jobs
+page_admission = FairLimiter(
+    "pages",
+    ADMISSION_MAX_PAGES,
+    max_queue=ADMISSION_MAX_QUEUE,
+    max_queued_per_caller=ADMISSION_MAX_QUEUED_PER_CALLER,
+    timeout=ADMISSION_QUEUE_TIMEOUT,
+    enabled=ADMISSION_ENABLED
+)
@@ -1,38 +1,79 @@
-from fastapi import FastAPI, File, UploadFile, HTTPException, Header, Depends, Form
+from fastapi import FastAPI, HTTPException, Header, Depends, Request
+from fastapi.exceptions import RequestValidationError
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, PlainTextResponse
 import uvicorn
 from typing import Optional, List, Union, Dict
+from contextlib import asynccontextmanager
 
 from dotenv import load_dotenv
 import os
-import io
-import fitz  # PyMuPDF
-from PIL import Image
-import json
+import asyncio
 
-from ocr import GCPHelper
-from llm_response import extract_document_info_with_refusal_handling
-from database import MongoDB, CRUDOperations
-from helper_functions import *
-from whatsapp_func import *
+from idempotency import IDEMPOTENCY_ENABLED, current_execution
+from cache import content_hash
+from uploads import spool_form, release_uploads, UPLOAD_MAX_REQUEST_BYTES
+from outbox import OutboxDispatcher, NOTIFICATION_MODE, OUTBOX_DISPATCHER_ENABLED
+from jobs import JobWorkerPool, JOB_WORKERS, job_status
+from resources import build_registry
+from admission import page_admission, caller_key, count_pages, current_caller
+import metrics
+import time
 
 load_dotenv()
 
-# Initialize database connection
-mongo_connection = os.getenv("MONGO_DB_URI")
-mongo_db_name = os.getenv("MONGO_DB_NAME")
-BACKEND_BASEURL = os.getenv("BACKEND_BASEURL")
+# Mongo, Vision, OpenAI, the CPU pool and outbound HTTP: imported, connected
+# and warmed in the background at startup, closed at shutdown (see resources.py)
+resources = build_registry()
 
-mongodb = MongoDB(mongo_connection, mongo_db_name)
+# Page budget and queue of /ocr-processing (see admission.py)
+metrics.registry.register_stats("admission", page_admission.stats)
 
-# Initialize CRUD operations for different collections
-documents_crud = CRUDOperations(mongodb, "documents")
-qatar_ids_crud = CRUDOperations(mongodb, "qatar_ids")
-istimaras_crud = CRUDOperations(mongodb, "istimaras")
-requests_crud = CRUDOperations(mongodb, "requests")
+# In-process job workers and notification dispatcher, started once the
+# resources are ready (more can run as `python jobs.py` / `python outbox.py`)
+background_workers = []
 
-app = FastAPI()
+
+async def start_resources():
+    await resources.start()
+    from pipeline import job_queue, outbox
+    
+    job_workers = JobWorkerPool(job_queue, JOB_WORKERS)
+    metrics.registry.register_stats("jobs", job_workers.stats)
+    job_workers.start()
+    background_workers.append(job_workers)
+    
+    outbox_dispatcher = OutboxDispatcher(outbox)
+    metrics.registry.register_stats("outbox", outbox_dispatcher.stats)
+    if NOTIFICATION_MODE == "outbox" and OUTBOX_DISPATCHER_ENABLED:
+        outbox_dispatcher.start()
+    background_workers.append(outbox_dispatcher)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    metrics.start_tracing()
+    
+    # Warm up in the background, so /healthz answers while the imports and connections are made
+    warm_up = asyncio.create_task(start_resources())
+    try:
+        yield
+    finally:
+        warm_up.cancel()
+        await asyncio.gather(warm_up, return_exceptions=True)
+        for worker in reversed(background_workers):
+            await worker.stop()
+        await resources.close()
+        metrics.stop_tracing()
+
+
+async def require_ready():
+    """Hold requests arriving during warm-up, 503 if the resources take too long"""
+    if not await resources.wait_ready():
+        raise HTTPException(status_code=503, detail="Service is starting", headers={"Retry-After": "5"})
+
+
+app = FastAPI(lifespan=lifespan)
 
 app.add_middleware(
     CORSMiddleware,
@@ -42,195 +83,200 @@ app.add_middleware(
     allow_headers=["*"], 
 )
 
+@app.middleware("http")
+async def reject_oversized_uploads(request: Request, call_next):
+    """Refuse uploads over the request size limit, or while the page queue is full, before their body is read"""
+    if request.method == "POST" and request.url.path == "/ocr-processing":
+        content_length = request.headers.get("content-length")
+        if content_length and content_length.isdigit() and int(content_length) > UPLOAD_MAX_REQUEST_BYTES:
+            return JSONResponse(
+                status_code=413,
+                content={"detail": f"Uploads are larger than {UPLOAD_MAX_REQUEST_BYTES} bytes in total"}
+            )
+        # Shed bursts before paying for spooling, page counting and the idempotency claim
+        # (the page-weighted acquire in the endpoint still decides)
+        try:
+            page_admission.check_room(caller_key(request.headers.get("authorization")))
+        except HTTPException as e:
+            return JSONResponse(status_code=e.status_code, content={"detail": e.detail}, headers=e.headers)
+    return await call_next(request)
+
+
+@app.middleware("http")
+async def record_request_metrics(request: Request, call_next):
+    """Time every request into ocr_http_request_seconds, by route template"""
+    if not metrics.METRICS_ENABLED:
+        return await call_next(request)
+    started = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        route = request.scope.get("route")
+        metrics.http_request_seconds.observe(
+            time.perf_counter() - started,
+            method=request.method,
+            route=route.path if route is not None else "unmatched",
+            status=status
+        )
+
+
 @app.get("/")
 def read_root():
     return {"message": "Hello, World!"}
 
 
-@app.post("/ocr-processing")
+@app.get("/healthz")
+def healthz():
+    """Liveness: the process is up and serving, whatever the state of its resources"""
+    return {"status": "ok"}
+
+
+@app.get("/readyz")
+def readyz():
+    """Readiness: 200 once the critical resources are warm, with per-resource status and warm-up times"""
+    report = resources.report()
+    return JSONResponse(status_code=200 if report["ready"] else 503, content=report)
+
+
+@app.get("/metrics")
+def get_metrics():
+    """Prometheus metrics: stage/call/page spans, HTTP and Mongo timings, counters and pool stats"""
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+
+# The /ocr-processing form, read by uploads.spool_form instead of FastAPI
+# (which would buffer the whole body first), documented for /docs
+OCR_PROCESSING_FORM = {
+    "requestBody": {
+        "required": True,
+        "content": {
+            "multipart/form-data": {
+                "schema": {
+                    "type": "object",
+                    "required": ["request_id", "client_name", "phone_number", "files"],
+                    "properties": {
+                        "request_id": {"type": "string"},
+                        "client_name": {"type": "string"},
+                        "phone_number": {"type": "string"},
+                        "files": {"type": "array", "items": {"type": "string", "format": "binary"}},
+                        "async_mode": {"type": "boolean", "default": False}
+                    }
+                }
+            }
+        }
+    }
+}
+
+
+@app.post("/ocr-processing", dependencies=[Depends(require_ready)], openapi_extra=OCR_PROCESSING_FORM)
 async def ocr_processing(
-    request_id: str = Form(...),
-    client_name: str = Form(...),
-    phone_number: str = Form(...),
-    files: List[UploadFile] = File(...),
+    request: Request,
     authorization: Optional[str] = Header(None)
 ):
     """
     OCR Processing Endpoint:
     - Accepts multiple files (PDF or images)
-    - Converts PDFs to images
-    - Processes all images through GCP OCR
+    - Sends PDFs to GCP OCR as-is, or converts them to images when too large
+    - Processes all pages through GCP OCR (per page or batched)
     - Extracts structured data using ChatGPT
     - Stores data in MongoDB
     - Returns extracted data and database IDs
+    With async_mode the files are queued and 202 is returned with a job id,
+    poll GET /jobs/{job_id} for the result. Otherwise the request waits for
+    page capacity and gets 429 with Retry-After when too many are waiting
+    (refused before its uploads are read when the queue is already full).
+    A request_id posted again gets the response of the first request (waiting
+    for it if still running), see the Idempotency-Status header.
     """
+    from pipeline import process_documents, job_queue, idempotency
+    
+    documents = []
     try:
-        if not files:
+        # Parsed as it arrives, each upload written once into memory or a temp
+        # file, 413 past the size limits
+        form, documents = await spool_form(request)
+        missing = [name for name in ("request_id", "client_name", "phone_number") if name not in form]
+        if missing:
+            raise RequestValidationError([
+                {"type": "missing", "loc": ("body", name), "msg": "Field required", "input": None} for name in missing
+            ])
+        request_id = form["request_id"]
+        client_name = form["client_name"]
+        phone_number = form["phone_number"]
+        async_mode = form.get("async_mode", "false").lower() in ("true", "1", "yes", "on")
+        if not documents:
             raise HTTPException(status_code=400, detail="No files uploaded")
         
-        # Initialize GCP OCR helper
-        gcp_helper = GCPHelper()
-        
-        all_extracted_text = ""
-        processed_files_info = []
-        
-        # Process each uploaded file
-        for file in files:
-            file_content = await file.read()
-            file_name = file.filename
-            file_size = len(file_content)
-            mime_type = file.content_type
-            
-            images_to_process = []
-            
-            # Check if PDF or image
-            if mime_type == "application/pdf":
-                print(f"Converting PDF to images: {file_name}")
-                images_to_process = pdf_to_images(file_content)
-            else:
-                # Assume it's an image
-                try:
-                    img = Image.open(io.BytesIO(file_content))
-                    images_to_process = [img]
-                except Exception as e:
-                    print(f"Error opening image {file_name}: {e}")
-                    continue
-            
-            # Process each image with GCP OCR
-            file_text = ""
-            for idx, img in enumerate(images_to_process):
-                print(f"Processing image {idx + 1}/{len(images_to_process)} from {file_name}")
-                extracted_text, confidence = gcp_helper.extract_text_from_image(img)
-                file_text += extracted_text + "\n"
-            
-            all_extracted_text += file_text + "\n\n"
-            
-            # Store file info
-            processed_files_info.append({
-                "file_name": file_name,
-                "file_size": file_size,
-                "mime_type": mime_type,
-                "pages_processed": len(images_to_process),
-                "extracted_text_length": len(file_text)
-            })
+        async def execute() -> Dict:
+            if async_mode:
+                job_id = await job_queue.submit(request_id, client_name, phone_number, documents, authorization)
+                print(f"Queued job {job_id} for request_id: {request_id}")
+                return {
+                    "status_code": 202,
+                    "content": {
+                        "success": True,
+                        "request_id": request_id,
+                        "job_id": job_id,
+                        "status": "queued",
+                        "status_url": f"/jobs/{job_id}"
+                    }
+                }
+            # Wait for a share of the page budget, 429 with Retry-After when the queue is full
+            caller = caller_key(authorization)
+            current_caller.set(caller)
+            async with page_admission.acquire(caller, await count_pages(documents)):
+                response_data = await process_documents(
+                    request_id, client_name, phone_number, documents, authorization, execution_id=current_execution.get()
+                )
+            return {"status_code": 200, "content": response_data}
         
-        print(f"Total extracted text length: {len(all_extracted_text)}")
+        if not IDEMPOTENCY_ENABLED:
+            response = await execute()
+            return JSONResponse(status_code=response["status_code"], content=response["content"])
         
-        # Pass extracted text to ChatGPT for structured extraction
-        print("Extracting structured data using ChatGPT...")
-        structured_data = extract_document_info_with_refusal_handling(all_extracted_text)
+        # Duplicates of a request_id join the running execution or get its stored response
+        fingerprint = content_hash(*(document["sha256"] for document in documents))
+        response, outcome = await idempotency.run(request_id, fingerprint, execute)
+        if outcome != "executed":
+            print(f"Request {request_id} {outcome} (duplicate of an earlier request)")
+        return JSONResponse(
+            status_code=response["status_code"],
+            content=response["content"],
+            headers={"Idempotency-Status": outcome}
+        )
         
-        # Check for errors in extraction
-        if "error" in structured_data:
-            raise HTTPException(
-                status_code=500, 
-                detail=f"ChatGPT extraction failed: {structured_data.get('refusal_message', 'Unknown error')}"
-            )
-        
-        # Store Qatar ID data in database
-        qatar_id_data = dict(structured_data.get("qatar_id", {}))
-        qatar_id_data["request_id"] = request_id
-        qatar_id_id = await qatar_ids_crud.create(qatar_id_data)
-        print(f"Qatar ID stored with ID: {qatar_id_id}")
-        
-        # Store Istimara data in database
-        istimara_data = dict(structured_data.get("istimara", {}))
-        istimara_data["request_id"] = request_id
-        istimara_id = await istimaras_crud.create(istimara_data)
-        print(f"Istimara stored with ID: {istimara_id}")
-        
-        # Prepare response data
-        response_data = {
-            "success": True,
-            "request_id": request_id,
-            "client_name": client_name,
-            "phone_number": phone_number,
-            "files_processed": len(files),
-            "files_info": processed_files_info,
-            "extracted_data": {
-                "qatar_id": dict(structured_data.get("qatar_id", {})),
-                "istimara": dict(structured_data.get("istimara", {}))
-            }
-        }
-        
-        # Send WhatsApp message with extracted information
-        try:
-            from whatsapp_func import format_extraction_message, call_renewal_validation_api, send_insurance_type_selection
-            
-            whatsapp_message = format_extraction_message(
-                request_id=request_id,
-                client_name=client_name,
-                qatar_id_data=dict(structured_data.get("qatar_id", {})),
-                istimara_data=dict(structured_data.get("istimara", {}))
-            )
-            
-            whatsapp_result = send_text_message(phone_number, whatsapp_message)
-            
-            if whatsapp_result.get("success"):
-                print(f"WhatsApp message sent successfully to {phone_number}")
-                response_data["whatsapp_sent"] = True
-                
-                # Call renewal validation API
-                chassis_no = dict(structured_data.get("istimara", {})).get("vehicle_chassis_no")
-                
-                if chassis_no and authorization:
-                    # Extract bearer token from Authorization header
-                    bearer_token = authorization.replace("Bearer ", "") if authorization.startswith("Bearer ") else authorization
-                    
-                    print(f"Calling renewal validation API with request_id: {request_id}, chassis_no: {chassis_no}")
-                    validation_result = call_renewal_validation_api(request_id, chassis_no, bearer_token)
-                    
-                    if validation_result.get("success"):
-                        validation_response = validation_result.get("response", {})
-                        
-                        if validation_response.get("status") == "success" and validation_response.get("responseCode") == "1":
-                            print(f"Renewal validation successful for request_id: {request_id}")
-                            response_data["renewal_validation"] = "success"
-                            
-                            # Send insurance type selection message
-                            insurance_selection_result = send_insurance_type_selection(phone_number)
-                            
-                            if insurance_selection_result.get("success"):
-                                print(f"Insurance type selection message sent to {phone_number}")
-                                response_data["insurance_selection_sent"] = True
-                            else:
-                                print(f"Failed to send insurance selection message: {insurance_selection_result.get('error')}")
-                                response_data["insurance_selection_sent"] = False
-                                response_data["insurance_selection_error"] = insurance_selection_result.get("error")
-                        else:
-                            print(f"Renewal validation failed: {validation_response}")
-                            response_data["renewal_validation"] = "failed"
-                            response_data["renewal_validation_response"] = validation_response
-                    else:
-                        print(f"Error calling renewal validation API: {validation_result.get('error')}")
-                        response_data["renewal_validation"] = "error"
-                        response_data["renewal_validation_error"] = validation_result.get("error")
-                else:
-                    if not chassis_no:
-                        print("Chassis number not found in extracted data")
-                        response_data["renewal_validation"] = "skipped_no_chassis"
-                    if not authorization:
-                        print("Authorization header not provided")
-                        response_data["renewal_validation"] = "skipped_no_auth"
-            else:
-                print(f"Failed to send WhatsApp message: {whatsapp_result.get('error')}")
-                response_data["whatsapp_sent"] = False
-                response_data["whatsapp_error"] = whatsapp_result.get("error")
-                
-        except Exception as e:
-            print(f"Error sending WhatsApp message: {e}")
-            response_data["whatsapp_sent"] = False
-            response_data["whatsapp_error"] = str(e)
-        
-        return JSONResponse(content=response_data)
-        
-    except HTTPException:
+    except (HTTPException, RequestValidationError):
         raise
     except Exception as e:
         print(f"Exception OCR Processing: {e}")
         import traceback
         traceback.print_exc()
         raise HTTPException(status_code=500, detail=f"OCR processing failed: {str(e)}")
+    finally:
+        # Async jobs keep their own copy in job storage
+        release_uploads(documents)
+
+
+@app.get("/jobs/{job_id}", dependencies=[Depends(require_ready)])
+async def get_job(job_id: str):
+    """Status of an async OCR job, with its result once completed"""
+    from pipeline import job_queue
+    
+    job = await job_queue.get(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return JSONResponse(content=job_status(job))
+
+
+@app.get("/requests/{request_id}/notifications", dependencies=[Depends(require_ready)])
+async def get_notifications(request_id: str):
+    """Delivery status of the WhatsApp messages and renewal validation of a request"""
+    from pipeline import outbox
+    
+    return JSONResponse(content={"request_id": request_id, "notifications": await outbox.for_request(request_id)})
 
 
 if __name__ == "__main__":
@@ -0,0 +1,129 @@
+"""
+OCR text compaction benchmark and regression check on recorded Vision output
+(benchmarks/ocr_samples.json: the per-file OCR text of a request and the
+fields expected from it).
+
+    python benchmarks/bench_compaction.py [--llm] [--json]
+
+Reports estimated prompt tokens before and after compaction and fails if an
+expected field value is no longer in the compacted text, or if the rule-based
+extraction reads a field differently from the raw and the compacted text
+(e.g. a Nationality value dropped as boilerplate). With --llm both
+texts are also sent for extraction (OpenAI, or the stub through
+OPENAI_BASE_URL) and the extracted fields are compared.
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from compaction import compact_texts, normalize_line
+
+SAMPLES_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "ocr_samples.json")
+
+
+def _normalized(text: str) -> str:
+    return " ".join(normalize_line(line) for line in text.splitlines()).casefold()
+
+
+def lost_values(raw_text: str, compacted_text: str, expected: dict) -> list:
+    """Expected values present in the raw OCR text but missing after compaction"""
+    raw, compacted = _normalized(raw_text), _normalized(compacted_text)
+    lost = []
+    for document, fields in expected.items():
+        for field, value in fields.items():
+            value = normalize_line(value).casefold()
+            if value and value in raw and value not in compacted:
+                lost.append(f"{document}.{field}")
+    return lost
+
+
+def rule_changed_fields(raw_text: str, compacted_text: str) -> dict:
+    """Fields the rule-based extraction reads differently after compaction"""
+    from rule_extractor import rule_extract
+
+    raw_result, _ = rule_extract(raw_text)
+    compacted_result, _ = rule_extract(compacted_text)
+    changed = {}
+    for document, fields in raw_result.items():
+        for field, value in fields.items():
+            compacted_value = compacted_result[document][field]
+            if normalize_line(compacted_value) != normalize_line(value):
+                changed[f"{document}.{field}"] = [value, compacted_value]
+    return changed
+
+
+async def changed_fields(raw_text: str, compacted_text: str) -> dict:
+    from llm_response import extract_document_info, llm_client
+
+    raw_result, compacted_result = await asyncio.gather(
+        extract_document_info(raw_text), extract_document_info(compacted_text)
+    )
+    await llm_client.close()
+    changed = {}
+    for document in ("qatar_id", "istimara"):
+        for field, value in raw_result.get(document, {}).items():
+            compacted_value = compacted_result.get(document, {}).get(field, "")
+            # Digits are normalized on purpose, only other differences count
+            if normalize_line(compacted_value) != normalize_line(value):
+                changed[f"{document}.{field}"] = [value, compacted_value]
+    return changed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--llm", action="store_true", help="compare extracted fields through the LLM")
+    parser.add_argument("--json", action="store_true", help="print machine-readable results")
+    args = parser.parse_args()
+
+    with open(SAMPLES_PATH, encoding="utf-8") as f:
+        samples = json.load(f)
+
+    results = []
+    for sample in samples:
+        raw_text = "\n\n".join(sample["files"])
+        started = time.perf_counter()
+        compacted_text, stats = compact_texts(sample["files"])
+        result = {
+            "sample": sample["name"],
+            "tokens_before": stats["tokens_before"],
+            "tokens_after": stats["tokens_after"],
+            "tokens_saved_pct": round(100 * (1 - stats["tokens_after"] / stats["tokens_before"]), 1),
+            "compact_ms": round((time.perf_counter() - started) * 1000, 2),
+            "lines_removed": stats["lines_removed"],
+            "lost_values": lost_values(raw_text, compacted_text, sample["expected"]),
+            "rule_changed_fields": rule_changed_fields(raw_text, compacted_text),
+        }
+        if args.llm:
+            result["changed_fields"] = asyncio.run(changed_fields(raw_text, compacted_text))
+        results.append(result)
+
+    failed = any(
+        result["lost_values"] or result["rule_changed_fields"] or result.get("changed_fields") for result in results
+    )
+
+    if args.json:
+        print(json.dumps(results, indent=2, ensure_ascii=False))
+    else:
+        for result in results:
+            print(
+                f"{result['sample']:<20} tokens {result['tokens_before']:>5} -> {result['tokens_after']:>5} "
+                f"({result['tokens_saved_pct']}% saved) in {result['compact_ms']}ms, removed {result['lines_removed']}"
+            )
+            if result["lost_values"]:
+                print(f"    LOST: {result['lost_values']}")
+            if result["rule_changed_fields"]:
+                print(f"    CHANGED (rules): {result['rule_changed_fields']}")
+            if result.get("changed_fields"):
+                print(f"    CHANGED: {result['changed_fields']}")
+        print("FAIL" if failed else "OK")
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
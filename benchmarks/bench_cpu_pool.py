@@ -0,0 +1,102 @@
+"""
+Pages per second of the CPU-bound image stages, inline (threads of one
+process, as without the pool) vs the CPU pool at 1..N worker processes.
+
+    python benchmarks/bench_cpu_pool.py [--pages 48] [--photos 12] [--workers 1,2,4] [--json]
+
+pdf:    rasterize and preprocess every page of a --pages page PDF
+        (cpu_pool.pdf_pages, consumed in order like the OCR stage does).
+photos: card detection and preprocessing of --photos phone photos,
+        all submitted at once like the read stage of concurrent requests.
+Worker counts default to powers of two up to the available cores.
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from fixtures import ISTIMARA_LINES, QID_LINES, QID_BACK_LINES, _pdf, build_fixtures
+from cpu_pool import CpuPool, available_cores
+from preprocessing import pdf_render_scale
+
+
+def pdf_pages_per_sec(pool: CpuPool, pdf: bytes, page_count: int) -> float:
+    started = time.perf_counter()
+    pages = list(pool.pdf_pages(pdf, page_count, scale=pdf_render_scale(), preprocess=True))
+    assert len(pages) == page_count
+    return round(page_count / (time.perf_counter() - started), 1)
+
+
+def photos_per_sec(pool: CpuPool, photos: list) -> float:
+    async def prepare_all():
+        return await asyncio.gather(*(
+            pool.prepare_image(photo, detect_cards=True, preprocess=True) for photo in photos
+        ))
+
+    started = time.perf_counter()
+    asyncio.run(prepare_all())
+    return round(len(photos) / (time.perf_counter() - started), 1)
+
+
+def measure(pool: CpuPool, pdf: bytes, page_count: int, photos: list) -> dict:
+    # One untimed page, so both variants run warm
+    pdf_pages_per_sec(pool, _pdf([ISTIMARA_LINES]), 1)
+    return {
+        "pdf_pages_per_sec": pdf_pages_per_sec(pool, pdf, page_count),
+        "photos_per_sec": photos_per_sec(pool, photos),
+    }
+
+
+def main():
+    cores = available_cores()
+    default_workers = sorted({min(2 ** power, cores) for power in range(8) if 2 ** power <= cores} | {cores})
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--pages", type=int, default=48)
+    parser.add_argument("--photos", type=int, default=12)
+    parser.add_argument("--workers", default=",".join(map(str, default_workers)), help="comma-separated pool sizes")
+    parser.add_argument("--json", action="store_true", help="print machine-readable results")
+    args = parser.parse_args()
+
+    cards = [ISTIMARA_LINES, QID_LINES + QID_BACK_LINES]
+    pdf = _pdf([cards[idx % len(cards)] for idx in range(args.pages)])
+    fixtures = build_fixtures()
+    photo_pool = [fixture["content"] for fixture in fixtures.values() if fixture["mime_type"] == "image/jpeg"]
+    photos = [photo_pool[idx % len(photo_pool)] for idx in range(args.photos)]
+
+    results = {"cores": cores, "pages": args.pages, "photos": args.photos, "runs": []}
+    inline = CpuPool(enabled=False)
+    results["runs"].append({"mode": "inline", "workers": 0, **measure(inline, pdf, args.pages, photos)})
+
+    for workers in [int(value) for value in args.workers.split(",") if value]:
+        pool = CpuPool(workers=workers, enabled=True)
+        pool.start()
+        try:
+            run = {"mode": "pool", "workers": workers, "warm_ms": pool.warm_ms, **measure(pool, pdf, args.pages, photos)}
+            run["shared_mb"] = pool.stats()["shared_mb"]
+        finally:
+            pool.close()
+        results["runs"].append(run)
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+
+    print(f"{cores} cores available, {args.pages} PDF pages, {args.photos} photos")
+    baseline = results["runs"][0]
+    for run in results["runs"]:
+        label = "inline" if run["mode"] == "inline" else f"pool x{run['workers']}"
+        speedup = run["pdf_pages_per_sec"] / baseline["pdf_pages_per_sec"] if baseline["pdf_pages_per_sec"] else 0
+        warm = f"   warm-up {run['warm_ms']}ms" if "warm_ms" in run else ""
+        print(
+            f"{label:<10} pdf {run['pdf_pages_per_sec']:>7} pages/s ({speedup:.2f}x)   "
+            f"photos {run['photos_per_sec']:>6} /s{warm}"
+        )
+
+
+if __name__ == "__main__":
+    main()
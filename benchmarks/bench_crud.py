@@ -0,0 +1,193 @@
+"""
+CRUDOperations benchmark against a local mongod: single vs bulk writes,
+to_list vs streaming reads, skip vs keyset pagination, and lookups by
+request_id with and without the declared indexes.
+
+    docker run -d -p 27017:27017 mongo:7
+    python benchmarks/bench_crud.py --documents 20000 [--uri mongodb://localhost:27017] [--json]
+
+Uses (and drops) the bench_crud database.
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from pymongo import IndexModel
+
+from database import MongoDB, CRUDOperations
+
+DATABASE = "bench_crud"
+
+
+def istimara_document(idx: int) -> dict:
+    return {
+        "request_id": f"req-{idx:07d}",
+        "vehicle_number": str(100000 + idx),
+        "owner_en": "MUHAMMAD AHMED KHAN",
+        "owner_qid": f"2{idx:010d}",
+        "vehicle_make": "TOYOTA",
+        "vehicle_model": "LAND CRUISER",
+        "vehicle_year": "2022",
+        "vehicle_chassis_no": f"JTMCY7AJ5K{idx:07d}",
+        "vehicle_expiry_date": "15/01/2026",
+    }
+
+
+async def timed(coro) -> tuple:
+    started = time.perf_counter()
+    result = await coro
+    return result, round((time.perf_counter() - started) * 1000, 1)
+
+
+async def writes(mongodb: MongoDB, count: int) -> dict:
+    single = CRUDOperations(mongodb, "single")
+    bulk = CRUDOperations(mongodb, "bulk")
+    documents = [istimara_document(idx) for idx in range(count)]
+
+    async def create_each():
+        for document in documents:
+            await single.create(dict(document))
+
+    async def upsert_each():
+        for document in documents:
+            await single.upsert({"request_id": document["request_id"]}, dict(document, vehicle_year="2023"))
+
+    _, create_ms = await timed(create_each())
+    _, bulk_create_ms = await timed(bulk.bulk_create([dict(document) for document in documents]))
+    await single.collection.create_index("request_id")
+    await bulk.collection.create_index("request_id")
+    _, upsert_ms = await timed(upsert_each())
+    _, bulk_upsert_ms = await timed(
+        bulk.bulk_upsert([dict(document, vehicle_year="2023") for document in documents], "request_id")
+    )
+    return {
+        "create_ms": create_ms,
+        "bulk_create_ms": bulk_create_ms,
+        "upsert_ms": upsert_ms,
+        "bulk_upsert_ms": bulk_upsert_ms,
+    }
+
+
+async def reads(crud: CRUDOperations, count: int) -> dict:
+    tracemalloc.start()
+    documents, to_list_ms = await timed(crud.find({}, limit=count))
+    to_list_peak = tracemalloc.get_traced_memory()[1]
+    del documents
+    tracemalloc.reset_peak()
+
+    async def stream_all():
+        seen = 0
+        async for _ in crud.stream(projection={"request_id": 1, "vehicle_chassis_no": 1}, batch_size=500):
+            seen += 1
+        return seen
+
+    _, stream_ms = await timed(stream_all())
+    stream_peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return {
+        "to_list_ms": to_list_ms,
+        "to_list_peak_kb": round(to_list_peak / 1024),
+        "stream_ms": stream_ms,
+        "stream_peak_kb": round(stream_peak / 1024),
+    }
+
+
+async def pagination(crud: CRUDOperations, count: int, page_size: int = 100) -> dict:
+    deep = max(0, count - page_size)
+    _, skip_ms = await timed(crud.get_all(skip=deep, limit=page_size))
+
+    # Walk to the same depth with keyset pages, timing only the last one
+    after = None
+    for _ in range(deep // page_size):
+        _, after = await crud.find_page(after=after, limit=page_size, projection={"_id": 1})
+    _, keyset_ms = await timed(crud.find_page(after=after, limit=page_size))
+    return {"depth": deep, "skip_page_ms": skip_ms, "keyset_page_ms": keyset_ms}
+
+
+async def lookups(mongodb: MongoDB, crud: CRUDOperations, count: int, queries: int = 200) -> dict:
+    request_ids = [f"req-{idx:07d}" for idx in range(0, count, max(1, count // queries))]
+
+    async def lookup_all():
+        for request_id in request_ids:
+            await crud.find_one({"request_id": request_id})
+
+    async def docs_examined() -> int:
+        explain = await mongodb.db.command(
+            "explain", {"find": crud.collection.name, "filter": {"request_id": request_ids[-1]}}, verbosity="executionStats"
+        )
+        return explain["executionStats"]["totalDocsExamined"]
+
+    await crud.collection.drop_indexes()
+    _, unindexed_ms = await timed(lookup_all())
+    unindexed_examined = await docs_examined()
+    await crud.ensure_indexes()
+    _, indexed_ms = await timed(lookup_all())
+    indexed_examined = await docs_examined()
+    return {
+        "queries": len(request_ids),
+        "unindexed_ms": unindexed_ms,
+        "unindexed_docs_examined": unindexed_examined,
+        "indexed_ms": indexed_ms,
+        "indexed_docs_examined": indexed_examined,
+    }
+
+
+async def run(uri: str, count: int) -> dict:
+    mongodb = MongoDB(uri, DATABASE)
+    await mongodb.client.drop_database(DATABASE)
+    try:
+        results = {"documents": count, "writes": await writes(mongodb, count)}
+        crud = CRUDOperations(mongodb, "bulk", indexes=[
+            IndexModel("request_id"),
+            IndexModel("owner_qid"),
+            IndexModel("vehicle_chassis_no")
+        ])
+        results["reads"] = await reads(crud, count)
+        results["pagination"] = await pagination(crud, count)
+        results["lookups"] = await lookups(mongodb, crud, count)
+        return results
+    finally:
+        await mongodb.client.drop_database(DATABASE)
+        await mongodb.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--uri", default=os.getenv("MONGO_BENCH_URI", "mongodb://localhost:27017"))
+    parser.add_argument("--documents", type=int, default=20000)
+    parser.add_argument("--json", action="store_true", help="print machine-readable results")
+    args = parser.parse_args()
+
+    results = asyncio.run(run(args.uri, args.documents))
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+
+    writes_result = results["writes"]
+    print(f"{results['documents']} documents")
+    print(f"create      one by one {writes_result['create_ms']:>9}ms   bulk_create {writes_result['bulk_create_ms']:>9}ms")
+    print(f"upsert      one by one {writes_result['upsert_ms']:>9}ms   bulk_upsert {writes_result['bulk_upsert_ms']:>9}ms")
+    reads_result = results["reads"]
+    print(
+        f"read all    to_list {reads_result['to_list_ms']}ms (peak {reads_result['to_list_peak_kb']}KB)   "
+        f"stream {reads_result['stream_ms']}ms (peak {reads_result['stream_peak_kb']}KB)"
+    )
+    pages = results["pagination"]
+    print(f"page at {pages['depth']}  skip {pages['skip_page_ms']}ms   keyset {pages['keyset_page_ms']}ms")
+    lookup = results["lookups"]
+    print(
+        f"{lookup['queries']} lookups by request_id  unindexed {lookup['unindexed_ms']}ms "
+        f"({lookup['unindexed_docs_examined']} docs examined)   indexed {lookup['indexed_ms']}ms "
+        f"({lookup['indexed_docs_examined']} docs examined)"
+    )
+
+
+if __name__ == "__main__":
+    main()
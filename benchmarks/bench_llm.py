@@ -0,0 +1,82 @@
+"""
+Load test of structured extraction: N concurrent extract_document_info calls
+through the shared client, reporting throughput, latency and token usage.
+Point it at the local stub to run offline:
+
+    python stubs/fake_openai.py --latency 0.8 --error-rate 0.1 &
+    OPENAI_BASE_URL=http://localhost:9200/v1 OPENAI_API_KEY=test \\
+        python benchmarks/bench_llm.py --requests 200 [--json]
+
+OPENAI_CONCURRENCY bounds the completions in flight.
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from fixtures import QID_LINES, ISTIMARA_LINES
+from llm_response import extract_document_info, llm_client
+
+
+async def run(requests: int):
+    context = "\n".join(QID_LINES + ISTIMARA_LINES)
+    latencies = []
+    errors = 0
+
+    async def one(idx: int):
+        nonlocal errors
+        started = time.perf_counter()
+        try:
+            # Vary the text so nothing can be served from a cache
+            result = await extract_document_info(f"{context}\nRef {idx}")
+            if "error" in result:
+                errors += 1
+        except Exception as e:
+            print(f"Request {idx} failed: {e}")
+            errors += 1
+        latencies.append((time.perf_counter() - started) * 1000)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(one(idx) for idx in range(requests)))
+    elapsed = time.perf_counter() - started
+    await llm_client.close()
+
+    latencies.sort()
+    stats = llm_client.stats()
+    stats.pop("recent_calls")
+    return {
+        "requests": requests,
+        "errors": errors,
+        "elapsed_s": round(elapsed, 2),
+        "requests_per_s": round(requests / elapsed, 2),
+        "p50_ms": round(latencies[len(latencies) // 2], 1),
+        "p95_ms": round(latencies[int(len(latencies) * 0.95) - 1], 1),
+        "client": stats
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=100)
+    parser.add_argument("--json", action="store_true", help="print machine-readable results")
+    args = parser.parse_args()
+
+    result = asyncio.run(run(args.requests))
+    if args.json:
+        print(json.dumps(result, indent=2))
+        return
+    client = result["client"]
+    print(
+        f"{result['requests']} requests in {result['elapsed_s']}s ({result['requests_per_s']}/s), "
+        f"p50 {result['p50_ms']}ms p95 {result['p95_ms']}ms, errors {result['errors']}, "
+        f"retries {client['retries']}, tokens {client['prompt_tokens']} + {client['completion_tokens']} "
+        f"(concurrency {client['max_concurrency']})"
+    )
+
+
+if __name__ == "__main__":
+    main()
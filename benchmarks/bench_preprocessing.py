@@ -0,0 +1,99 @@
+"""
+Preprocessing benchmark: upload size and encode time of the old pipeline
+(every page as a full-colour PNG, PDFs rendered at 2x) against the adaptive
+preprocessing profiles, on the synthetic fixture corpus.
+
+    python benchmarks/bench_preprocessing.py [--ocr] [--json]
+
+With --ocr both variants are also sent to Vision (needs GCP credentials) and
+the OCR text is compared line by line against the fixture's expected lines.
+"""
+import argparse
+import io
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from PIL import Image
+
+from fixtures import build_fixtures
+from helper_functions import iter_pdf_pages
+from preprocessing import preprocess_image, pixmap_encoder, pdf_render_scale
+
+
+def baseline_pages(fixture):
+    """Pages as the pipeline used to upload them"""
+    if fixture["mime_type"] == "application/pdf":
+        return list(iter_pdf_pages(fixture["content"], scale=2))
+    output = io.BytesIO()
+    Image.open(io.BytesIO(fixture["content"])).save(output, format="PNG")
+    return [output.getvalue()]
+
+
+def preprocessed_pages(fixture):
+    if fixture["mime_type"] == "application/pdf":
+        return list(iter_pdf_pages(fixture["content"], scale=pdf_render_scale(), encode_page=pixmap_encoder()))
+    upload_bytes, _ = preprocess_image(fixture["content"])
+    return [upload_bytes]
+
+
+def timed(fn, *args):
+    started = time.perf_counter()
+    result = fn(*args)
+    return result, (time.perf_counter() - started) * 1000
+
+
+def missing_lines(pages, expected_lines, gcp_helper):
+    text = "\n".join(gcp_helper.extract_text_from_image(page)[0] for page in pages)
+    normalized = " ".join(text.split()).lower()
+    return [line for line in expected_lines if " ".join(line.split()).lower() not in normalized]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--ocr", action="store_true", help="compare OCR text through Vision")
+    parser.add_argument("--json", action="store_true", help="print machine-readable results")
+    args = parser.parse_args()
+
+    gcp_helper = None
+    if args.ocr:
+        from ocr import GCPHelper
+        gcp_helper = GCPHelper()
+
+    results = []
+    for name, fixture in build_fixtures().items():
+        before, before_ms = timed(baseline_pages, fixture)
+        after, after_ms = timed(preprocessed_pages, fixture)
+        result = {
+            "fixture": name,
+            "pages": len(after),
+            "baseline_bytes": sum(len(page) for page in before),
+            "preprocessed_bytes": sum(len(page) for page in after),
+            "baseline_encode_ms": round(before_ms, 1),
+            "preprocessed_encode_ms": round(after_ms, 1),
+        }
+        result["bytes_saved_pct"] = round(100 * (1 - result["preprocessed_bytes"] / result["baseline_bytes"]), 1)
+        if gcp_helper:
+            result["baseline_missing_lines"] = missing_lines(before, fixture["expected_text"], gcp_helper)
+            result["preprocessed_missing_lines"] = missing_lines(after, fixture["expected_text"], gcp_helper)
+        results.append(result)
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+
+    for result in results:
+        print(
+            f"{result['fixture']:<22} pages={result['pages']} "
+            f"bytes {result['baseline_bytes']:>9} -> {result['preprocessed_bytes']:>9} ({result['bytes_saved_pct']}% saved) "
+            f"encode {result['baseline_encode_ms']:>7}ms -> {result['preprocessed_encode_ms']:>7}ms"
+        )
+        if gcp_helper:
+            print(f"    missing OCR lines: baseline={result['baseline_missing_lines']} preprocessed={result['preprocessed_missing_lines']}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,140 @@
+"""
+Combined vs per-document-type extraction on recorded Vision output
+(benchmarks/ocr_samples.json, one page per file).
+
+    python benchmarks/bench_split.py [--llm] [--json]
+
+Classifies the pages, then compares the estimated prompt tokens (text and
+response schema) of one combined call with those of one call per document
+type, each given only its own compacted pages. With --llm both are sent for
+extraction (OpenAI, or the stub through OPENAI_BASE_URL) and the latency,
+reported token usage and extracted fields are compared. Fails if a document
+type with expected fields gets no pages, or (with --llm) if a field differs.
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from compaction import compact_texts, estimate_tokens, normalize_line
+from page_classifier import group_pages
+from llm_response import (
+    SYSTEM_PROMPT, USER_PROMPT_TEMPLATE, DOCUMENT_PROMPT_TEMPLATE, DOCUMENT_MODELS, DOCUMENT_TITLES,
+    DocumentExtractionResponse
+)
+
+SAMPLES_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "ocr_samples.json")
+
+
+def prompt_tokens(prompt: str, model) -> int:
+    """Estimated prompt tokens of a structured output call: messages plus the response schema"""
+    schema = json.dumps(model.model_json_schema(), separators=(",", ":"))
+    return estimate_tokens(SYSTEM_PROMPT) + estimate_tokens(prompt) + estimate_tokens(schema)
+
+
+def split_contexts(files: list) -> tuple:
+    documents, pages = group_pages([(f"file_{idx}", [text]) for idx, text in enumerate(files, 1)])
+    contexts = {document: compact_texts(texts)[0] if texts else "" for document, texts in documents.items()}
+    return contexts, pages
+
+
+async def compare_llm(combined_context: str, contexts: dict) -> dict:
+    from llm_response import extract_document_info, extract_documents_memoized, llm_client
+
+    async def measure(call):
+        prompt_before, completion_before = llm_client.prompt_tokens, llm_client.completion_tokens
+        started = time.perf_counter()
+        result = await call
+        return result, {
+            "latency_ms": round((time.perf_counter() - started) * 1000, 1),
+            "prompt_tokens": llm_client.prompt_tokens - prompt_before,
+            "completion_tokens": llm_client.completion_tokens - completion_before
+        }
+
+    # One after the other, so the usage deltas are not mixed up
+    combined_result, combined = await measure(extract_document_info(combined_context))
+    split_result, split = await measure(extract_documents_memoized(contexts))
+    await llm_client.close()
+
+    changed = {}
+    for document in DOCUMENT_MODELS:
+        for field, value in combined_result.get(document, {}).items():
+            split_value = split_result.get(document, {}).get(field, "")
+            if normalize_line(split_value) != normalize_line(value):
+                changed[f"{document}.{field}"] = [value, split_value]
+    return {"combined": combined, "split": split, "changed_fields": changed}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--llm", action="store_true", help="send both variants for extraction")
+    parser.add_argument("--json", action="store_true", help="print machine-readable results")
+    args = parser.parse_args()
+
+    with open(SAMPLES_PATH, encoding="utf-8") as f:
+        samples = json.load(f)
+
+    results = []
+    for sample in samples:
+        combined_context = compact_texts(sample["files"])[0]
+        started = time.perf_counter()
+        contexts, pages = split_contexts(sample["files"])
+        classify_ms = round((time.perf_counter() - started) * 1000, 2)
+
+        combined_tokens = prompt_tokens(USER_PROMPT_TEMPLATE.format(context=combined_context), DocumentExtractionResponse)
+        split_tokens = {
+            document: prompt_tokens(
+                DOCUMENT_PROMPT_TEMPLATE.format(document=DOCUMENT_TITLES[document], context=context),
+                DOCUMENT_MODELS[document]
+            )
+            for document, context in contexts.items() if context
+        }
+        result = {
+            "sample": sample["name"],
+            "pages": [page["type"] for page in pages],
+            "classify_ms": classify_ms,
+            "combined_prompt_tokens": combined_tokens,
+            "split_prompt_tokens": split_tokens,
+            "largest_split_prompt_tokens": max(split_tokens.values(), default=0),
+            # Documents with expected values whose pages were all dropped
+            "unclassified": [
+                document for document, fields in sample["expected"].items()
+                if any(fields.values()) and not contexts.get(document)
+            ],
+        }
+        if args.llm:
+            result.update(asyncio.run(compare_llm(combined_context, contexts)))
+        results.append(result)
+
+    failed = any(result["unclassified"] or result.get("changed_fields") for result in results)
+
+    if args.json:
+        print(json.dumps(results, indent=2, ensure_ascii=False))
+    else:
+        for result in results:
+            print(
+                f"{result['sample']:<20} pages {result['pages']} classified in {result['classify_ms']}ms, "
+                f"prompt tokens combined {result['combined_prompt_tokens']} vs split {result['split_prompt_tokens']}"
+            )
+            if args.llm:
+                for variant in ("combined", "split"):
+                    usage = result[variant]
+                    print(
+                        f"    {variant:<8} {usage['latency_ms']:>7}ms, "
+                        f"{usage['prompt_tokens']} prompt + {usage['completion_tokens']} completion tokens"
+                    )
+            if result["unclassified"]:
+                print(f"    UNCLASSIFIED: {result['unclassified']}")
+            if result.get("changed_fields"):
+                print(f"    CHANGED: {result['changed_fields']}")
+        print("FAIL" if failed else "OK")
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,354 @@
+"""
+Offline per-stage benchmark suite with regression thresholds.
+
+Every stage runs on its own over the synthetic QID/Istimara corpus
+(benchmarks/fixtures.py), against local stand-ins for the paid services:
+
+    pdf_to_images            rasterize the fixture PDF
+    prepare_image            card detection and preprocessing of the fixture photos
+    image_encoding           PNG encoding of PIL pages for Vision (GCPHelper._image_content)
+    vision_ocr               GCPHelper page OCR against stubs/fake_vision.py (gRPC, in-process)
+    llm_extraction           extract_document_info against stubs/fake_openai.py (started here)
+    crud                     CRUDOperations create / find_one / upsert against a local mongod
+    format_extraction_message
+
+    python benchmarks/bench_stages.py [--iterations 10] [--stages pdf_to_images,crud]
+        [--mongo-uri mongodb://localhost:27017] [--baseline previous.json] [--output results.json]
+
+Prints JSON results (p50/p95/mean per stage, commit, host). A stage fails if
+its p50 is over its ceiling in benchmarks/thresholds.json, or more than
+--tolerance slower than in --baseline (the JSON of an earlier run). Stages
+whose stand-in is not available (no mongod) are skipped. Exit code 1 on failure.
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import socket
+import statistics
+import subprocess
+import sys
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, "stubs"))
+
+THRESHOLDS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "thresholds.json")
+DATABASE = "bench_stages"
+
+from fixtures import QID_LINES, QID_BACK_LINES, ISTIMARA_LINES, build_fixtures
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+class Skip(Exception):
+    """A stage whose stand-in service is not available"""
+
+
+def summarize(timings: list) -> dict:
+    timings = sorted(timings)
+    return {
+        "runs": len(timings),
+        "p50_ms": round(statistics.median(timings), 2),
+        "p95_ms": round(timings[min(len(timings) - 1, int(len(timings) * 0.95))], 2),
+        "mean_ms": round(statistics.fmean(timings), 2),
+        "min_ms": round(timings[0], 2),
+    }
+
+
+async def measure(call, iterations: int) -> dict:
+    """Time iterations calls of call() (sync or async), after one untimed warm-up call"""
+    async def once():
+        result = call()
+        if asyncio.iscoroutine(result):
+            await result
+
+    await once()
+    timings = []
+    for _ in range(iterations):
+        started = time.perf_counter()
+        await once()
+        timings.append((time.perf_counter() - started) * 1000)
+    return summarize(timings)
+
+
+# ---------------------------------------------------------------------------
+# Stages
+# ---------------------------------------------------------------------------
+
+async def bench_pdf_to_images(corpus: dict, iterations: int, args) -> dict:
+    from helper_functions import pdf_to_images
+
+    pdf = corpus["istimara.pdf"]["content"]
+    result = await measure(lambda: pdf_to_images(pdf), iterations)
+    result["pages"] = len(pdf_to_images(pdf))
+    return result
+
+
+async def bench_prepare_image(corpus: dict, iterations: int, args) -> dict:
+    from preprocessing import prepare_image
+
+    photos = [fixture["content"] for fixture in corpus.values() if fixture["mime_type"] != "application/pdf"]
+
+    def prepare_all():
+        for photo in photos:
+            prepare_image(photo)
+
+    result = await measure(prepare_all, iterations)
+    result["images"] = len(photos)
+    return result
+
+
+async def bench_image_encoding(corpus: dict, iterations: int, args) -> dict:
+    from helper_functions import pdf_to_images
+    from ocr import GCPHelper
+
+    pages = pdf_to_images(corpus["istimara.pdf"]["content"])
+    for page in pages:
+        page.load()
+
+    def encode_all():
+        for page in pages:
+            GCPHelper._image_content(page)
+
+    result = await measure(encode_all, iterations)
+    result["pages"] = len(pages)
+    return result
+
+
+async def bench_vision_ocr(corpus: dict, iterations: int, args) -> dict:
+    from fake_vision import serve
+
+    import ocr
+    from ocr import GCPHelper, VisionClientPool
+
+    server, fake, port = serve(0, latency=args.vision_latency)
+    # Clients created from here on talk to the fake server
+    ocr.VISION_API_ENDPOINT = f"127.0.0.1:{port}"
+
+    from preprocessing import prepare_image
+
+    pool = VisionClientPool(1)
+    helper = GCPHelper(pool=pool)
+    # The pages the read stage would send: preprocessed photos
+    pages = [
+        page
+        for fixture in corpus.values() if fixture["mime_type"] != "application/pdf"
+        for page in prepare_image(fixture["content"])[0]
+    ]
+    try:
+        result = await measure(lambda: helper.extract_text_from_images(pages, batch_size=1), iterations)
+    finally:
+        pool.close()
+        server.stop(grace=None)
+    result["pages"] = len(pages)
+    result["vision_requests"] = fake.requests
+    return result
+
+
+async def bench_llm_extraction(corpus: dict, iterations: int, args) -> dict:
+    port = free_port()
+    stub = subprocess.Popen(
+        [sys.executable, os.path.join(ROOT, "stubs", "fake_openai.py"), "--port", str(port), "--latency", str(args.llm_latency)],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL
+    )
+    try:
+        import httpx
+
+        for _ in range(100):
+            try:
+                httpx.get(f"http://127.0.0.1:{port}/stats", timeout=1.0)
+                break
+            except httpx.HTTPError:
+                time.sleep(0.1)
+        else:
+            raise Skip("OpenAI stub did not start")
+
+        # Read by the OpenAI client when it is created
+        os.environ["OPENAI_BASE_URL"] = f"http://127.0.0.1:{port}/v1"
+        os.environ["OPENAI_API_KEY"] = "bench"
+        from llm_response import extract_document_info, llm_client
+
+        context = "\n".join(QID_LINES + QID_BACK_LINES + ISTIMARA_LINES)
+        calls = 0
+
+        async def extract():
+            nonlocal calls
+            calls += 1
+            # Vary the text so nothing can be served from a cache
+            result = await extract_document_info(f"{context}\nRef {calls}")
+            if "error" in result:
+                raise RuntimeError(result["error"])
+
+        try:
+            result = await measure(extract, iterations)
+        finally:
+            await llm_client.close()
+        result["prompt_tokens"] = llm_client.prompt_tokens
+        return result
+    finally:
+        stub.terminate()
+        stub.wait()
+
+
+async def bench_crud(corpus: dict, iterations: int, args) -> dict:
+    from pymongo import IndexModel
+    from database import MongoDB, CRUDOperations
+
+    mongodb = MongoDB(args.mongo_uri, DATABASE)
+    try:
+        await asyncio.wait_for(mongodb.client.admin.command("ping"), timeout=3)
+    except Exception as e:
+        await mongodb.close()
+        raise Skip(f"no mongod at {args.mongo_uri}: {type(e).__name__}")
+
+    await mongodb.client.drop_database(DATABASE)
+    try:
+        crud = CRUDOperations(mongodb, "istimaras", indexes=[IndexModel("request_id")])
+        await crud.ensure_indexes()
+        calls = 0
+
+        async def roundtrip():
+            nonlocal calls
+            calls += 1
+            request_id = f"bench-{calls}"
+            await crud.create({"request_id": request_id, "vehicle_chassis_no": "JTMCY7AJ5K4123456"})
+            await crud.find_one({"request_id": request_id})
+            await crud.upsert({"request_id": request_id}, {"vehicle_year": "2023"})
+
+        return await measure(roundtrip, iterations)
+    finally:
+        await mongodb.client.drop_database(DATABASE)
+        await mongodb.close()
+
+
+async def bench_format_extraction_message(corpus: dict, iterations: int, args) -> dict:
+    from whatsapp_func import format_extraction_message
+
+    qatar_id = {
+        "name": "MUHAMMAD AHMED KHAN", "id_no": "28412345678", "dob": "15/03/1984",
+        "nationality": "PAKISTAN", "occupation": "ENGINEER", "expiry_date": "10/05/2027",
+        "passport_number": "AB1234567", "passport_expiry": "20/12/2028", "employer": "QATAR PETROLEUM"
+    }
+    istimara = {
+        "owner_en": "MUHAMMAD AHMED KHAN", "vehicle_number": "123456", "vehicle_make": "TOYOTA",
+        "vehicle_model": "LAND CRUISER", "vehicle_year": "2022", "vehicle_chassis_no": "JTMCY7AJ5K4123456",
+        "vehicle_expiry_date": "15/01/2026"
+    }
+
+    def format_many():
+        # A single call is too quick to time on its own
+        for _ in range(1000):
+            format_extraction_message("req-1", "Client", qatar_id, istimara)
+
+    result = await measure(format_many, iterations)
+    result["calls_per_run"] = 1000
+    return result
+
+
+STAGES = {
+    "pdf_to_images": bench_pdf_to_images,
+    "prepare_image": bench_prepare_image,
+    "image_encoding": bench_image_encoding,
+    "vision_ocr": bench_vision_ocr,
+    "llm_extraction": bench_llm_extraction,
+    "crud": bench_crud,
+    "format_extraction_message": bench_format_extraction_message,
+}
+
+
+def check(name: str, result: dict, thresholds: dict, baseline: dict, tolerance: float) -> list:
+    """Reasons the stage failed (empty when it passed)"""
+    failures = []
+    ceiling = thresholds.get(name, {}).get("p50_ms")
+    if ceiling is not None and result["p50_ms"] > ceiling:
+        failures.append(f"p50 {result['p50_ms']}ms over the {ceiling}ms threshold")
+    previous = baseline.get("stages", {}).get(name, {})
+    if previous.get("p50_ms") and result["p50_ms"] > previous["p50_ms"] * (1 + tolerance):
+        failures.append(
+            f"p50 {result['p50_ms']}ms is more than {tolerance:.0%} over {previous['p50_ms']}ms "
+            f"at {baseline.get('commit', 'baseline')}"
+        )
+    return failures
+
+
+async def run(args) -> dict:
+    corpus = build_fixtures()
+    with open(THRESHOLDS_PATH, encoding="utf-8") as f:
+        thresholds = json.load(f)
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+
+    results = {
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "cores": os.cpu_count(),
+        "iterations": args.iterations,
+        "stages": {},
+    }
+    names = args.stages.split(",") if args.stages else list(STAGES)
+    for name in names:
+        try:
+            result = await STAGES[name](corpus, args.iterations, args)
+        except Skip as e:
+            results["stages"][name] = {"status": "skipped", "reason": str(e)}
+            continue
+        except Exception as e:
+            results["stages"][name] = {"status": "error", "reason": f"{type(e).__name__}: {e}"}
+            continue
+        failures = check(name, result, thresholds, baseline, args.tolerance)
+        result["threshold_p50_ms"] = thresholds.get(name, {}).get("p50_ms")
+        result["status"] = "failed" if failures else "ok"
+        if failures:
+            result["failures"] = failures
+        results["stages"][name] = result
+    results["ok"] = not any(stage["status"] in ("failed", "error") for stage in results["stages"].values())
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--iterations", type=int, default=10)
+    parser.add_argument("--stages", help=f"comma-separated subset of {','.join(STAGES)}")
+    parser.add_argument("--mongo-uri", default=os.getenv("MONGO_BENCH_URI", "mongodb://localhost:27017"))
+    parser.add_argument("--vision-latency", type=float, default=0.0, help="mean seconds per fake Vision call")
+    parser.add_argument("--llm-latency", type=float, default=0.0, help="mean seconds per fake completion")
+    parser.add_argument("--baseline", help="results JSON of an earlier run to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed p50 slowdown against --baseline")
+    parser.add_argument("--output", help="also write the results JSON to this file")
+    args = parser.parse_args()
+
+    if args.stages:
+        unknown = set(args.stages.split(",")) - set(STAGES)
+        if unknown:
+            parser.error(f"unknown stages: {', '.join(sorted(unknown))}")
+
+    results = asyncio.run(run(args))
+    output = json.dumps(results, indent=2)
+    print(output)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(output + "\n")
+    sys.exit(0 if results["ok"] else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,122 @@
+"""
+Synthetic Qatar ID / Istimara fixtures for the benchmarks.
+Everything is generated deterministically from a fixed seed, so no real
+customer documents are needed and every run sees the same pixels.
+"""
+from typing import Dict, List, Tuple
+from PIL import Image, ImageDraw, ImageFilter, ImageFont
+import fitz
+import io
+import random
+
+QID_LINES = [
+    "State of Qatar",
+    "Residency Permit",
+    "ID No: 28412345678",
+    "D.O.B: 15/03/1984",
+    "Expiry: 10/05/2027",
+    "Nationality: PAKISTAN",
+    "Name: MUHAMMAD AHMED KHAN",
+    "Occupation: ENGINEER",
+]
+
+QID_BACK_LINES = [
+    "Passport Number: AB1234567",
+    "Passport Expiry: 20/12/2028",
+    "Serial No: 0123456789",
+    "Employer: QATAR PETROLEUM",
+]
+
+ISTIMARA_LINES = [
+    "State of Qatar - Ministry of Interior",
+    "Vehicle Registration",
+    "Plate No: 123456",
+    "Owner: MUHAMMAD AHMED KHAN",
+    "Owner ID: 28412345678",
+    "Nationality: PAKISTAN",
+    "Make: TOYOTA  Model: LAND CRUISER",
+    "Year: 2022  Color: WHITE",
+    "Chassis No: JTMCY7AJ5K4123456",
+    "Engine No: 1GR1234567",
+    "Reg. Date: 15/01/2022  Expiry: 15/01/2026",
+    "Insurance: QATAR INSURANCE CO  Policy: QIC-2024-12345",
+]
+
+
+def _card(lines: List[str], size: Tuple[int, int] = (1011, 638), tint=(222, 235, 245)) -> Image.Image:
+    """ID-1 sized card at 300 DPI with the given text lines"""
+    card = Image.new("RGB", size, tint)
+    draw = ImageDraw.Draw(card)
+    font = ImageFont.load_default(size=30)
+    draw.rectangle([0, 0, size[0], 70], fill=(120, 30, 60))
+    draw.text((30, 18), lines[0], fill=(255, 255, 255), font=font)
+    for idx, line in enumerate(lines[1:]):
+        draw.text((30, 95 + idx * 50), line, fill=(20, 20, 20), font=font)
+    return card
+
+
+def _photo(card: Image.Image, seed: int, frame=(4000, 3000), angle: float = 4.0) -> Image.Image:
+    """Place a card, slightly rotated, on a noisy background like a phone photo"""
+    rng = random.Random(seed)
+    background = Image.frombytes("L", frame, rng.randbytes(frame[0] * frame[1])).convert("RGB")
+    background = Image.blend(background, Image.new("RGB", frame, (140, 110, 90)), 0.6)
+    scaled = card.resize((card.width * 2, card.height * 2), Image.LANCZOS)
+    rotated = scaled.rotate(angle, expand=True, resample=Image.BICUBIC, fillcolor=(140, 110, 90))
+    x = rng.randint(200, frame[0] - rotated.width - 200)
+    y = rng.randint(200, frame[1] - rotated.height - 200)
+    background.paste(rotated, (x, y))
+    return background.filter(ImageFilter.GaussianBlur(0.6))
+
+
+def _jpeg(img: Image.Image, quality: int = 92) -> bytes:
+    output = io.BytesIO()
+    img.save(output, format="JPEG", quality=quality)
+    return output.getvalue()
+
+
+def _png(img: Image.Image) -> bytes:
+    output = io.BytesIO()
+    img.save(output, format="PNG")
+    return output.getvalue()
+
+
+def _pdf(pages: List[List[str]], blank_pages: int = 0) -> bytes:
+    document = fitz.open()
+    for lines in pages:
+        page = document.new_page()
+        for idx, line in enumerate(lines):
+            page.insert_text((60, 80 + idx * 24), line, fontsize=13)
+    for _ in range(blank_pages):
+        document.new_page()
+    data = document.tobytes()
+    document.close()
+    return data
+
+
+def build_fixtures() -> Dict[str, Dict]:
+    """
+    Fixture corpus: name -> {"mime_type", "content", "expected_text"}.
+    expected_text lists lines that OCR must recover from the fixture.
+    """
+    return {
+        "qid_front_photo.jpg": {
+            "mime_type": "image/jpeg",
+            "content": _jpeg(_photo(_card(QID_LINES), seed=1)),
+            "expected_text": QID_LINES[2:],
+        },
+        "qid_back_scan.png": {
+            "mime_type": "image/png",
+            "content": _png(_card(["State of Qatar"] + QID_BACK_LINES)),
+            "expected_text": QID_BACK_LINES,
+        },
+        "istimara_photo.jpg": {
+            "mime_type": "image/jpeg",
+            "content": _jpeg(_photo(_card(ISTIMARA_LINES, size=(1011, 720), tint=(240, 240, 230)), seed=2, angle=-3.0)),
+            "expected_text": ISTIMARA_LINES[2:],
+        },
+        "istimara.pdf": {
+            "mime_type": "application/pdf",
+            "content": _pdf([ISTIMARA_LINES, QID_LINES + QID_BACK_LINES], blank_pages=1),
+            "expected_text": ISTIMARA_LINES[2:],
+        },
+    }
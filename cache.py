@@ -0,0 +1,159 @@
+from collections import OrderedDict
+from datetime import datetime
+from typing import Optional, Dict, Any
+import copy
+import hashlib
+import threading
+import time
+
+from database import CRUDOperations
+from metrics import cache_lookups
+
+
+def content_hash(*parts) -> str:
+    """SHA-256 over the given bytes/str parts, used as a content-addressed cache key"""
+    digest = hashlib.sha256()
+    for part in parts:
+        if isinstance(part, str):
+            part = part.encode("utf-8")
+        digest.update(part)
+        digest.update(b"\x00")
+    return digest.hexdigest()
+
+
+class ResultCache:
+    """
+    Two-tier cache for expensive results:
+    - a bounded in-process LRU (first tier)
+    - an optional MongoDB collection with a TTL index (second tier, shared by all workers)
+    Mongo errors never fail the caller, they are counted and treated as a miss.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        max_entries: int = 1024,
+        ttl_seconds: int = 7 * 24 * 3600,
+        crud: CRUDOperations = None,
+        bypass: bool = False
+    ):
+        self.name = name
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.crud = crud
+        self.bypass = bypass
+
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+        # Stats
+        self.memory_hits = 0
+        self.mongo_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.mongo_errors = 0
+
+        # Per-tier lookup latency (total seconds and number of lookups)
+        self.memory_lookup_seconds = 0.0
+        self.memory_lookups = 0
+        self.mongo_lookup_seconds = 0.0
+        self.mongo_lookups = 0
+
+    async def ensure_indexes(self):
+        """Create the unique key index and the TTL index on the Mongo tier"""
+        if self.crud is None:
+            return
+        await self.crud.collection.create_index("key", unique=True)
+        await self.crud.collection.create_index("created_at", expireAfterSeconds=self.ttl_seconds)
+
+    def _memory_get(self, key: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+        # Callers get their own copy, so mutating a result never corrupts the cache
+        return copy.deepcopy(value)
+
+    def _memory_set(self, key: str, value: Dict[str, Any]):
+        value = copy.deepcopy(value)
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    async def get(self, key: str) -> Optional[Dict[str, Any]]:
+        """Look a key up in memory, then in Mongo. Returns None on a miss or when bypassed."""
+        if self.bypass:
+            return None
+
+        started = time.perf_counter()
+        value = self._memory_get(key)
+        self.memory_lookup_seconds += time.perf_counter() - started
+        self.memory_lookups += 1
+        if value is not None:
+            self.memory_hits += 1
+            cache_lookups.inc(cache=self.name, result="memory_hit")
+            return value
+
+        if self.crud is not None:
+            started = time.perf_counter()
+            try:
+                document = await self.crud.find_one({"key": key})
+            except Exception as e:
+                print(f"Error reading {self.name} cache from MongoDB: {e}")
+                self.mongo_errors += 1
+                document = None
+            self.mongo_lookup_seconds += time.perf_counter() - started
+            self.mongo_lookups += 1
+            if document:
+                self.mongo_hits += 1
+                cache_lookups.inc(cache=self.name, result="mongo_hit")
+                self._memory_set(key, document["value"])
+                return document["value"]
+
+        self.misses += 1
+        cache_lookups.inc(cache=self.name, result="miss")
+        return None
+
+    async def set(self, key: str, value: Dict[str, Any]):
+        """Store a value in both tiers"""
+        if self.bypass:
+            return
+
+        self._memory_set(key, value)
+
+        if self.crud is not None:
+            try:
+                await self.crud.upsert(
+                    {"key": key},
+                    {"key": key, "value": value, "created_at": datetime.utcnow()}
+                )
+            except Exception as e:
+                print(f"Error writing {self.name} cache to MongoDB: {e}")
+                self.mongo_errors += 1
+
+    def clear(self):
+        """Drop the in-process tier"""
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.memory_hits + self.mongo_hits + self.misses
+        return {
+            "name": self.name,
+            "bypass": self.bypass,
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "memory_hits": self.memory_hits,
+            "mongo_hits": self.mongo_hits,
+            "misses": self.misses,
+            "hit_rate": (self.memory_hits + self.mongo_hits) / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+            "mongo_errors": self.mongo_errors,
+            "memory_lookups": self.memory_lookups,
+            "memory_avg_latency_ms": 1000 * self.memory_lookup_seconds / self.memory_lookups if self.memory_lookups else 0.0,
+            "mongo_lookups": self.mongo_lookups,
+            "mongo_avg_latency_ms": 1000 * self.mongo_lookup_seconds / self.mongo_lookups if self.mongo_lookups else 0.0
+        }
@@ -0,0 +1,113 @@
+from typing import List
+import cv2
+import numpy as np
+import os
+
+CARD_DETECTION_ENABLED = os.getenv("CARD_DETECTION_ENABLED", "true").lower() == "true"
+
+# Detection runs on a downscaled copy of the frame
+DETECTION_WIDTH = 1000
+# A card must cover at least this fraction of the frame...
+MIN_CARD_AREA_RATIO = float(os.getenv("CARD_MIN_AREA_RATIO", "0.04"))
+# ...and at most this much (a card filling the frame needs no crop)
+MAX_CARD_AREA_RATIO = 0.9
+# Long side / short side of ID-1 cards is 1.586, allow for perspective
+MIN_CARD_ASPECT = 1.25
+MAX_CARD_ASPECT = 1.95
+# Contours that fill at least this much of their min-area rectangle are
+# accepted as rectangles even when the polygon fit has rounded corners
+MIN_RECT_FILL = 0.85
+
+
+def order_corners(quad: np.ndarray) -> np.ndarray:
+    """Order 4 points as top-left, top-right, bottom-right, bottom-left"""
+    quad = quad.reshape(4, 2).astype(np.float32)
+    sums = quad.sum(axis=1)
+    diffs = np.diff(quad, axis=1).ravel()
+    return np.array([
+        quad[np.argmin(sums)],
+        quad[np.argmin(diffs)],
+        quad[np.argmax(sums)],
+        quad[np.argmax(diffs)]
+    ], dtype=np.float32)
+
+
+def _quad_aspect(quad: np.ndarray) -> float:
+    edges = np.linalg.norm(quad - np.roll(quad, -1, axis=0), axis=1)
+    width = (edges[0] + edges[2]) / 2
+    height = (edges[1] + edges[3]) / 2
+    short_side = min(width, height)
+    return max(width, height) / short_side if short_side else 0.0
+
+
+def _contour_quad(contour: np.ndarray):
+    perimeter = cv2.arcLength(contour, True)
+    approx = cv2.approxPolyDP(contour, 0.02 * perimeter, True)
+    if len(approx) == 4 and cv2.isContourConvex(approx):
+        return approx.reshape(4, 2).astype(np.float32)
+
+    # Rounded card corners often give more than 4 points
+    rect = cv2.minAreaRect(contour)
+    rect_area = rect[1][0] * rect[1][1]
+    if rect_area and cv2.contourArea(contour) / rect_area >= MIN_RECT_FILL:
+        return cv2.boxPoints(rect).astype(np.float32)
+    return None
+
+
+def find_cards(image: np.ndarray) -> List[np.ndarray]:
+    """
+    Find card-shaped quadrilaterals in a BGR frame.
+    Returns ordered corner arrays in full-resolution coordinates, largest first,
+    without cards nested inside another card.
+    """
+    height, width = image.shape[:2]
+    scale = min(1.0, DETECTION_WIDTH / width)
+    small = cv2.resize(image, (round(width * scale), round(height * scale)), interpolation=cv2.INTER_AREA) if scale < 1 else image
+
+    gray = cv2.cvtColor(small, cv2.COLOR_BGR2GRAY)
+    gray = cv2.GaussianBlur(gray, (5, 5), 0)
+    edges = cv2.Canny(gray, 40, 120)
+    edges = cv2.dilate(edges, np.ones((3, 3), np.uint8), iterations=2)
+    contours, _ = cv2.findContours(edges, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+
+    frame_area = small.shape[0] * small.shape[1]
+    candidates = []
+    for contour in contours:
+        area = cv2.contourArea(contour)
+        if not MIN_CARD_AREA_RATIO * frame_area <= area <= MAX_CARD_AREA_RATIO * frame_area:
+            continue
+        quad = _contour_quad(contour)
+        if quad is None:
+            continue
+        quad = order_corners(quad)
+        if MIN_CARD_ASPECT <= _quad_aspect(quad) <= MAX_CARD_ASPECT:
+            candidates.append((area, quad))
+
+    cards = []
+    for _, quad in sorted(candidates, key=lambda candidate: candidate[0], reverse=True):
+        center = tuple(float(v) for v in quad.mean(axis=0))
+        if any(cv2.pointPolygonTest(card, center, False) >= 0 for card in cards):
+            continue
+        cards.append(quad)
+
+    return [card / scale for card in cards]
+
+
+def warp_card(image: np.ndarray, corners: np.ndarray) -> np.ndarray:
+    """Perspective-correct one card into its own upright rectangle"""
+    edges = np.linalg.norm(corners - np.roll(corners, -1, axis=0), axis=1)
+    width = int(round(max(edges[0], edges[2])))
+    height = int(round(max(edges[1], edges[3])))
+    target = np.array([[0, 0], [width - 1, 0], [width - 1, height - 1], [0, height - 1]], dtype=np.float32)
+    matrix = cv2.getPerspectiveTransform(corners.astype(np.float32), target)
+    return cv2.warpPerspective(image, matrix, (width, height), flags=cv2.INTER_CUBIC)
+
+
+def split_cards(image: np.ndarray) -> List[np.ndarray]:
+    """
+    Crop every card found in the frame, top-to-bottom then left-to-right.
+    Returns an empty list when no card is found (callers fall back to the full frame).
+    """
+    cards = find_cards(image)
+    cards.sort(key=lambda corners: (round(corners[:, 1].min() / 50), corners[:, 0].min()))
+    return [warp_card(image, corners) for corners in cards]
@@ -0,0 +1,184 @@
+from typing import List, Dict, Any, Tuple
+import math
+import os
+import re
+
+COMPACTION_ENABLED = os.getenv("COMPACTION_ENABLED", "true").lower() == "true"
+# Max estimated prompt tokens of OCR text sent for extraction
+COMPACTION_TOKEN_BUDGET = int(os.getenv("COMPACTION_TOKEN_BUDGET", "3000"))
+# A run of this many lines seen before (e.g. the same page uploaded twice) is dropped.
+# Longer than one bilingual field (label and value in English and Arabic), which
+# two cards can share, like Nationality QATAR on the Qatar ID and the Istimara
+COMPACTION_DUPLICATE_RUN = int(os.getenv("COMPACTION_DUPLICATE_RUN", "6"))
+
+# Arabic-Indic and Extended Arabic-Indic (Persian) digits to ASCII
+DIGITS = str.maketrans("٠١٢٣٤٥٦٧٨٩۰۱۲۳۴۵۶۷۸۹", "01234567890123456789")
+
+# Card headers and issuing authority lines that carry none of the extracted fields.
+# Document titles (Residency Permit, Vehicle Registration...) are kept, they tell
+# the model which card a field belongs to.
+BOILERPLATE_PATTERNS = [re.compile(pattern, re.IGNORECASE) for pattern in (
+    r"state of qatar",
+    r"دولة قطر",
+    r"ministry of interior",
+    r"وزارة الداخلية",
+    r"general directorate of (traffic|passports)",
+    r"الإدارة العامة (للمرور|للجوازات)",
+    r"traffic department",
+    r"director general of passports",
+    r"مدير عام الجوازات",
+    r"signature of (the )?holder",
+    r"توقيع (صاحب|حامل) البطاقة",
+    r"(this card|هذه البطاقة).{0,80}",
+    r"(www\.)?moi\.gov\.qa",
+)]
+
+# A field label, on its own line before its value: any line ending with a colon
+# and the bare labels of free-text fields whose value can read like a header
+# (Nationality QATAR, Employer Ministry of Interior). The line after one is
+# never dropped as boilerplate.
+FIELD_LABEL = re.compile(
+    r".{1,40}:|(nationality|employer|occupation|owner( name)?|insurance( company)?|insurer)"
+    r"|(الجنسية|صاحب العمل|المهنة|المالك|اسم المالك|شركة التأمين)",
+    re.IGNORECASE
+)
+
+BOILERPLATE_SEPARATOR = re.compile(r"\s[-/|]\s")
+WHITESPACE = re.compile(r"\s+")
+# Runs of separator characters Vision reads from card borders and table lines
+SEPARATORS = re.compile(r"[|_~=•·]{2,}|-{3,}|\.{3,}")
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    Rough GPT-4o token count: about 4 characters per token for Latin text
+    and 2 for Arabic. Good enough to compare prompt sizes and apply a budget.
+    """
+    ascii_chars = sum(1 for char in text if ord(char) < 128)
+    return math.ceil(ascii_chars / 4 + (len(text) - ascii_chars) / 2)
+
+
+def normalize_line(line: str) -> str:
+    line = line.translate(DIGITS)
+    line = SEPARATORS.sub(" ", line)
+    return WHITESPACE.sub(" ", line).strip(" .,:;|-")
+
+
+def is_boilerplate(line: str) -> bool:
+    """The whole line is made of boilerplate, e.g. State of Qatar - Ministry of Interior"""
+    parts = [part.strip() for part in BOILERPLATE_SEPARATOR.split(line)]
+    return all(
+        any(pattern.fullmatch(part) for pattern in BOILERPLATE_PATTERNS)
+        for part in parts if part
+    )
+
+
+def is_noise(line: str) -> bool:
+    """Stray marks: fewer than 2 letters or digits and no digit (lone digits can be values)"""
+    alnum = sum(1 for char in line if char.isalnum())
+    return alnum < 2 and not any(char.isdigit() for char in line)
+
+
+def _clean_lines(text: str) -> Tuple[List[str], Dict[str, int]]:
+    lines = []
+    removed = {"boilerplate": 0, "noise": 0, "repeated": 0}
+    after_label = False
+    for raw_line in text.splitlines():
+        line = normalize_line(raw_line)
+        if not line:
+            continue
+        if is_noise(line):
+            removed["noise"] += 1
+            continue
+        if not after_label and is_boilerplate(line):
+            removed["boilerplate"] += 1
+        elif lines and lines[-1] == line:
+            removed["repeated"] += 1
+        else:
+            lines.append(line)
+        after_label = bool(FIELD_LABEL.fullmatch(raw_line.strip()))
+    return lines, removed
+
+
+def _drop_duplicate_runs(files_lines: List[List[str]], run: int) -> Tuple[List[List[str]], int]:
+    """
+    Drop every line covered by a run of `run` consecutive lines that already
+    appeared earlier (in the same or a previous file). A single value line
+    shared by two cards, like a name or nationality, is kept.
+    """
+    first_seen = {}
+    kept_files = []
+    dropped = 0
+    for file_index, lines in enumerate(files_lines):
+        duplicate = [False] * len(lines)
+        for start in range(len(lines) - run + 1):
+            shingle = tuple(lines[start:start + run])
+            if shingle in first_seen and first_seen[shingle] != (file_index, start):
+                for idx in range(start, start + run):
+                    duplicate[idx] = True
+            else:
+                first_seen.setdefault(shingle, (file_index, start))
+        kept_files.append([line for line, is_duplicate in zip(lines, duplicate) if not is_duplicate])
+        dropped += sum(duplicate)
+    return kept_files, dropped
+
+
+def _apply_budget(files_lines: List[List[str]], budget: int) -> Tuple[List[List[str]], bool]:
+    """Share the token budget between files (small files keep everything), truncating the rest"""
+    costs = [[estimate_tokens(line) + 1 for line in lines] for lines in files_lines]
+    if sum(map(sum, costs)) <= budget:
+        return files_lines, False
+
+    allowance = [0] * len(files_lines)
+    remaining = budget
+    order = sorted(range(len(files_lines)), key=lambda idx: sum(costs[idx]))
+    for position, idx in enumerate(order):
+        share = remaining // (len(order) - position)
+        allowance[idx] = min(sum(costs[idx]), share)
+        remaining -= allowance[idx]
+
+    kept_files = []
+    for lines, line_costs, allowed in zip(files_lines, costs, allowance):
+        kept, used = [], 0
+        for line, cost in zip(lines, line_costs):
+            if used + cost > allowed:
+                break
+            kept.append(line)
+            used += cost
+        kept_files.append(kept)
+    return kept_files, True
+
+
+def compact_texts(
+    file_texts: List[str],
+    token_budget: int = COMPACTION_TOKEN_BUDGET,
+    duplicate_run: int = COMPACTION_DUPLICATE_RUN
+) -> Tuple[str, Dict[str, Any]]:
+    """
+    Compact the OCR text of every file of a request for the extraction prompt:
+    normalize whitespace and digits, drop stray marks, card boilerplate,
+    repeated lines and runs of lines seen before, then fit the token budget.
+    Returns the prompt text (files separated by a blank line) and stats.
+    """
+    original = "\n\n".join(file_texts)
+    removed = {"boilerplate": 0, "noise": 0, "repeated": 0}
+    files_lines = []
+    for text in file_texts:
+        lines, file_removed = _clean_lines(text)
+        files_lines.append(lines)
+        for reason, count in file_removed.items():
+            removed[reason] += count
+
+    files_lines, removed["duplicate_runs"] = _drop_duplicate_runs(files_lines, duplicate_run)
+    files_lines, truncated = _apply_budget(files_lines, token_budget)
+
+    compacted = "\n\n".join("\n".join(lines) for lines in files_lines if lines)
+    stats = {
+        "tokens_before": estimate_tokens(original),
+        "tokens_after": estimate_tokens(compacted),
+        "chars_before": len(original),
+        "chars_after": len(compacted),
+        "lines_removed": removed,
+        "truncated": truncated
+    }
+    return compacted, stats
@@ -0,0 +1,404 @@
+"""
+Process pool for the CPU-bound image stages: PDF rasterization and page
+encoding, photo decode/card detection/preprocessing, and PNG encoding of PIL
+pages for Vision.
+
+These stages hold the GIL, so a thread per page only gets one page encoded
+at a time per process. The pool runs them in CPU_POOL_WORKERS processes,
+sized from the cores this process may use (affinity and cgroup quota)
+divided by the uvicorn workers sharing them (WEB_CONCURRENCY).
+Workers are started and warmed (fitz, PIL, OpenCV imported, one page
+rendered) at startup, so the first request does not pay for it.
+
+Inputs are not pickled: spooled uploads are opened by path, in-memory
+uploads and raw pixel buffers are handed over in a shared memory block.
+Only the encoded pages come back.
+
+Deployment:
+    - One container, several uvicorn workers (event loops, for concurrent
+      requests and I/O): WEB_CONCURRENCY=N (see the Dockerfile CMD). Each
+      worker gets its own pool of cores / N processes.
+    - The pool alone already spreads page encoding over every core, so
+      WEB_CONCURRENCY=1 is enough unless the event loop itself is the limit.
+    - CPU_POOL_WORKERS=k forces the pool size, CPU_POOL_ENABLED=false runs
+      the stages in threads of the request process (as before).
+    - python benchmarks/bench_cpu_pool.py measures pages/sec per pool size.
+"""
+from concurrent.futures import Future, ProcessPoolExecutor
+from multiprocessing import get_context
+from multiprocessing.shared_memory import SharedMemory
+from collections import OrderedDict, deque
+from typing import Optional, List, Dict, Any, Union, Iterator, Tuple
+import asyncio
+import math
+import os
+import threading
+import time
+
+from metrics import span, span_seconds
+
+CPU_POOL_ENABLED = os.getenv("CPU_POOL_ENABLED", "true").lower() == "true"
+# Pages rendered ahead of the OCR consumer, per pool worker
+CPU_POOL_PREFETCH = int(os.getenv("CPU_POOL_PREFETCH", "2"))
+# Inputs smaller than this are pickled, the shared memory setup is not worth it
+CPU_POOL_SHM_MIN_BYTES = int(os.getenv("CPU_POOL_SHM_MIN_BYTES", str(64 * 1024)))
+
+
+def available_cores() -> int:
+    """Cores this process may run on: CPU affinity, capped by the cgroup v2 CPU quota"""
+    if hasattr(os, "sched_getaffinity"):
+        cores = len(os.sched_getaffinity(0))
+    else:
+        cores = os.cpu_count() or 1
+    try:
+        with open("/sys/fs/cgroup/cpu.max") as f:
+            quota, period = f.read().split()[:2]
+        if quota != "max":
+            cores = min(cores, max(1, math.ceil(int(quota) / int(period))))
+    except (OSError, ValueError):
+        pass
+    return max(1, cores)
+
+
+def default_workers() -> int:
+    """Cores shared out between the uvicorn workers of the container"""
+    web_concurrency = max(1, int(os.getenv("WEB_CONCURRENCY", "1")))
+    return max(1, available_cores() // web_concurrency)
+
+
+CPU_POOL_WORKERS = int(os.getenv("CPU_POOL_WORKERS", "0")) or default_workers()
+
+
+# ---------------------------------------------------------------------------
+# Shared memory hand-over
+# ---------------------------------------------------------------------------
+
+class SharedBuffer:
+    """
+    A copy of some bytes in a shared memory block, for the pool workers.
+    The creator closes it once the tasks reading it are done.
+    """
+
+    def __init__(self, data):
+        view = memoryview(data).cast("B")
+        self.size = view.nbytes
+        self.shm = SharedMemory(create=True, size=max(1, self.size))
+        self.shm.buf[:self.size] = view
+
+    @property
+    def handle(self) -> Tuple[str, str, int]:
+        return ("shm", self.shm.name, self.size)
+
+    def close(self):
+        self.shm.close()
+        try:
+            self.shm.unlink()
+        except FileNotFoundError:
+            pass
+
+
+def _is_shared(source) -> bool:
+    return isinstance(source, tuple) and len(source) == 3 and source[0] == "shm"
+
+
+def _read_shared(handle) -> bytes:
+    """Copy a shared block out in a worker (the creator may release it right after)"""
+    _, name, size = handle
+    shm = SharedMemory(name=name)
+    try:
+        return bytes(shm.buf[:size])
+    finally:
+        shm.close()
+
+
+def _resolve(source) -> Union[bytes, str]:
+    """A task input as helper_functions/preprocessing take it: a path or bytes"""
+    if _is_shared(source):
+        return _read_shared(source)
+    return source
+
+
+# ---------------------------------------------------------------------------
+# Worker side
+# ---------------------------------------------------------------------------
+
+# Open PDFs of the worker, so a document is not reopened for every page.
+# The worker rendering the last page closes it, the others when it is evicted.
+_open_pdfs = OrderedDict()
+_OPEN_PDFS_MAX = 4
+
+
+def _init_worker():
+    # Import the heavy modules once per worker, not on the first task
+    import fitz  # noqa: F401
+    import cv2  # noqa: F401
+    import numpy  # noqa: F401
+    from PIL import Image  # noqa: F401
+    import preprocessing  # noqa: F401
+
+
+def _warm_worker() -> int:
+    """Render and encode a small page, so codecs and caches are loaded"""
+    import fitz
+    from preprocessing import pixmap_encoder
+
+    with fitz.open() as document:
+        page = document.new_page(width=200, height=100)
+        page.insert_text((20, 50), "warm up")
+        pixmap_encoder()(page.get_pixmap())
+    return os.getpid()
+
+
+def _worker_pdf(source):
+    from helper_functions import open_pdf
+
+    key = source[1] if _is_shared(source) else source
+    document = _open_pdfs.get(key)
+    if document is None:
+        document = open_pdf(_resolve(source))
+        _open_pdfs[key] = document
+        while len(_open_pdfs) > _OPEN_PDFS_MAX:
+            _open_pdfs.popitem(last=False)[1].close()
+    else:
+        _open_pdfs.move_to_end(key)
+    return document
+
+
+def _release_pdf(source):
+    key = source[1] if _is_shared(source) else source
+    document = _open_pdfs.pop(key, None)
+    if document is not None:
+        document.close()
+
+
+def render_pdf_page(source, page_index: int, scale: float, preprocess: bool, last: bool = False) -> Tuple[bytes, Optional[Dict[str, Any]], float]:
+    """
+    Rasterize and encode one PDF page. Returns (page bytes, page stats when
+    preprocessed, seconds spent), the time is recorded by the parent process.
+    """
+    import fitz
+    from preprocessing import pixmap_encoder
+
+    started = time.perf_counter()
+    try:
+        pix = _worker_pdf(source)[page_index].get_pixmap(matrix=fitz.Matrix(scale, scale))
+        if not preprocess:
+            return pix.tobytes("png"), None, time.perf_counter() - started
+        page_stats = []
+        page_bytes = pixmap_encoder(page_stats=page_stats)(pix)
+        return page_bytes, page_stats[0], time.perf_counter() - started
+    finally:
+        if last:
+            _release_pdf(source)
+
+
+def prepare_image_task(source, detect_cards: bool, preprocess: bool) -> Tuple[List[bytes], List[Dict[str, Any]]]:
+    from preprocessing import prepare_image
+
+    return prepare_image(_resolve(source), detect_cards=detect_cards, preprocess=preprocess)
+
+
+def encode_pixels_task(handle, mode: str, size: Tuple[int, int], image_format: str) -> bytes:
+    """Encode a raw pixel buffer (shared memory) the way PIL.Image.save does"""
+    from PIL import Image
+    import io
+
+    _, name, nbytes = handle
+    shm = SharedMemory(name=name)
+    try:
+        img = Image.frombuffer(mode, size, shm.buf[:nbytes], "raw", mode, 0, 1)
+        output = io.BytesIO()
+        img.save(output, format=image_format)
+        del img
+        return output.getvalue()
+    finally:
+        shm.close()
+
+
+def _encode_inline(image, image_format: str) -> bytes:
+    import io
+
+    output = io.BytesIO()
+    image.save(output, format=image_format)
+    return output.getvalue()
+
+
+# ---------------------------------------------------------------------------
+# Pool
+# ---------------------------------------------------------------------------
+
+class CpuPool:
+    """
+    Process pool for the CPU-bound image stages.
+    Until start() is called (scripts, CPU_POOL_ENABLED=false) every call runs
+    in the calling process instead, so callers do not have to care.
+    """
+
+    def __init__(self, workers: int = CPU_POOL_WORKERS, enabled: bool = CPU_POOL_ENABLED):
+        self.workers = max(1, workers)
+        self.enabled = enabled
+        self._executor = None
+        self._lock = threading.Lock()
+
+        # Counters
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.shared_bytes = 0
+        self.warm_ms = None
+        self.worker_pids = []
+
+    @property
+    def started(self) -> bool:
+        return self._executor is not None
+
+    def start(self):
+        """Start and warm every worker process (blocking, run it in a thread)"""
+        if not self.enabled or self._executor is not None:
+            return
+        started = time.perf_counter()
+        # spawn: workers must not inherit the event loop, Mongo and gRPC state of the parent
+        executor = ProcessPoolExecutor(
+            max_workers=self.workers,
+            mp_context=get_context("spawn"),
+            initializer=_init_worker
+        )
+        # One warm-up task per worker; they start together, so each lands on its own process
+        warmups = [executor.submit(_warm_worker) for _ in range(self.workers)]
+        self.worker_pids = sorted({warmup.result() for warmup in warmups})
+        self._executor = executor
+        self.warm_ms = round((time.perf_counter() - started) * 1000, 1)
+
+    def close(self):
+        executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=True, cancel_futures=True)
+
+    def _done(self, future: Future):
+        with self._lock:
+            if future.cancelled() or future.exception() is not None:
+                self.failed += 1
+            else:
+                self.completed += 1
+
+    def submit(self, func, *args) -> Future:
+        """Run func(*args) in a worker process (in this thread when the pool is not started)"""
+        if self._executor is None:
+            future = Future()
+            try:
+                future.set_result(func(*args))
+            except BaseException as e:
+                future.set_exception(e)
+            return future
+        with self._lock:
+            self.submitted += 1
+        future = self._executor.submit(func, *args)
+        future.add_done_callback(self._done)
+        return future
+
+    async def run(self, func, *args):
+        """Await func(*args) from the event loop, in a worker process or else a thread"""
+        if self._executor is None:
+            return await asyncio.to_thread(func, *args)
+        return await asyncio.wrap_future(self.submit(func, *args))
+
+    def share(self, source: Union[bytes, str]) -> Tuple[Any, Optional[SharedBuffer]]:
+        """
+        The form of an input the workers read: paths as they are, larger bytes
+        through shared memory. Returns (task input, SharedBuffer to close or None).
+        """
+        if self._executor is None or isinstance(source, str) or len(source) < CPU_POOL_SHM_MIN_BYTES:
+            return source, None
+        shared = SharedBuffer(source)
+        with self._lock:
+            self.shared_bytes += shared.size
+        return shared.handle, shared
+
+    async def prepare_image(self, image: Union[bytes, str], detect_cards: bool, preprocess: bool) -> Tuple[List[bytes], List[Dict[str, Any]]]:
+        """preprocessing.prepare_image in a worker process"""
+        source, shared = self.share(image)
+        try:
+            return await self.run(prepare_image_task, source, detect_cards, preprocess)
+        finally:
+            if shared is not None:
+                shared.close()
+
+    def pdf_pages(
+        self,
+        pdf: Union[bytes, str],
+        page_count: int,
+        scale: float,
+        preprocess: bool,
+        page_stats: list = None
+    ) -> Iterator[bytes]:
+        """
+        Lazily rasterize and encode PDF pages, like helper_functions.iter_pdf_pages,
+        with up to CPU_POOL_PREFETCH pages per worker rendered ahead of the consumer
+        in the pool. Pages are yielded in order; per-page stats go to page_stats.
+        """
+        if self._executor is None:
+            from helper_functions import iter_pdf_pages
+            from preprocessing import pixmap_encoder
+
+            if preprocess:
+                pages = iter_pdf_pages(pdf, scale=scale, encode_page=pixmap_encoder(page_stats=page_stats))
+            else:
+                pages = iter_pdf_pages(pdf, scale=scale)
+            while True:
+                with span("page.rasterize"):
+                    page_bytes = next(pages, None)
+                if page_bytes is None:
+                    return
+                yield page_bytes
+
+        window = max(1, self.workers * CPU_POOL_PREFETCH)
+        source, shared = self.share(pdf)
+        pending = deque()
+        next_page = 0
+        try:
+            while next_page < page_count or pending:
+                while next_page < page_count and len(pending) < window:
+                    last = next_page == page_count - 1
+                    pending.append(self.submit(render_pdf_page, source, next_page, scale, preprocess, last))
+                    next_page += 1
+                page_bytes, stats, seconds = pending.popleft().result()
+                span_seconds.observe(seconds, span="page.rasterize", status="ok")
+                if page_stats is not None and stats is not None:
+                    page_stats.append(stats)
+                yield page_bytes
+        finally:
+            for future in pending:
+                future.cancel()
+            if shared is not None:
+                shared.close()
+
+    def encode_image(self, image, image_format: str = "PNG") -> bytes:
+        """Encode a PIL image in a worker, its pixels handed over in shared memory"""
+        with span("page.encode"):
+            if self._executor is None or image.mode not in ("1", "L", "RGB", "RGBA", "CMYK", "I", "F"):
+                return _encode_inline(image, image_format)
+            shared = SharedBuffer(image.tobytes())
+            try:
+                with self._lock:
+                    self.shared_bytes += shared.size
+                return self.submit(encode_pixels_task, shared.handle, image.mode, image.size, image_format).result()
+            finally:
+                shared.close()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "enabled": self.enabled,
+            "started": self.started,
+            "workers": self.workers,
+            "worker_pids": self.worker_pids,
+            "warm_ms": self.warm_ms,
+            "submitted": self.submitted,
+            "completed": self.completed,
+            "failed": self.failed,
+            "in_flight": self.submitted - self.completed - self.failed,
+            "shared_mb": round(self.shared_bytes / (1024 * 1024), 1)
+        }
+
+
+# Process-wide pool, started by the app and the standalone job workers
+cpu_pool = CpuPool()
@@ -1,12 +1,18 @@
 from motor.motor_asyncio import AsyncIOMotorClient
-from typing import Optional, List, Dict, Any
+from pymongo import ReturnDocument, IndexModel, UpdateOne, ASCENDING
+from typing import Optional, List, Dict, Any, AsyncIterator, Tuple, Union
 from bson import ObjectId
 from datetime import datetime
 
+from metrics import mongo_event_listeners
+
 
 class MongoDB:
     def __init__(self, connection_string: str, database_name: str):
-        self.client = AsyncIOMotorClient(connection_string)
+        # Command timings go to the ocr_mongo_command_seconds histogram.
+        # connect=False: nothing is opened until the first command (the
+        # resource registry pings at startup), not when the module is imported
+        self.client = AsyncIOMotorClient(connection_string, connect=False, event_listeners=mongo_event_listeners())
         self.db = self.client[database_name]
     
     def get_collection(self, collection_name: str):
@@ -17,8 +23,17 @@ class MongoDB:
 
 
 class CRUDOperations:
-    def __init__(self, mongodb: MongoDB, collection_name: str):
+    def __init__(self, mongodb: MongoDB, collection_name: str, indexes: Optional[List[IndexModel]] = None):
         self.collection = mongodb.get_collection(collection_name)
+        # Created by ensure_indexes at startup
+        self.indexes = indexes or []
+    
+    # INDEXES - Create the declared indexes (no-op for existing ones)
+    async def ensure_indexes(self) -> List[str]:
+        """Create the indexes declared for this collection and return their names"""
+        if not self.indexes:
+            return []
+        return await self.collection.create_indexes(self.indexes)
     
     # CREATE
     async def create(self, data: Dict[str, Any]) -> str:
@@ -26,6 +41,14 @@ class CRUDOperations:
         result = await self.collection.insert_one(data)
         return str(result.inserted_id)
     
+    # CREATE - Insert many documents in one round trip
+    async def bulk_create(self, documents: List[Dict[str, Any]], ordered: bool = False) -> List[str]:
+        """Insert documents with insert_many and return their IDs (in input order)"""
+        if not documents:
+            return []
+        result = await self.collection.insert_many(documents, ordered=ordered)
+        return [str(inserted_id) for inserted_id in result.inserted_ids]
+    
     # READ - Get by ID
     async def get_by_id(self, doc_id: str) -> Optional[Dict[str, Any]]:
         """Get a single document by ID"""
@@ -36,7 +59,7 @@ class CRUDOperations:
     
     # READ - Get all
     async def get_all(self, skip: int = 0, limit: int = 100) -> List[Dict[str, Any]]:
-        """Get all documents with pagination"""
+        """Get all documents with pagination (prefer find_page or stream for deep or large reads)"""
         cursor = self.collection.find().skip(skip).limit(limit)
         documents = await cursor.to_list(length=limit)
         for doc in documents:
@@ -45,13 +68,58 @@ class CRUDOperations:
     
     # READ - Find by filter
     async def find(self, filter_query: Dict[str, Any], skip: int = 0, limit: int = 100) -> List[Dict[str, Any]]:
-        """Find documents matching a filter"""
+        """Find documents matching a filter (prefer find_page or stream for deep or large reads)"""
         cursor = self.collection.find(filter_query).skip(skip).limit(limit)
         documents = await cursor.to_list(length=limit)
         for doc in documents:
             doc["_id"] = str(doc["_id"])
         return documents
     
+    # READ - Stream documents matching a filter
+    async def stream(
+        self,
+        filter_query: Dict[str, Any] = None,
+        projection: Dict[str, Any] = None,
+        sort: Optional[List] = None,
+        batch_size: int = 100,
+        limit: int = 0
+    ) -> AsyncIterator[Dict[str, Any]]:
+        """
+        Iterate over the documents matching a filter, fetched from the server
+        batch_size at a time instead of loaded into one list
+        """
+        cursor = self.collection.find(filter_query or {}, projection, batch_size=batch_size, limit=limit)
+        if sort:
+            cursor = cursor.sort(sort)
+        async for document in cursor:
+            if "_id" in document:
+                document["_id"] = str(document["_id"])
+            yield document
+    
+    # READ - Keyset pagination
+    async def find_page(
+        self,
+        filter_query: Dict[str, Any] = None,
+        after: Optional[str] = None,
+        limit: int = 100,
+        projection: Dict[str, Any] = None
+    ) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+        """
+        One page of documents in _id order, starting after the _id returned as
+        the cursor of the previous page. Unlike skip, the cost of a page does
+        not grow with its depth. Returns the documents and the next cursor
+        (None on the last page).
+        """
+        query = dict(filter_query or {})
+        if after is not None:
+            query["_id"] = {"$gt": ObjectId(after)}
+        cursor = self.collection.find(query, projection).sort("_id", ASCENDING).limit(limit)
+        documents = await cursor.to_list(length=limit)
+        for doc in documents:
+            doc["_id"] = str(doc["_id"])
+        next_cursor = documents[-1]["_id"] if len(documents) == limit else None
+        return documents, next_cursor
+    
     # READ - Find one by filter
     async def find_one(self, filter_query: Dict[str, Any]) -> Optional[Dict[str, Any]]:
         """Find a single document matching a filter"""
@@ -80,6 +148,66 @@ class CRUDOperations:
         )
         return result.modified_count
     
+    # UPDATE - Atomically update one document by filter and return it
+    async def find_one_and_update(
+        self,
+        filter_query: Dict[str, Any],
+        update: Dict[str, Any],
+        sort: Optional[List] = None,
+        upsert: bool = False
+    ) -> Optional[Dict[str, Any]]:
+        """
+        Apply a raw update to the first document matching a filter and return the
+        updated document (inserting it first when upsert is set and none matches)
+        """
+        document = await self.collection.find_one_and_update(
+            filter_query,
+            update,
+            sort=sort,
+            upsert=upsert,
+            return_document=ReturnDocument.AFTER
+        )
+        if document:
+            document["_id"] = str(document["_id"])
+        return document
+    
+    # UPSERT - Update or insert by filter
+    async def upsert(self, filter_query: Dict[str, Any], data: Dict[str, Any]) -> bool:
+        """Update the document matching a filter, or insert it if there is none. Returns True if inserted"""
+        data["updated_at"] = datetime.utcnow().isoformat()
+        result = await self.collection.update_one(
+            filter_query,
+            {"$set": data},
+            upsert=True
+        )
+        return result.upserted_id is not None
+    
+    # UPSERT - Update or insert many documents in one round trip
+    async def bulk_upsert(
+        self,
+        documents: List[Dict[str, Any]],
+        keys: Union[str, List[str]],
+        ordered: bool = False
+    ) -> Dict[str, int]:
+        """
+        Upsert documents with one bulk_write, each matched on its values of the
+        key fields (e.g. "request_id"). Returns the inserted and updated counts.
+        """
+        if not documents:
+            return {"inserted": 0, "updated": 0}
+        keys = [keys] if isinstance(keys, str) else keys
+        now = datetime.utcnow().isoformat()
+        operations = [
+            UpdateOne(
+                {key: document.get(key) for key in keys},
+                {"$set": {**document, "updated_at": now}},
+                upsert=True
+            )
+            for document in documents
+        ]
+        result = await self.collection.bulk_write(operations, ordered=ordered)
+        return {"inserted": result.upserted_count, "updated": result.modified_count}
+    
     # DELETE
     async def delete(self, doc_id: str) -> bool:
         """Delete a document by ID"""
@@ -1,29 +1,92 @@
-
-from typing import Optional, List, Union, Dict
+from typing import Optional, List, Union, Dict, Iterator, Callable
 import fitz
 from PIL import Image
 import io
 
+# Render scale used for rasterizing PDF pages (2x = 144 DPI)
+PDF_RENDER_SCALE = 2
+
+
+def open_pdf(pdf: Union[bytes, str]) -> fitz.Document:
+    """
+    Helper function: Open a PDF from a file path (read by PyMuPDF as needed,
+    no copy in Python) or from bytes
+    """
+    if isinstance(pdf, str):
+        return fitz.open(pdf, filetype="pdf")
+    return fitz.open(stream=pdf, filetype="pdf")
+
+
+def iter_pdf_pages(
+    pdf_bytes: Union[bytes, str],
+    scale: float = PDF_RENDER_SCALE,
+    image_format: str = "png",
+    encode_page: Callable = None
+) -> Iterator[bytes]:
+    """
+    Helper function: Lazily rasterize PDF pages, yielding one upload-ready
+    encoded page at a time. Each page is encoded once, straight from the
+    fitz pixmap (or by encode_page(pixmap) when given), so only the current
+    page is held in memory.
+    Raises on a broken PDF instead of returning partial results.
+    """
+    with open_pdf(pdf_bytes) as pdf_document:
+        mat = fitz.Matrix(scale, scale)
+        for page in pdf_document:
+            pix = page.get_pixmap(matrix=mat)
+            page_bytes = encode_page(pix) if encode_page else pix.tobytes(image_format)
+            pix = None
+            yield page_bytes
+
+
 def pdf_to_images(pdf_bytes: bytes) -> List[Image.Image]:
     """
     Helper function: Convert PDF bytes to list of PIL Images
+    (kept for scripts, the OCR pipeline streams pages with iter_pdf_pages)
     """
-    images = []
-    try:
-        pdf_document = fitz.open(stream=pdf_bytes, filetype="pdf")
-        
-        for page_number in range(len(pdf_document)):
-            page = pdf_document[page_number]
-            
-            mat = fitz.Matrix(2, 2)
-            pix = page.get_pixmap(matrix=mat)
-            
-            img_bytes = pix.tobytes("png")
-            img = Image.open(io.BytesIO(img_bytes))
-            images.append(img)
-        
-        pdf_document.close()
-        return images
-        
-    except Exception as e:
-        print(f"Error converting PDF to images: {e}")
+    return [Image.open(io.BytesIO(page_bytes)) for page_bytes in iter_pdf_pages(pdf_bytes)]
+
+
+def get_pdf_page_count(pdf_bytes: Union[bytes, str]) -> int:
+    """
+    Helper function: Number of pages in a PDF (without rendering it)
+    """
+    with open_pdf(pdf_bytes) as pdf_document:
+        return len(pdf_document)
+
+
+# Image formats Vision accepts as-is (PIL format names)
+VISION_IMAGE_FORMATS = {"JPEG", "PNG", "GIF", "BMP", "WEBP", "ICO", "TIFF"}
+
+
+def open_image(image: Union[bytes, str]) -> Image.Image:
+    """
+    Helper function: Open an image from a file path or from bytes
+    (PIL only reads the header until the pixels are needed)
+    """
+    return Image.open(image if isinstance(image, str) else io.BytesIO(image))
+
+
+def read_image_bytes(image: Union[bytes, str]) -> bytes:
+    """
+    Helper function: The encoded bytes of an image given as a file path or bytes
+    """
+    if isinstance(image, str):
+        with open(image, "rb") as f:
+            return f.read()
+    return image
+
+
+def image_upload_bytes(image_bytes: Union[bytes, str]) -> bytes:
+    """
+    Helper function: Upload-ready bytes for an uploaded image (bytes or file path).
+    Formats Vision understands are passed through untouched (no decode or
+    re-encode), anything else is decoded and encoded once to PNG.
+    Raises if the bytes are not an image.
+    """
+    with open_image(image_bytes) as img:
+        if img.format in VISION_IMAGE_FORMATS:
+            return read_image_bytes(image_bytes)
+        output = io.BytesIO()
+        img.save(output, format="PNG")
+        return output.getvalue()
@@ -0,0 +1,165 @@
+from typing import Optional, Dict, Any
+from urllib.parse import urlsplit
+import asyncio
+import os
+import threading
+import time
+
+import httpx
+
+from metrics import span
+
+HTTP_CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", "5"))
+HTTP_READ_TIMEOUT = float(os.getenv("HTTP_READ_TIMEOUT", "20"))
+HTTP_WRITE_TIMEOUT = float(os.getenv("HTTP_WRITE_TIMEOUT", "20"))
+# Max time a request waits for a free connection from its host's pool
+HTTP_POOL_TIMEOUT = float(os.getenv("HTTP_POOL_TIMEOUT", "10"))
+# Connection pool per host
+HTTP_MAX_CONNECTIONS_PER_HOST = int(os.getenv("HTTP_MAX_CONNECTIONS_PER_HOST", "20"))
+HTTP_MAX_KEEPALIVE_PER_HOST = int(os.getenv("HTTP_MAX_KEEPALIVE_PER_HOST", "10"))
+HTTP_KEEPALIVE_EXPIRY = float(os.getenv("HTTP_KEEPALIVE_EXPIRY", "30"))
+
+
+def _host(url: str) -> str:
+    parts = urlsplit(url)
+    return f"{parts.scheme}://{parts.netloc}"
+
+
+class HttpClientPool:
+    """
+    Shared async HTTP clients for outbound calls (Graph API, backend).
+    Each host gets its own httpx.AsyncClient with a keep-alive connection pool,
+    so a slow host cannot use up the connections of another one.
+    Clients are created at startup (or on first use) and reused for every request.
+    """
+
+    def __init__(
+        self,
+        max_connections_per_host: int = HTTP_MAX_CONNECTIONS_PER_HOST,
+        max_keepalive_per_host: int = HTTP_MAX_KEEPALIVE_PER_HOST,
+        keepalive_expiry: float = HTTP_KEEPALIVE_EXPIRY
+    ):
+        self.max_connections_per_host = max_connections_per_host
+        self.max_keepalive_per_host = max_keepalive_per_host
+        self.keepalive_expiry = keepalive_expiry
+        self.timeout = httpx.Timeout(
+            connect=HTTP_CONNECT_TIMEOUT,
+            read=HTTP_READ_TIMEOUT,
+            write=HTTP_WRITE_TIMEOUT,
+            pool=HTTP_POOL_TIMEOUT
+        )
+        self._clients = {}
+        self._host_stats = {}
+        self._lock = threading.Lock()
+
+    def _new_host_stats(self) -> Dict[str, Any]:
+        return {
+            "requests": 0,
+            "errors": 0,
+            "timeouts": 0,
+            "in_flight": 0,
+            "max_in_flight": 0,
+            "total_latency_ms": 0.0
+        }
+
+    def client(self, url: str) -> httpx.AsyncClient:
+        """The pooled client for the host of a URL"""
+        host = _host(url)
+        with self._lock:
+            client = self._clients.get(host)
+            if client is None or client.is_closed:
+                client = httpx.AsyncClient(
+                    base_url=host,
+                    timeout=self.timeout,
+                    limits=httpx.Limits(
+                        max_connections=self.max_connections_per_host,
+                        max_keepalive_connections=self.max_keepalive_per_host,
+                        keepalive_expiry=self.keepalive_expiry
+                    )
+                )
+                self._clients[host] = client
+                self._host_stats.setdefault(host, self._new_host_stats())
+        return client
+
+    def start(self, *urls: Optional[str]):
+        """Create the clients for the hosts that will be called"""
+        for url in urls:
+            if url:
+                self.client(url)
+
+    async def request(self, method: str, url: str, **kwargs) -> httpx.Response:
+        client = self.client(url)
+        stats = self._host_stats[_host(url)]
+        with self._lock:
+            stats["requests"] += 1
+            stats["in_flight"] += 1
+            stats["max_in_flight"] = max(stats["max_in_flight"], stats["in_flight"])
+        started = time.perf_counter()
+        try:
+            with span(f"http.{urlsplit(url).netloc}", method=method):
+                return await client.request(method, url, **kwargs)
+        except httpx.TimeoutException:
+            with self._lock:
+                stats["timeouts"] += 1
+                stats["errors"] += 1
+            raise
+        except Exception:
+            with self._lock:
+                stats["errors"] += 1
+            raise
+        finally:
+            with self._lock:
+                stats["in_flight"] -= 1
+                stats["total_latency_ms"] += (time.perf_counter() - started) * 1000
+
+    async def post(self, url: str, **kwargs) -> httpx.Response:
+        return await self.request("POST", url, **kwargs)
+
+    async def get(self, url: str, **kwargs) -> httpx.Response:
+        return await self.request("GET", url, **kwargs)
+
+    async def close(self):
+        with self._lock:
+            clients = list(self._clients.values())
+            self._clients = {}
+        for client in clients:
+            await client.aclose()
+
+    def stats(self) -> Dict[str, Any]:
+        hosts = {}
+        with self._lock:
+            for host, stats in self._host_stats.items():
+                hosts[host] = {
+                    "requests": stats["requests"],
+                    "errors": stats["errors"],
+                    "timeouts": stats["timeouts"],
+                    "in_flight": stats["in_flight"],
+                    "max_in_flight": stats["max_in_flight"],
+                    "pool_utilisation": round(stats["in_flight"] / self.max_connections_per_host, 3),
+                    "peak_pool_utilisation": round(stats["max_in_flight"] / self.max_connections_per_host, 3),
+                    "avg_latency_ms": round(stats["total_latency_ms"] / stats["requests"], 1) if stats["requests"] else 0.0
+                }
+        return {
+            "max_connections_per_host": self.max_connections_per_host,
+            "connect_timeout": HTTP_CONNECT_TIMEOUT,
+            "read_timeout": HTTP_READ_TIMEOUT,
+            "hosts": hosts
+        }
+
+
+# Process-wide HTTP clients (opened at app startup)
+http_client = HttpClientPool()
+
+
+def run_sync(func, *args, **kwargs):
+    """
+    Run one of the async HTTP helpers from synchronous code (scripts, shells),
+    e.g. run_sync(send_text_message, phone_number, "Hello").
+    Not for use inside the app's event loop: the clients are closed afterwards.
+    """
+    async def runner():
+        try:
+            return await func(*args, **kwargs)
+        finally:
+            await http_client.close()
+    return asyncio.run(runner())
@@ -0,0 +1,202 @@
+"""
+Idempotent /ocr-processing by request_id.
+
+A duplicate of a request that is still running (client retry, double tap)
+waits for the running execution and gets its response instead of running the
+pipeline again: inside the process through a shared future, across uvicorn
+workers and hosts through a record in the `idempotency` collection, unique on
+request_id. Completed responses are stored there and replayed for
+IDEMPOTENCY_TTL_SECONDS. Failed executions are not stored, so a retry runs again.
+
+Each execution has an id, kept when an abandoned execution is taken over,
+that execute() reads from current_execution (e.g. to queue notifications
+once per execution).
+"""
+from fastapi import HTTPException
+from pymongo.errors import DuplicateKeyError
+from typing import Optional, Dict, Any, Callable, Awaitable, Tuple
+from contextvars import ContextVar
+from datetime import datetime, timedelta
+import asyncio
+import os
+import socket
+import uuid
+
+from database import CRUDOperations
+
+IDEMPOTENCY_ENABLED = os.getenv("IDEMPOTENCY_ENABLED", "true").lower() == "true"
+# How long a completed response is replayed
+IDEMPOTENCY_TTL_SECONDS = int(os.getenv("IDEMPOTENCY_TTL_SECONDS", str(24 * 3600)))
+# A running execution whose lease is not renewed within this time (its worker
+# died) is taken over by the next duplicate
+IDEMPOTENCY_LEASE_SECONDS = int(os.getenv("IDEMPOTENCY_LEASE_SECONDS", "60"))
+# Duplicates poll for the result of an execution running in another worker
+IDEMPOTENCY_POLL_INTERVAL = float(os.getenv("IDEMPOTENCY_POLL_INTERVAL", "0.5"))
+IDEMPOTENCY_WAIT_SECONDS = float(os.getenv("IDEMPOTENCY_WAIT_SECONDS", "300"))
+
+# Id of the execution running in this context (None outside of IdempotencyStore.run)
+current_execution = ContextVar("idempotency_execution", default=None)
+
+
+class IdempotencyStore:
+    """Single-flight execution and response replay keyed on request_id"""
+
+    def __init__(self, crud: CRUDOperations):
+        self.crud = crud
+        self.owner = f"{socket.gethostname()}-{os.getpid()}"
+        # request_id -> (fingerprint, future of the response) of executions running in this process
+        self._in_flight = {}
+        self.executed = 0
+        self.coalesced = 0
+        self.replayed = 0
+        self.conflicts = 0
+
+    async def ensure_indexes(self):
+        await self.crud.collection.create_index("request_id", unique=True)
+        # Completed records expire after the TTL, abandoned ones after their lease
+        await self.crud.collection.create_index("expires_at", expireAfterSeconds=0)
+
+    async def run(
+        self,
+        request_id: str,
+        fingerprint: str,
+        execute: Callable[[], Awaitable[Dict[str, Any]]]
+    ) -> Tuple[Dict[str, Any], str]:
+        """
+        Run execute once per request_id and return its response with how it was
+        served: executed, coalesced (joined a running execution) or replayed
+        (stored response). A request_id reused with other uploads (fingerprint)
+        is rejected with 409.
+        """
+        in_flight = self._in_flight.get(request_id)
+        if in_flight is not None:
+            self._check_fingerprint(request_id, fingerprint, in_flight[0])
+            self.coalesced += 1
+            return await asyncio.shield(in_flight[1]), "coalesced"
+
+        future = asyncio.get_running_loop().create_future()
+        self._in_flight[request_id] = (fingerprint, future)
+        try:
+            response, outcome = await self._run_once(request_id, fingerprint, execute)
+            future.set_result(response)
+            return response, outcome
+        except BaseException as e:
+            future.set_exception(e)
+            # Nobody may be waiting on the future, keep asyncio from warning about it
+            future.exception()
+            raise
+        finally:
+            del self._in_flight[request_id]
+
+    def _check_fingerprint(self, request_id: str, fingerprint: str, existing: Optional[str]):
+        if existing and existing != fingerprint:
+            self.conflicts += 1
+            raise HTTPException(
+                status_code=409,
+                detail=f"request_id {request_id} was already used with different files"
+            )
+
+    async def _run_once(self, request_id: str, fingerprint: str, execute) -> Tuple[Dict[str, Any], str]:
+        waited = 0.0
+        while True:
+            execution_id, record = await self._claim(request_id, fingerprint)
+            if execution_id is not None:
+                break
+            self._check_fingerprint(request_id, fingerprint, record.get("fingerprint"))
+            if record["status"] == "completed":
+                if waited:
+                    self.coalesced += 1
+                    return record["response"], "coalesced"
+                self.replayed += 1
+                return record["response"], "replayed"
+            # Running in another worker: wait for its response (or its lease to expire)
+            if waited >= IDEMPOTENCY_WAIT_SECONDS:
+                raise HTTPException(status_code=409, detail=f"request_id {request_id} is already being processed")
+            await asyncio.sleep(IDEMPOTENCY_POLL_INTERVAL)
+            waited += IDEMPOTENCY_POLL_INTERVAL
+
+        lease_task = asyncio.create_task(self._keep_lease(request_id))
+        execution = current_execution.set(execution_id)
+        try:
+            response = await execute()
+        except BaseException:
+            lease_task.cancel()
+            await self.crud.delete_many({"request_id": request_id, "owner": self.owner, "status": "processing"})
+            raise
+        finally:
+            current_execution.reset(execution)
+        lease_task.cancel()
+        self.executed += 1
+        try:
+            await self.crud.update_many(
+                {"request_id": request_id, "owner": self.owner},
+                {
+                    "status": "completed",
+                    "response": response,
+                    "expires_at": datetime.utcnow() + timedelta(seconds=IDEMPOTENCY_TTL_SECONDS)
+                }
+            )
+        except Exception as e:
+            # The response was produced, only its replay is lost
+            print(f"Error storing idempotent response of request {request_id}: {e}")
+        return response, "executed"
+
+    async def _claim(self, request_id: str, fingerprint: str) -> Tuple[Optional[str], Optional[Dict[str, Any]]]:
+        """(execution id, None) when this process now owns the execution, otherwise (None, the existing record)"""
+        now = datetime.utcnow()
+        lease = {
+            "fingerprint": fingerprint,
+            "status": "processing",
+            "owner": self.owner,
+            "expires_at": now + timedelta(seconds=IDEMPOTENCY_LEASE_SECONDS),
+            "created_at": now
+        }
+        execution_id = uuid.uuid4().hex
+        try:
+            await self.crud.create({"request_id": request_id, "execution_id": execution_id, **lease})
+            return execution_id, None
+        except DuplicateKeyError:
+            pass
+
+        # Take over an abandoned execution, as the same execution (its worker
+        # may have done part of it)
+        taken = await self.crud.find_one_and_update(
+            {"request_id": request_id, "status": "processing", "expires_at": {"$lt": now}},
+            {"$set": {**lease, "updated_at": now}}
+        )
+        if taken is not None:
+            return taken.get("execution_id") or taken["_id"], None
+
+        # or a completed one past its TTL that the TTL monitor has not removed yet
+        taken = await self.crud.find_one_and_update(
+            {"request_id": request_id, "status": "completed", "expires_at": {"$lt": now}},
+            {"$set": {**lease, "execution_id": execution_id, "updated_at": now}, "$unset": {"response": ""}}
+        )
+        if taken is not None:
+            return execution_id, None
+
+        record = await self.crud.find_one({"request_id": request_id})
+        if record is None:
+            # Deleted after a failed execution, try again
+            return await self._claim(request_id, fingerprint)
+        return None, record
+
+    async def _keep_lease(self, request_id: str):
+        while True:
+            await asyncio.sleep(IDEMPOTENCY_LEASE_SECONDS / 3)
+            try:
+                await self.crud.update_many(
+                    {"request_id": request_id, "owner": self.owner, "status": "processing"},
+                    {"expires_at": datetime.utcnow() + timedelta(seconds=IDEMPOTENCY_LEASE_SECONDS)}
+                )
+            except Exception as e:
+                print(f"Error renewing idempotency lease of request {request_id}: {e}")
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "in_flight": len(self._in_flight),
+            "executed": self.executed,
+            "coalesced": self.coalesced,
+            "replayed": self.replayed,
+            "conflicts": self.conflicts
+        }
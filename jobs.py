@@ -0,0 +1,363 @@
+"""
+Asynchronous job mode for /ocr-processing.
+
+Submitted uploads are written to JOB_STORAGE_DIR and a job document is queued
+in the `requests` collection. Workers lease jobs from there with an atomic
+find_one_and_update, keep the lease alive while the pipeline runs, and store
+the result (or error) on the job document.
+
+The caller's bearer token is stored with the job only because the pipeline
+forwards it to the backend (renewal validation): it is removed from the job
+document as soon as the job completes or fails for good. The hashed caller
+key (admission fairness) stays.
+
+Workers run inside the API process (JOB_WORKERS, started at app startup) or
+as separate processes:
+
+    python jobs.py --workers 4
+"""
+from fastapi import HTTPException
+from typing import Optional, List, Dict, Any
+from datetime import datetime, timedelta
+import argparse
+import asyncio
+import os
+import shutil
+import socket
+import traceback
+import uuid
+
+from database import CRUDOperations
+from uploads import save_document, document_size
+from admission import page_admission, caller_key, count_pages, current_caller
+
+JOB_STORAGE_DIR = os.getenv("JOB_STORAGE_DIR", "shared/jobs")
+# Number of in-process workers started with the API (0 = only separate worker processes)
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "2"))
+# A job whose lease is not renewed within this time is picked up by another worker
+JOB_LEASE_SECONDS = int(os.getenv("JOB_LEASE_SECONDS", "120"))
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "3"))
+# Idle workers poll the queue this often
+JOB_POLL_INTERVAL = float(os.getenv("JOB_POLL_INTERVAL", "1.0"))
+
+
+class JobQueue:
+    """MongoDB-backed job queue stored in the requests collection"""
+
+    def __init__(self, crud: CRUDOperations, storage_dir: str = JOB_STORAGE_DIR):
+        self.crud = crud
+        self.storage_dir = storage_dir
+
+    async def ensure_indexes(self):
+        await self.crud.collection.create_index("job_id", unique=True, sparse=True)
+        await self.crud.collection.create_index([("status", 1), ("created_at", 1)])
+        # Jobs finished before the bearer token was removed on finish
+        await self.crud.collection.update_many(
+            {"job_id": {"$exists": True}, "status": {"$in": ["completed", "failed"]}, "authorization": {"$exists": True}},
+            {"$unset": {"authorization": ""}}
+        )
+
+    def _save_files(self, job_id: str, documents: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        job_dir = os.path.join(self.storage_dir, job_id)
+        os.makedirs(job_dir, exist_ok=True)
+        files = []
+        for idx, document in enumerate(documents):
+            # Never trust the uploaded name as a path
+            safe_name = os.path.basename(document["file_name"] or "upload") or "upload"
+            path = os.path.join(job_dir, f"{idx:03d}_{safe_name}")
+            save_document(document, path)
+            files.append({
+                "file_name": document["file_name"],
+                "mime_type": document["mime_type"],
+                "file_size": document_size(document),
+                "path": path
+            })
+        return files
+
+    async def submit(
+        self,
+        request_id: str,
+        client_name: str,
+        phone_number: str,
+        documents: List[Dict[str, Any]],
+        authorization: Optional[str] = None
+    ) -> str:
+        """Persist the uploads and queue a job. Returns the job id."""
+        job_id = uuid.uuid4().hex
+        files = await asyncio.to_thread(self._save_files, job_id, documents)
+        now = datetime.utcnow()
+        await self.crud.create({
+            "job_id": job_id,
+            "request_id": request_id,
+            "client_name": client_name,
+            "phone_number": phone_number,
+            # Removed when the job finishes, see finish()
+            "authorization": authorization,
+            "caller": caller_key(authorization),
+            "files": files,
+            "status": "queued",
+            "attempts": 0,
+            "lease_owner": None,
+            "lease_expires_at": None,
+            "created_at": now,
+            "updated_at": now
+        })
+        return job_id
+
+    async def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        return await self.crud.find_one({"job_id": job_id})
+
+    async def claim(self, worker_id: str) -> Optional[Dict[str, Any]]:
+        """Lease the oldest queued job, or one whose lease expired"""
+        now = datetime.utcnow()
+
+        # Jobs that keep losing their lease are given up on, and their uploads removed
+        abandoned = {
+            "job_id": {"$exists": True},
+            "status": "processing",
+            "lease_expires_at": {"$lt": now},
+            "attempts": {"$gte": JOB_MAX_ATTEMPTS}
+        }
+        for job in await self.crud.collection.find(abandoned, {"job_id": 1}).to_list(length=None):
+            result = await self.crud.collection.update_one(
+                {**abandoned, "job_id": job["job_id"]},
+                {
+                    "$set": {
+                        "status": "failed",
+                        "error": "Job lease expired too many times",
+                        "files": [],
+                        "completed_at": now,
+                        "updated_at": now
+                    },
+                    "$unset": {"authorization": ""}
+                }
+            )
+            if result.modified_count:
+                await asyncio.to_thread(shutil.rmtree, os.path.join(self.storage_dir, job["job_id"]), True)
+
+        return await self.crud.find_one_and_update(
+            {
+                "job_id": {"$exists": True},
+                "attempts": {"$lt": JOB_MAX_ATTEMPTS},
+                "$or": [
+                    {"status": "queued"},
+                    {"status": "processing", "lease_expires_at": {"$lt": now}}
+                ]
+            },
+            {
+                "$set": {
+                    "status": "processing",
+                    "lease_owner": worker_id,
+                    "lease_expires_at": now + timedelta(seconds=JOB_LEASE_SECONDS),
+                    "updated_at": now
+                },
+                "$inc": {"attempts": 1}
+            },
+            sort=[("created_at", 1)]
+        )
+
+    async def renew_lease(self, job_id: str, worker_id: str) -> bool:
+        now = datetime.utcnow()
+        result = await self.crud.collection.update_one(
+            {"job_id": job_id, "lease_owner": worker_id, "status": "processing"},
+            {"$set": {"lease_expires_at": now + timedelta(seconds=JOB_LEASE_SECONDS), "updated_at": now}}
+        )
+        return result.modified_count > 0
+
+    async def finish(self, job_id: str, worker_id: str, result: Dict[str, Any] = None, error: str = None, retry: bool = False) -> bool:
+        """
+        Record the outcome of a job (or put it back in the queue when retry is
+        set). Returns False when the worker had lost the lease, the outcome is
+        then dropped and the uploads are left to the worker now running the job.
+        """
+        if retry:
+            status = "queued"
+        else:
+            status = "failed" if error else "completed"
+        update = {
+            "status": status,
+            "result": result,
+            "error": error,
+            "lease_owner": None,
+            "lease_expires_at": None,
+            "updated_at": datetime.utcnow()
+        }
+        operations = {"$set": update}
+        if status != "queued":
+            update["completed_at"] = update["updated_at"]
+            # Uploads and the bearer token are only needed while the job can still run
+            update["files"] = []
+            operations["$unset"] = {"authorization": ""}
+        updated = await self.crud.collection.update_one({"job_id": job_id, "lease_owner": worker_id}, operations)
+        if not updated.modified_count:
+            return False
+        if status != "queued":
+            await asyncio.to_thread(shutil.rmtree, os.path.join(self.storage_dir, job_id), True)
+        return True
+
+
+def job_status(job: Dict[str, Any]) -> Dict[str, Any]:
+    """Public view of a job (no credentials or file paths)"""
+    status = {
+        "job_id": job["job_id"],
+        "request_id": job.get("request_id"),
+        "status": job["status"],
+        "attempts": job.get("attempts", 0),
+        "created_at": job["created_at"].isoformat() if job.get("created_at") else None,
+        "completed_at": job["completed_at"].isoformat() if job.get("completed_at") else None
+    }
+    if job["status"] == "completed":
+        status["result"] = job.get("result")
+    if job["status"] == "failed":
+        status["error"] = job.get("error")
+    return status
+
+
+def _load_documents(job: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """The stored uploads of a job, opened from their path by the pipeline"""
+    return [
+        {
+            "file_name": file["file_name"],
+            "mime_type": file["mime_type"],
+            "file_size": file["file_size"],
+            "content": None,
+            "path": file["path"]
+        }
+        for file in job["files"]
+    ]
+
+
+class JobWorkerPool:
+    """A pool of asyncio workers leasing jobs from a JobQueue and running process_documents"""
+
+    def __init__(self, queue: JobQueue, size: int = JOB_WORKERS):
+        self.queue = queue
+        self.size = size
+        self._tasks = []
+        self._stopping = asyncio.Event()
+        self.jobs_completed = 0
+        self.jobs_failed = 0
+
+    def start(self):
+        for idx in range(self.size):
+            worker_id = f"{socket.gethostname()}-{os.getpid()}-{idx}"
+            self._tasks.append(asyncio.create_task(self._worker(worker_id)))
+
+    async def join(self):
+        """Wait until every worker exits"""
+        await asyncio.gather(*self._tasks)
+
+    async def stop(self):
+        """Stop taking new jobs and wait for running ones to finish"""
+        self._stopping.set()
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def _keep_lease(self, job_id: str, worker_id: str):
+        while True:
+            await asyncio.sleep(JOB_LEASE_SECONDS / 3)
+            try:
+                await self.queue.renew_lease(job_id, worker_id)
+            except Exception as e:
+                print(f"Error renewing lease of job {job_id}: {e}")
+
+    async def _worker(self, worker_id: str):
+        while not self._stopping.is_set():
+            try:
+                job = await self.queue.claim(worker_id)
+            except Exception as e:
+                print(f"Error claiming job: {e}")
+                job = None
+
+            if job is None:
+                try:
+                    await asyncio.wait_for(self._stopping.wait(), timeout=JOB_POLL_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            try:
+                await self.run_job(job, worker_id)
+            except Exception as e:
+                # The lease expires and the job is picked up again
+                print(f"Error running job {job['job_id']}: {e}")
+
+    async def run_job(self, job: Dict[str, Any], worker_id: str):
+        from pipeline import process_documents
+
+        job_id = job["job_id"]
+        print(f"Worker {worker_id} processing job {job_id} (attempt {job['attempts']})")
+        lease_task = asyncio.create_task(self._keep_lease(job_id, worker_id))
+        try:
+            documents = _load_documents(job)
+            caller = job.get("caller") or caller_key(job.get("authorization"))
+            current_caller.set(caller)
+            # Jobs share the page budget of synchronous requests, waiting as long as it takes
+            async with page_admission.acquire(caller, await count_pages(documents), bounded=False):
+                result = await process_documents(
+                    request_id=job["request_id"],
+                    client_name=job["client_name"],
+                    phone_number=job["phone_number"],
+                    documents=documents,
+                    authorization=job.get("authorization"),
+                    # A job run again after losing its lease is the same execution
+                    execution_id=job["job_id"]
+                )
+        except HTTPException as e:
+            # Client and extraction errors will not go away on retry
+            if await self._finish(job_id, worker_id, error=str(e.detail)):
+                self.jobs_failed += 1
+        except Exception as e:
+            traceback.print_exc()
+            retry = job["attempts"] < JOB_MAX_ATTEMPTS
+            if await self._finish(job_id, worker_id, error=f"OCR processing failed: {str(e)}", retry=retry) and not retry:
+                self.jobs_failed += 1
+        else:
+            if await self._finish(job_id, worker_id, result=result):
+                self.jobs_completed += 1
+        finally:
+            lease_task.cancel()
+
+    async def _finish(self, job_id: str, worker_id: str, **outcome) -> bool:
+        """queue.finish that never raises: a job whose outcome is not recorded runs again once its lease expires"""
+        try:
+            finished = await self.queue.finish(job_id, worker_id, **outcome)
+        except Exception as e:
+            print(f"Error recording the outcome of job {job_id}: {e}")
+            return False
+        if not finished:
+            print(f"Worker {worker_id} lost the lease of job {job_id}, its outcome is dropped")
+        return finished
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "workers": self.size,
+            "jobs_completed": self.jobs_completed,
+            "jobs_failed": self.jobs_failed
+        }
+
+
+async def run_workers(size: int):
+    """Run a standalone worker process until interrupted"""
+    from resources import build_registry
+
+    resources = build_registry(["mongo", "vision", "openai", "cpu_pool", "http"])
+    await resources.start()
+    from pipeline import job_queue
+
+    pool = JobWorkerPool(job_queue, size)
+    pool.start()
+    print(f"Started {size} job workers")
+    try:
+        await pool.join()
+    finally:
+        await pool.stop()
+        await resources.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run /ocr-processing job workers")
+    parser.add_argument("--workers", type=int, default=max(JOB_WORKERS, 1))
+    args = parser.parse_args()
+    asyncio.run(run_workers(args.workers))
@@ -1,9 +1,22 @@
-from pydantic import BaseModel, Field
-from openai import OpenAI
-from typing import Optional
+from pydantic import BaseModel, Field, create_model
+from openai import (
+    AsyncOpenAI, DefaultAsyncHttpxClient, RateLimitError, InternalServerError, APITimeoutError, APIConnectionError
+)
+from typing import Optional, List, Dict, Any, Tuple
+from collections import deque
+from functools import lru_cache
+import asyncio
 import json
+import os
+import random
+import time
+import httpx
 from dotenv import load_dotenv
 
+from cache import ResultCache, content_hash
+from metrics import span, retries
+from admission import FairLimiter, current_caller
+
 load_dotenv()
 
 class QatarID(BaseModel):
@@ -55,7 +68,246 @@ class DocumentExtractionResponse(BaseModel):
     istimara: Istimara
 
 
-def extract_document_info(context: str, api_key: str = None) -> dict:
+EXTRACTION_MODEL = "gpt-4o-2024-08-06"
+
+# Completions in flight at once, across every request of the process
+OPENAI_CONCURRENCY = int(os.getenv("OPENAI_CONCURRENCY", "8"))
+OPENAI_TIMEOUT = float(os.getenv("OPENAI_TIMEOUT", "60"))
+OPENAI_CONNECT_TIMEOUT = float(os.getenv("OPENAI_CONNECT_TIMEOUT", "5"))
+OPENAI_MAX_RETRIES = int(os.getenv("OPENAI_MAX_RETRIES", "4"))
+# Backoff before retry n is a random delay up to OPENAI_RETRY_BASE * 2^n seconds
+OPENAI_RETRY_BASE = float(os.getenv("OPENAI_RETRY_BASE", "1"))
+OPENAI_RETRY_MAX = float(os.getenv("OPENAI_RETRY_MAX", "20"))
+# APIConnectionError covers timeouts too; InternalServerError is any 5xx
+RETRYABLE_ERRORS = (RateLimitError, InternalServerError, APITimeoutError, APIConnectionError)
+
+SYSTEM_PROMPT = """You are an expert document information extractor for Qatar documents.
+                Extract all available information from Qatar ID cards and Istimara (vehicle registration) documents.
+                
+                Important instructions:
+                - Extract ALL information that is present in the context
+                - If a field is not mentioned or cannot be found, leave it as an empty string ""
+                - Be precise and accurate with dates, numbers, and names
+                - For names, extract both Arabic and English versions if available
+                - Ensure all extracted data matches the original context exactly
+                """
+
+USER_PROMPT_TEMPLATE = "Extract Qatar ID and Istimara information from the following context:\n\n{context}"
+
+# Used when the rule-based extractor already filled the other fields
+MISSING_FIELDS_PROMPT_TEMPLATE = "Extract only the following fields ({fields}) from the following context:\n\n{context}"
+
+# Used when each document type is extracted from its own pages
+DOCUMENT_PROMPT_TEMPLATE = "Extract {document} information from the following context:\n\n{context}"
+
+DOCUMENT_MODELS = {"qatar_id": QatarID, "istimara": Istimara}
+DOCUMENT_TITLES = {"qatar_id": "Qatar ID", "istimara": "Istimara (vehicle registration)"}
+
+
+def extraction_schema_version() -> str:
+    """
+    Fingerprint of everything that shapes an extraction besides the OCR text:
+    the response schemas and the prompts. Changing any of them changes the
+    cache keys, so stale memoized results are never served.
+    """
+    schemas = [
+        model.model_json_schema()
+        for model in (DocumentExtractionResponse, QatarID, Istimara)
+    ]
+    return content_hash(
+        json.dumps(schemas, sort_keys=True), SYSTEM_PROMPT, USER_PROMPT_TEMPLATE, MISSING_FIELDS_PROMPT_TEMPLATE,
+        DOCUMENT_PROMPT_TEMPLATE, json.dumps(DOCUMENT_TITLES, sort_keys=True)
+    )[:16]
+
+
+EXTRACTION_SCHEMA_VERSION = extraction_schema_version()
+
+
+def normalize_context(context: str) -> str:
+    """Collapse whitespace and drop blank lines, so layout-only differences share a cache key"""
+    lines = (" ".join(line.split()) for line in context.splitlines())
+    return "\n".join(line for line in lines if line)
+
+
+def extraction_cache_key(
+    context: str,
+    model: str = EXTRACTION_MODEL,
+    fields: Dict[str, List[str]] = None,
+    document: str = None
+) -> str:
+    """Key of a full extraction, of an extraction of one document type, or of only the given fields of each document"""
+    if document is not None:
+        return content_hash("extraction-document", model, EXTRACTION_SCHEMA_VERSION, document, normalize_context(context))
+    if fields is None:
+        return content_hash("extraction", model, EXTRACTION_SCHEMA_VERSION, normalize_context(context))
+    requested = json.dumps({document: sorted(names) for document, names in fields.items()}, sort_keys=True)
+    return content_hash("extraction-fields", model, EXTRACTION_SCHEMA_VERSION, requested, normalize_context(context))
+
+
+@lru_cache(maxsize=256)
+def _missing_fields_model(requested: Tuple[Tuple[str, Tuple[str, ...]], ...]):
+    documents = {}
+    for document, names in requested:
+        model = DOCUMENT_MODELS[document]
+        documents[document] = (
+            create_model(
+                f"{model.__name__}Fields",
+                __doc__=model.__doc__,
+                **{name: (str, model.model_fields[name]) for name in names}
+            ),
+            ...
+        )
+    return create_model("MissingFieldsResponse", **documents)
+
+
+def missing_fields_model(fields: Dict[str, List[str]]):
+    """Response model with only the given fields of each document (same descriptions as the full models)"""
+    requested = tuple(sorted((document, tuple(sorted(names))) for document, names in fields.items() if names))
+    return _missing_fields_model(requested)
+
+
+class ExtractionClient:
+    """
+    Shared AsyncOpenAI client for structured extraction.
+    One pooled client per API key, at most max_concurrency completions in
+    flight, explicit timeouts, and retries with jittered exponential backoff
+    on 429, 5xx, timeouts and connection errors.
+    Token usage and latency are kept for every call.
+    """
+    
+    def __init__(
+        self,
+        max_concurrency: int = OPENAI_CONCURRENCY,
+        timeout: float = OPENAI_TIMEOUT,
+        connect_timeout: float = OPENAI_CONNECT_TIMEOUT,
+        max_retries: int = OPENAI_MAX_RETRIES
+    ):
+        self.max_concurrency = max_concurrency
+        self.timeout = httpx.Timeout(timeout, connect=connect_timeout)
+        self.max_retries = max_retries
+        self._clients = {}
+        # Calls beyond max_concurrency wait their turn, callers served fairly
+        self.limiter = FairLimiter("llm", max_concurrency)
+        self.calls = 0
+        self.retries = 0
+        self.errors = 0
+        self.refusals = 0
+        self.in_flight = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.total_latency_ms = 0.0
+        self.recent_calls = deque(maxlen=100)
+    
+    def client(self, api_key: Optional[str] = None) -> AsyncOpenAI:
+        client = self._clients.get(api_key)
+        if client is None:
+            client = AsyncOpenAI(
+                api_key=api_key,
+                timeout=self.timeout,
+                # Retries are done here, with jitter and usage tracking
+                max_retries=0,
+                http_client=DefaultAsyncHttpxClient(
+                    timeout=self.timeout,
+                    limits=httpx.Limits(max_connections=self.max_concurrency, max_keepalive_connections=self.max_concurrency)
+                )
+            )
+            self._clients[api_key] = client
+        return client
+    
+    def _retry_delay(self, attempt: int, error: Exception) -> float:
+        # Honour Retry-After from rate limit responses
+        response = getattr(error, "response", None)
+        if response is not None:
+            try:
+                return min(OPENAI_RETRY_MAX, float(response.headers.get("retry-after")))
+            except (TypeError, ValueError):
+                pass
+        delay = min(OPENAI_RETRY_MAX, OPENAI_RETRY_BASE * 2 ** attempt)
+        return random.uniform(delay / 2, delay)
+    
+    async def parse(self, messages: List[Dict[str, str]], response_format, api_key: Optional[str] = None, model: str = EXTRACTION_MODEL):
+        """Structured completion, retried on transient errors. Returns the completion message."""
+        client = self.client(api_key)
+        attempt = 0
+        async with self.limiter.acquire(current_caller.get(), bounded=False):
+            self.in_flight += 1
+            try:
+                while True:
+                    started = time.perf_counter()
+                    try:
+                        with span("llm.parse", model=model, attempt=attempt):
+                            completion = await client.beta.chat.completions.parse(
+                                model=model,
+                                messages=messages,
+                                response_format=response_format,
+                            )
+                    except RETRYABLE_ERRORS as e:
+                        if attempt >= self.max_retries:
+                            self.errors += 1
+                            raise
+                        delay = self._retry_delay(attempt, e)
+                        attempt += 1
+                        self.retries += 1
+                        retries.inc(service="openai")
+                        print(f"OpenAI call failed ({type(e).__name__}), retry {attempt}/{self.max_retries} in {delay:.1f}s")
+                        await asyncio.sleep(delay)
+                        continue
+                    except Exception:
+                        self.errors += 1
+                        raise
+                    
+                    latency_ms = (time.perf_counter() - started) * 1000
+                    self._record(completion, latency_ms, attempt)
+                    return completion.choices[0].message
+            finally:
+                self.in_flight -= 1
+    
+    def _record(self, completion, latency_ms: float, retries: int):
+        usage = completion.usage
+        prompt_tokens = usage.prompt_tokens if usage else 0
+        completion_tokens = usage.completion_tokens if usage else 0
+        self.calls += 1
+        self.prompt_tokens += prompt_tokens
+        self.completion_tokens += completion_tokens
+        self.total_latency_ms += latency_ms
+        if completion.choices[0].message.refusal:
+            self.refusals += 1
+        self.recent_calls.append({
+            "model": completion.model,
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "latency_ms": round(latency_ms, 1),
+            "retries": retries
+        })
+        print(f"OpenAI extraction: {prompt_tokens} prompt + {completion_tokens} completion tokens in {latency_ms:.0f}ms")
+    
+    async def close(self):
+        clients = list(self._clients.values())
+        self._clients = {}
+        for client in clients:
+            await client.close()
+    
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "max_concurrency": self.max_concurrency,
+            "in_flight": self.in_flight,
+            "waiting": self.limiter.queued,
+            "calls": self.calls,
+            "retries": self.retries,
+            "errors": self.errors,
+            "refusals": self.refusals,
+            "prompt_tokens": self.prompt_tokens,
+            "completion_tokens": self.completion_tokens,
+            "avg_latency_ms": round(self.total_latency_ms / self.calls, 1) if self.calls else 0.0,
+            "recent_calls": list(self.recent_calls)[-10:]
+        }
+
+
+# Process-wide OpenAI client
+llm_client = ExtractionClient()
+
+
+async def extract_document_info(context: str, api_key: str = None) -> dict:
     """
     Extract Qatar ID and Istimara information from the given context.
     
@@ -64,40 +316,33 @@ def extract_document_info(context: str, api_key: str = None) -> dict:
         api_key: OpenAI API key (optional, will use environment variable if not provided)
     
     Returns:
-        Dictionary with extracted information in the specified structure
+        Dictionary with extracted information, or error and refusal_message if the request was refused
     """
-    # Initialize OpenAI client
-    client = OpenAI(api_key=api_key) if api_key else OpenAI()
-    
-    # Create the completion with structured output
-    completion = client.beta.chat.completions.parse(
-        model="gpt-4o-2024-08-06",
+    message = await llm_client.parse(
         messages=[
             {
                 "role": "system",
-                "content": """You are an expert document information extractor for Qatar documents.
-                Extract all available information from Qatar ID cards and Istimara (vehicle registration) documents.
-                
-                Important instructions:
-                - Extract ALL information that is present in the context
-                - If a field is not mentioned or cannot be found, leave it as an empty string ""
-                - Be precise and accurate with dates, numbers, and names
-                - For names, extract both Arabic and English versions if available
-                - Ensure all extracted data matches the original context exactly
-                """
+                "content": SYSTEM_PROMPT
             },
             {
                 "role": "user",
-                "content": f"Extract Qatar ID and Istimara information from the following context:\n\n{context}"
+                "content": USER_PROMPT_TEMPLATE.format(context=context)
             }
         ],
         response_format=DocumentExtractionResponse,
+        api_key=api_key
     )
     
+    # Check for refusal
+    if message.refusal:
+        return {
+            "error": "Request was refused",
+            "refusal_message": message.refusal
+        }
+    
     # Get the parsed response
-    extracted_data = completion.choices[0].message.parsed
+    extracted_data = message.parsed
     
-    # Convert to dictionary
     result = {
         "qatar_id": extracted_data.qatar_id.model_dump(),
         "istimara": extracted_data.istimara.model_dump()
@@ -106,63 +351,125 @@ def extract_document_info(context: str, api_key: str = None) -> dict:
     return result
 
 
-def extract_document_info_with_refusal_handling(context: str, api_key: str = None) -> dict:
+async def extract_missing_fields(context: str, fields: Dict[str, List[str]], api_key: str = None) -> dict:
     """
-    Extract document information with proper refusal handling.
+    Extract only some fields, e.g. {"qatar_id": ["name"], "istimara": ["vehicle_model"]}.
+    Returns a dict with the requested fields of each document, or error and refusal_message.
+    """
+    fields = {document: names for document, names in fields.items() if names}
+    field_list = ", ".join(f"{document}.{name}" for document, names in fields.items() for name in names)
+    message = await llm_client.parse(
+        messages=[
+            {
+                "role": "system",
+                "content": SYSTEM_PROMPT
+            },
+            {
+                "role": "user",
+                "content": MISSING_FIELDS_PROMPT_TEMPLATE.format(fields=field_list, context=context)
+            }
+        ],
+        response_format=missing_fields_model(fields),
+        api_key=api_key
+    )
     
-    Args:
-        context: Text content containing Qatar ID and/or Istimara information
-        api_key: OpenAI API key (optional, will use environment variable if not provided)
+    if message.refusal:
+        return {
+            "error": "Request was refused",
+            "refusal_message": message.refusal
+        }
     
-    Returns:
-        Dictionary with extracted information or error message
+    return message.parsed.model_dump()
+
+
+async def extract_single_document(context: str, document: str, api_key: str = None) -> dict:
     """
-    client = OpenAI(api_key=api_key) if api_key else OpenAI()
-    
-    completion = client.beta.chat.completions.parse(
-        model="gpt-4o-2024-08-06",
+    Extract one document type ("qatar_id" or "istimara") with its own schema.
+    Returns the fields of that document, or error and refusal_message.
+    """
+    message = await llm_client.parse(
         messages=[
             {
                 "role": "system",
-                "content": """You are an expert document information extractor for Qatar documents.
-                Extract all available information from Qatar ID cards and Istimara (vehicle registration) documents.
-                
-                Important instructions:
-                - Extract ALL information that is present in the context
-                - If a field is not mentioned or cannot be found, leave it as an empty string ""
-                - Be precise and accurate with dates, numbers, and names
-                - For names, extract both Arabic and English versions if available
-                - Ensure all extracted data matches the original context exactly
-                """
+                "content": SYSTEM_PROMPT
             },
             {
                 "role": "user",
-                "content": f"Extract Qatar ID and Istimara information from the following context:\n\n{context}"
+                "content": DOCUMENT_PROMPT_TEMPLATE.format(document=DOCUMENT_TITLES[document], context=context)
             }
         ],
-        response_format=DocumentExtractionResponse,
+        response_format=DOCUMENT_MODELS[document],
+        api_key=api_key
     )
     
-    message = completion.choices[0].message
-    
-    # Check for refusal
     if message.refusal:
         return {
             "error": "Request was refused",
             "refusal_message": message.refusal
         }
     
-    # Get the parsed response
-    extracted_data = message.parsed
+    return message.parsed.model_dump()
+
+
+async def _memoized(key: Optional[str], cache: Optional[ResultCache], call) -> dict:
+    if key is not None:
+        cached = await cache.get(key)
+        if cached is not None:
+            print("Structured data served from extraction cache")
+            return cached
     
-    result = {
-        "qatar_id": extracted_data.qatar_id.model_dump(),
-        "istimara": extracted_data.istimara.model_dump()
-    }
+    result = await call()
+    
+    if key is not None and "error" not in result:
+        await cache.set(key, result)
     
     return result
 
 
+async def extract_document_info_memoized(context: str, cache: ResultCache = None, api_key: str = None) -> dict:
+    """
+    extract_document_info behind a result cache.
+    Identical OCR text (after normalization) with the same model, schemas and
+    prompts is served from the cache instead of a new completion.
+    Refusals and errors are never cached.
+    """
+    key = extraction_cache_key(context) if cache is not None else None
+    return await _memoized(key, cache, lambda: extract_document_info(context, api_key))
+
+
+async def extract_missing_fields_memoized(
+    context: str,
+    fields: Dict[str, List[str]],
+    cache: ResultCache = None,
+    api_key: str = None
+) -> dict:
+    """extract_missing_fields behind the same result cache, keyed on the requested fields too"""
+    key = extraction_cache_key(context, fields=fields) if cache is not None else None
+    return await _memoized(key, cache, lambda: extract_missing_fields(context, fields, api_key))
+
+
+async def extract_documents_memoized(contexts: Dict[str, str], cache: ResultCache = None, api_key: str = None) -> dict:
+    """
+    One extraction per document type, run concurrently, each with only the text
+    of its own pages and its own schema. A document type without text is
+    returned empty without a call. Same result shape as extract_document_info.
+    """
+    documents = [document for document in DOCUMENT_MODELS if contexts.get(document)]
+    
+    async def extract(document: str) -> dict:
+        key = extraction_cache_key(contexts[document], document=document) if cache is not None else None
+        return await _memoized(key, cache, lambda: extract_single_document(contexts[document], document, api_key))
+    
+    results = await asyncio.gather(*(extract(document) for document in documents))
+    for result in results:
+        if "error" in result:
+            return result
+    
+    extracted = {document: model().model_dump() for document, model in DOCUMENT_MODELS.items()}
+    extracted.update(zip(documents, results))
+    return extracted
+
+
 # # Example usage
 # if __name__ == "__main__":
 #     # Example context with Qatar ID and Istimara information
@@ -208,7 +515,7 @@ def extract_document_info_with_refusal_handling(context: str, api_key: str = Non
     
 #     # Extract information
 #     try:
-#         result = extract_document_info_with_refusal_handling(sample_context)
+#         result = asyncio.run(extract_document_info(sample_context))
         
 #         # Pretty print the result
 #         print(json.dumps(result, indent=2, ensure_ascii=False))
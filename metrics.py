@@ -0,0 +1,356 @@
+"""
+Latency instrumentation: spans, histograms and counters, exposed in the
+Prometheus text format on GET /metrics.
+
+    with span("vision.text_detection", pages=1):
+        ...
+    pages_processed.inc(len(pages), mode="batch")
+
+Every span is recorded in the ocr_span_seconds histogram (labels span and
+status) and, with OTEL_ENABLED=true and the opentelemetry SDK and OTLP
+exporter installed, exported as a trace span to OTEL_EXPORTER_OTLP_ENDPOINT
+(a local collector). The stats() of the shared pools, caches and queues are
+exposed as gauges through register_stats.
+
+With METRICS_ENABLED=false span() returns a shared no-op context manager and
+inc/observe return immediately.
+"""
+from contextlib import nullcontext
+from typing import Dict, Any, Callable, Iterable, Tuple
+import math
+import os
+import re
+import threading
+import time
+
+from pymongo import monitoring
+
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "true").lower() == "true"
+# Optional trace export through OpenTelemetry (OTLP/gRPC to a local collector)
+OTEL_ENABLED = os.getenv("OTEL_ENABLED", "false").lower() == "true"
+OTEL_EXPORTER_OTLP_ENDPOINT = os.getenv("OTEL_EXPORTER_OTLP_ENDPOINT", "http://localhost:4317")
+OTEL_SERVICE_NAME = os.getenv("OTEL_SERVICE_NAME", "renewal-ocr")
+
+METRICS_PREFIX = "ocr_"
+# Seconds, from a cache hit to a slow LLM call
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def _metric_name(name: str) -> str:
+    return re.sub(r"[^a-zA-Z0-9_]", "_", name)
+
+
+def _label_value(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(labels: Tuple[Tuple[str, Any], ...]) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{_label_value(value)}"' for name, value in labels) + "}"
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class Counter:
+    """A monotonically increasing count per label set"""
+
+    def __init__(self, name: str, description: str, labels: Iterable[str] = ()):
+        self.name = METRICS_PREFIX + name
+        self.description = description
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1, **labels):
+        if not METRICS_ENABLED:
+            return
+        key = tuple((name, labels.get(name, "")) for name in self.labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        return self._values.get(tuple((name, labels.get(name, "")) for name in self.labels), 0)
+
+    def render(self) -> Iterable[str]:
+        yield f"# HELP {self.name} {self.description}"
+        yield f"# TYPE {self.name} counter"
+        with self._lock:
+            values = list(self._values.items())
+        for key, value in values:
+            yield f"{self.name}{_format_labels(key)} {_format_value(value)}"
+
+
+class Histogram:
+    """Observations in cumulative buckets per label set, with their count and sum"""
+
+    def __init__(self, name: str, description: str, labels: Iterable[str] = (), buckets: Iterable[float] = DEFAULT_BUCKETS):
+        self.name = METRICS_PREFIX + name
+        self.description = description
+        self.labels = tuple(labels)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+        self._series = {}  # labels -> [bucket counts..., count, sum]
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels):
+        if not METRICS_ENABLED:
+            return
+        key = tuple((name, labels.get(name, "")) for name in self.labels)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [0] * (len(self.buckets) + 2)
+            for idx, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[idx] += 1
+                    break
+            series[-2] += 1
+            series[-1] += value
+
+    def time(self, **labels):
+        """Context manager observing the seconds spent in its block"""
+        if not METRICS_ENABLED:
+            return nullcontext()
+        return _Timer(self, labels)
+
+    def count(self, **labels) -> int:
+        series = self._series.get(tuple((name, labels.get(name, "")) for name in self.labels))
+        return series[-2] if series else 0
+
+    def render(self) -> Iterable[str]:
+        yield f"# HELP {self.name} {self.description}"
+        yield f"# TYPE {self.name} histogram"
+        with self._lock:
+            series_list = [(key, list(series)) for key, series in self._series.items()]
+        for key, series in series_list:
+            cumulative = 0
+            for idx, bound in enumerate(self.buckets):
+                cumulative += series[idx]
+                labels = key + (("le", _format_value(bound)),)
+                yield f"{self.name}_bucket{_format_labels(labels)} {cumulative}"
+            yield f"{self.name}_count{_format_labels(key)} {series[-2]}"
+            yield f"{self.name}_sum{_format_labels(key)} {_format_value(series[-1])}"
+
+
+class _Timer:
+    __slots__ = ("histogram", "labels", "started")
+
+    def __init__(self, histogram: Histogram, labels: Dict[str, Any]):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.histogram.observe(time.perf_counter() - self.started, **self.labels)
+        return False
+
+
+class MetricsRegistry:
+    """Every metric of the process, plus stats() callables rendered as gauges"""
+
+    def __init__(self):
+        self.metrics = {}
+        self.stats_sources = {}
+
+    def counter(self, name: str, description: str, labels: Iterable[str] = ()) -> Counter:
+        metric = self.metrics[name] = Counter(name, description, labels)
+        return metric
+
+    def histogram(self, name: str, description: str, labels: Iterable[str] = (), buckets: Iterable[float] = DEFAULT_BUCKETS) -> Histogram:
+        metric = self.metrics[name] = Histogram(name, description, labels, buckets)
+        return metric
+
+    def register_stats(self, name: str, stats: Callable[[], Dict[str, Any]]):
+        """Expose the numeric values of stats() as ocr_<name>_<key> gauges"""
+        self.stats_sources[name] = stats
+
+    def _stats_gauges(self, prefix: str, values: Dict[str, Any], labels: Tuple = ()) -> Iterable[Tuple[str, Tuple, float]]:
+        for key, value in values.items():
+            if isinstance(value, dict):
+                if re.fullmatch(r"[a-zA-Z_][a-zA-Z0-9_]*", str(key)):
+                    yield from self._stats_gauges(f"{prefix}_{key}", value, labels)
+                else:
+                    # Keyed by a name (host, cache...) rather than a field: make it a label
+                    yield from self._stats_gauges(prefix, value, labels + (("name", key),))
+            elif isinstance(value, (bool, int, float)):
+                yield _metric_name(f"{prefix}_{key}"), labels, float(value)
+
+    def render(self) -> str:
+        lines = []
+        for metric in list(self.metrics.values()):
+            lines.extend(metric.render())
+        for name, stats in list(self.stats_sources.items()):
+            try:
+                values = stats()
+            except Exception as e:
+                print(f"Error collecting {name} stats: {e}")
+                continue
+            typed = set()
+            for metric_name, labels, value in self._stats_gauges(METRICS_PREFIX + name, values):
+                if metric_name not in typed:
+                    typed.add(metric_name)
+                    lines.append(f"# TYPE {metric_name} gauge")
+                lines.append(f"{metric_name}{_format_labels(labels)} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+
+registry = MetricsRegistry()
+
+span_seconds = registry.histogram("span_seconds", "Duration of instrumented spans (stages, calls, pages)", ("span", "status"))
+http_request_seconds = registry.histogram(
+    "http_request_seconds", "Duration of HTTP requests served", ("method", "route", "status")
+)
+mongo_command_seconds = registry.histogram("mongo_command_seconds", "Duration of MongoDB commands", ("command", "collection", "status"))
+pages_processed = registry.counter("pages_processed_total", "Pages sent to OCR", ("mode",))
+upload_bytes = registry.counter("upload_bytes_total", "Bytes of accepted uploads")
+uploads_rejected = registry.counter("uploads_rejected_total", "Uploads rejected for their size")
+retries = registry.counter("retries_total", "Retried calls to external services", ("service",))
+cache_lookups = registry.counter("cache_lookups_total", "Cache lookups by result", ("cache", "result"))
+admission_wait_seconds = registry.histogram(
+    "admission_wait_seconds", "Time spent waiting for admission (OCR pages, LLM calls)", ("queue", "outcome")
+)
+admission_rejected = registry.counter("admission_rejected_total", "Requests refused by admission control", ("queue", "reason"))
+
+
+# ---------------------------------------------------------------------------
+# Spans
+# ---------------------------------------------------------------------------
+
+_tracer = None
+_tracer_provider = None
+
+
+class _NoopSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+    def set_status(self, status: str):
+        pass
+
+
+_NOOP_SPAN = _NoopSpan()
+
+
+class _Span:
+    __slots__ = ("name", "attributes", "status", "started", "otel_span")
+
+    def __init__(self, name: str, attributes: Dict[str, Any]):
+        self.name = name
+        self.attributes = attributes
+        self.status = None
+        self.otel_span = None
+
+    def set_status(self, status: str):
+        """Status label of the span (default: ok, or error when its block raised)"""
+        self.status = status
+
+    def __enter__(self):
+        if _tracer is not None:
+            self.otel_span = _tracer.start_as_current_span(self.name, attributes={
+                key: value for key, value in self.attributes.items() if isinstance(value, (str, bool, int, float))
+            })
+            self.otel_span.__enter__()
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        status = self.status or ("error" if exc_type else "ok")
+        span_seconds.observe(time.perf_counter() - self.started, span=self.name, status=status)
+        if self.otel_span is not None:
+            self.otel_span.__exit__(exc_type, exc, tb)
+        return False
+
+
+def span(name: str, **attributes):
+    """
+    Time a block as a span: observed in ocr_span_seconds and, when OpenTelemetry
+    export is on, sent as a trace span with the given attributes (e.g. request_id).
+    Works in sync and async code (`with span(...)`), nested spans become children.
+    """
+    if not METRICS_ENABLED:
+        return _NOOP_SPAN
+    return _Span(name, attributes)
+
+
+def start_tracing():
+    """Set up OpenTelemetry span export when OTEL_ENABLED (called at startup)"""
+    global _tracer, _tracer_provider
+    if not (METRICS_ENABLED and OTEL_ENABLED) or _tracer is not None:
+        return
+    try:
+        from opentelemetry import trace
+        from opentelemetry.sdk.resources import Resource
+        from opentelemetry.sdk.trace import TracerProvider
+        from opentelemetry.sdk.trace.export import BatchSpanProcessor
+        from opentelemetry.exporter.otlp.proto.grpc.trace_exporter import OTLPSpanExporter
+    except ImportError as e:
+        print(f"OpenTelemetry export disabled, the SDK is not installed: {e}")
+        return
+    _tracer_provider = TracerProvider(resource=Resource.create({"service.name": OTEL_SERVICE_NAME}))
+    _tracer_provider.add_span_processor(BatchSpanProcessor(OTLPSpanExporter(endpoint=OTEL_EXPORTER_OTLP_ENDPOINT, insecure=True)))
+    trace.set_tracer_provider(_tracer_provider)
+    _tracer = trace.get_tracer("renewal-ocr")
+    print(f"Exporting spans to {OTEL_EXPORTER_OTLP_ENDPOINT}")
+
+
+def stop_tracing():
+    """Flush pending spans (called at shutdown)"""
+    global _tracer, _tracer_provider
+    if _tracer_provider is not None:
+        _tracer_provider.shutdown()
+    _tracer = None
+    _tracer_provider = None
+
+
+# ---------------------------------------------------------------------------
+# MongoDB command timings
+# ---------------------------------------------------------------------------
+
+class MongoCommandMetrics(monitoring.CommandListener):
+    """pymongo command listener feeding ocr_mongo_command_seconds"""
+
+    def __init__(self):
+        self._collections = {}
+
+    def started(self, event):
+        collection = event.command.get(event.command_name)
+        self._collections[(event.connection_id, event.request_id)] = (
+            collection if isinstance(collection, str) else ""
+        )
+
+    def _record(self, event, status: str):
+        collection = self._collections.pop((event.connection_id, event.request_id), "")
+        mongo_command_seconds.observe(
+            event.duration_micros / 1e6, command=event.command_name, collection=collection, status=status
+        )
+
+    def succeeded(self, event):
+        self._record(event, "ok")
+
+    def failed(self, event):
+        self._record(event, "error")
+
+
+def mongo_event_listeners() -> list:
+    """Listeners to pass to the Mongo client (none when metrics are disabled)"""
+    if not METRICS_ENABLED:
+        return []
+    return [MongoCommandMetrics()]
+
+
+def render() -> str:
+    return registry.render()
@@ -1,78 +1,292 @@
 # gcp_helper.py me ye simple solution use karen:
 
 import io
+import asyncio
 from google.cloud import vision
+from google.cloud.vision_v1.services.image_annotator.transports import ImageAnnotatorGrpcTransport
 from google.api_core import retry
 from google.api_core.exceptions import ServiceUnavailable, InternalServerError, DeadlineExceeded
 from PIL import Image
 import os
 import time
 import logging
+from typing import List
+import threading
+from contextlib import contextmanager
+import grpc
+
+from cache import ResultCache, content_hash
+from cpu_pool import cpu_pool
+from metrics import span, retries
+
+# Max number of pages sent to Vision at the same time
+OCR_CONCURRENCY = int(os.getenv("OCR_CONCURRENCY", "4"))
+
+# Number of long-lived Vision clients (gRPC channels) shared by the process
+VISION_POOL_SIZE = int(os.getenv("VISION_POOL_SIZE", "2"))
+
+# host:port of a Vision-compatible endpoint reached over plaintext gRPC without
+# credentials, e.g. stubs/fake_vision.py for offline benchmarks (unset: Google)
+VISION_API_ENDPOINT = os.getenv("VISION_API_ENDPOINT")
+
+# Service account key of the Vision clients, read once when a client is created
+VISION_CREDENTIALS_FILE = os.getenv("GOOGLE_APPLICATION_CREDENTIALS", "alkhaleej-454901-15ecd8efcec5.json")
+
+# How pages are sent to Vision: auto, page, batch or pdf (see choose_ocr_mode)
+OCR_MODE = os.getenv("OCR_MODE", "auto")
+
+# Vision limits for synchronous requests
+VISION_MAX_BATCH_IMAGES = 16  # images per batch_annotate_images call
+VISION_MAX_FILE_PAGES = 5  # pages per batch_annotate_files call
+OCR_BATCH_SIZE = min(int(os.getenv("OCR_BATCH_SIZE", str(VISION_MAX_BATCH_IMAGES))), VISION_MAX_BATCH_IMAGES)
+
+# Largest PDF submitted as-is to Vision, bigger ones are rasterized first
+VISION_PDF_MAX_BYTES = int(os.getenv("VISION_PDF_MAX_BYTES", str(10 * 1024 * 1024)))
+
+VISION_RETRY = retry.Retry(
+    predicate=retry.if_exception_type(
+        ServiceUnavailable,
+        InternalServerError,
+        DeadlineExceeded
+    ),
+    initial=2.0,
+    maximum=60.0,
+    multiplier=2.0,
+    deadline=180.0  # Total 3 minutes
+)
+VISION_TIMEOUT = 90.0  # Individual request timeout
+
+TEXT_DETECTION_FEATURES = [vision.Feature(type_=vision.Feature.Type.TEXT_DETECTION)]
+
+
+class VisionClientPool:
+    """
+    Process-wide pool of long-lived Vision clients.
+    Clients are handed out round-robin and reused across requests, so TLS,
+    HTTP/2 and credential setup is paid once per channel instead of per page.
+    A client whose channel goes bad is replaced and the old one is closed
+    once its in-flight calls finish.
+    """
+    
+    def __init__(self, size: int = VISION_POOL_SIZE):
+        self.size = max(1, size)
+        self._clients = [None] * self.size
+        self._in_use = {}  # id(client) -> number of in-flight calls
+        self._retired = {}  # id(client) -> client waiting to be closed
+        self._next = 0
+        self._lock = threading.Lock()
+        
+        # Counters
+        self.reconnects = 0
+        self.in_flight = 0
+        self.total_calls = 0
+    
+    def _create_client(self):
+        if VISION_API_ENDPOINT:
+            transport = ImageAnnotatorGrpcTransport(channel=grpc.insecure_channel(VISION_API_ENDPOINT))
+            return vision.ImageAnnotatorClient(transport=transport)
+        return vision.ImageAnnotatorClient(client_options={"credentials_file": VISION_CREDENTIALS_FILE})
+    
+    @staticmethod
+    def _close_client(client):
+        try:
+            client.transport.close()
+        except Exception as e:
+            logging.warning(f"Error closing Vision client: {str(e)}")
+    
+    def start(self):
+        """Create every client in the pool up front (called at app startup)"""
+        with self._lock:
+            for slot in range(self.size):
+                if self._clients[slot] is None:
+                    self._clients[slot] = self._create_client()
+    
+    def _acquire(self):
+        with self._lock:
+            slot = self._next
+            self._next = (self._next + 1) % self.size
+            if self._clients[slot] is None:
+                self._clients[slot] = self._create_client()
+            client = self._clients[slot]
+            self._in_use[id(client)] = self._in_use.get(id(client), 0) + 1
+            self.in_flight += 1
+            self.total_calls += 1
+            return slot, client
+    
+    def _release(self, client):
+        to_close = None
+        with self._lock:
+            self.in_flight -= 1
+            remaining = self._in_use.get(id(client), 1) - 1
+            if remaining > 0:
+                self._in_use[id(client)] = remaining
+            else:
+                self._in_use.pop(id(client), None)
+                to_close = self._retired.pop(id(client), None)
+        if to_close is not None:
+            self._close_client(to_close)
+    
+    @contextmanager
+    def client(self):
+        """Borrow a client for one call"""
+        slot, client = self._acquire()
+        try:
+            yield client
+        except ServiceUnavailable:
+            # Channel is likely broken, swap it for a fresh one
+            self.reconnect(slot, client)
+            raise
+        finally:
+            self._release(client)
+    
+    def reconnect(self, slot: int, client=None):
+        """Replace the client in slot (only if it is still client, when given)"""
+        to_close = None
+        with self._lock:
+            old = self._clients[slot]
+            if client is not None and old is not client:
+                return  # Another thread already reconnected this slot
+            self._clients[slot] = self._create_client()
+            self.reconnects += 1
+            if old is not None:
+                if self._in_use.get(id(old)):
+                    self._retired[id(old)] = old
+                else:
+                    to_close = old
+        logging.warning(f"Vision client in slot {slot} reconnected")
+        if to_close is not None:
+            self._close_client(to_close)
+    
+    def health_check(self, timeout: float = 5.0) -> bool:
+        """
+        Check that every channel can connect, reconnecting the ones that can't.
+        Returns True if all channels were healthy.
+        """
+        healthy = True
+        for slot in range(self.size):
+            with self._lock:
+                client = self._clients[slot]
+            if client is None:
+                continue
+            try:
+                grpc.channel_ready_future(client.transport.grpc_channel).result(timeout=timeout)
+            except grpc.FutureTimeoutError:
+                healthy = False
+                self.reconnect(slot, client)
+        return healthy
+    
+    def close(self):
+        """Close every client (called at app shutdown)"""
+        with self._lock:
+            clients = [c for c in self._clients if c is not None] + list(self._retired.values())
+            self._clients = [None] * self.size
+            self._retired = {}
+        for client in clients:
+            self._close_client(client)
+    
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "pool_size": self.size,
+                "open_clients": sum(1 for c in self._clients if c is not None),
+                "retired_clients": len(self._retired),
+                "in_flight": self.in_flight,
+                "total_calls": self.total_calls,
+                "reconnects": self.reconnects
+            }
+
+
+# Shared by every GCPHelper in the process
+vision_client_pool = VisionClientPool()
+
+
+def choose_ocr_mode(mime_type: str, page_count: int, file_size: int, mode: str = None) -> str:
+    """
+    Pick how a file is sent to Vision:
+    - "pdf": the original PDF bytes through file annotation (no rasterization)
+    - "batch": rasterized pages packed into batch_annotate_images calls
+    - "page": one text_detection call per page
+    """
+    mode = mode or OCR_MODE
+    native_pdf_ok = mime_type == "application/pdf" and file_size <= VISION_PDF_MAX_BYTES
+    
+    if mode in ("auto", "pdf") and native_pdf_ok:
+        return "pdf"
+    if mode == "page":
+        return "page"
+    if mode == "batch":
+        return "batch"
+    return "batch" if page_count > 1 else "page"
+
+
+def parse_annotation_response(response):
+    """Return (full_text, confidence) from an AnnotateImageResponse"""
+    if response.error.message:
+        raise Exception(f"Vision API Error: {response.error.message}")
+    
+    texts = response.text_annotations
+    if not texts:
+        # File annotation may only fill full_text_annotation
+        return response.full_text_annotation.text, 0.0
+    
+    full_text = texts[0].description
+    
+    # Calculate confidence
+    total_confidence = 0.0
+    word_count = 0
+    
+    for text in texts[1:]:
+        if hasattr(text, 'confidence'):
+            total_confidence += text.confidence
+            word_count += 1
+    
+    overall_confidence = total_confidence / word_count if word_count > 0 else 0.0
+    
+    return full_text, overall_confidence
+
+
+def image_cache_key(image) -> str:
+    """
+    OCR cache key for a page. Encoded pages (bytes) are keyed on their content,
+    PIL images on their decoded pixels.
+    """
+    if isinstance(image, (bytes, bytearray, memoryview)):
+        return content_hash("page", image)
+    return content_hash("image", image.mode, str(image.size), image.tobytes())
+
+
+def _take_pages(page_iter, count: int, with_keys: bool):
+    """Pull up to count pages from a (lazy) page iterator, with their cache keys"""
+    chunk = []
+    for page in page_iter:
+        chunk.append((page, image_cache_key(page) if with_keys else None))
+        if len(chunk) == count:
+            break
+    return chunk
+
 
 class GCPHelper:
-    def __init__(self):
-        os.environ['GOOGLE_APPLICATION_CREDENTIALS'] = 'alkhaleej-454901-15ecd8efcec5.json'
+    def __init__(self, pool: VisionClientPool = None, cache: ResultCache = None):
+        self.pool = pool or vision_client_pool
+        self.cache = cache
     
-    def extract_text_from_image(self, image):
-        """Simple retry with fresh client creation"""
+    @staticmethod
+    def _image_content(image) -> bytes:
+        # Encoded pages are uploaded as they are
+        if isinstance(image, (bytes, bytearray, memoryview)):
+            return bytes(image)
+        
+        # Convert PIL Image to bytes (PNG-encoded in the CPU pool)
+        return cpu_pool.encode_image(image, "PNG")
+    
+    def _call_with_retries(self, call, name: str = "vision.call", pages: int = 1):
+        """Run call(client) on a pooled client with simple retry (each attempt is a span)"""
         
         max_retries = 3
         for attempt in range(max_retries):
             try:
-                # Fresh client har attempt pe
-                client = vision.ImageAnnotatorClient()
-                
-                # Convert PIL Image to bytes
-                img_byte_arr = io.BytesIO()
-                image.save(img_byte_arr, format='PNG')
-                img_byte_arr.seek(0)
-                
-                # Create Vision API image object
-                vision_image = vision.Image(content=img_byte_arr.getvalue())
-                
-                # Perform text detection with timeout
-                response = client.text_detection(
-                    image=vision_image,
-                    retry=retry.Retry(
-                        predicate=retry.if_exception_type(
-                            ServiceUnavailable,
-                            InternalServerError,
-                            DeadlineExceeded
-                        ),
-                        initial=2.0,
-                        maximum=60.0,
-                        multiplier=2.0,
-                        deadline=180.0  # Total 3 minutes
-                    ),
-                    timeout=90.0  # Individual request timeout
-                )
-                
-                # Close client connection explicitly
-                if hasattr(client, 'transport') and hasattr(client.transport, 'grpc_channel'):
-                    client.transport.grpc_channel.close()
-                
-                if response.error.message:
-                    raise Exception(f"Vision API Error: {response.error.message}")
-                
-                # Process response
-                texts = response.text_annotations
-                if not texts:
-                    return "", 0.0
-                    
-                full_text = texts[0].description
-                
-                # Calculate confidence
-                total_confidence = 0.0
-                word_count = 0
-                
-                for text in texts[1:]:
-                    if hasattr(text, 'confidence'):
-                        total_confidence += text.confidence
-                        word_count += 1
-                
-                overall_confidence = total_confidence / word_count if word_count > 0 else 0.0
-                
-                return full_text, overall_confidence
+                with self.pool.client() as client, span(name, pages=pages, attempt=attempt):
+                    return call(client)
                 
             except (ServiceUnavailable, InternalServerError, DeadlineExceeded) as e:
                 logging.warning(f"GCP OCR attempt {attempt + 1} failed: {str(e)}")
@@ -81,6 +295,7 @@ class GCPHelper:
                     raise Exception(f"GCP Vision API failed after {max_retries} attempts: {str(e)}")
                 
                 # Wait before retry
+                retries.inc(service="vision")
                 wait_time = (2 ** attempt) + 1
                 logging.info(f"Waiting {wait_time} seconds before retry...")
                 time.sleep(wait_time)
@@ -88,5 +303,192 @@ class GCPHelper:
             except Exception as e:
                 logging.error(f"Unexpected OCR error: {str(e)}")
                 raise
+    
+    def extract_text_from_image(self, image):
+        """OCR a single page (encoded bytes or PIL Image) with one text_detection call"""
+        
+        # Create Vision API image object
+        vision_image = vision.Image(content=self._image_content(image))
+        
+        response = self._call_with_retries(
+            lambda client: client.text_detection(
+                image=vision_image,
+                retry=VISION_RETRY,
+                timeout=VISION_TIMEOUT
+            ),
+            name="vision.text_detection"
+        )
+        return parse_annotation_response(response)
+    
+    def batch_extract_text_from_images(self, images):
+        """
+        OCR up to VISION_MAX_BATCH_IMAGES pages with one batch_annotate_images call.
+        Returns a list of (text, confidence) in the same order as images.
+        """
+        if len(images) > VISION_MAX_BATCH_IMAGES:
+            raise ValueError(f"At most {VISION_MAX_BATCH_IMAGES} images per batch, got {len(images)}")
+        
+        annotate_requests = [
+            vision.AnnotateImageRequest(
+                image=vision.Image(content=self._image_content(image)),
+                features=TEXT_DETECTION_FEATURES
+            )
+            for image in images
+        ]
+        
+        response = self._call_with_retries(
+            lambda client: client.batch_annotate_images(
+                requests=annotate_requests,
+                retry=VISION_RETRY,
+                timeout=VISION_TIMEOUT
+            ),
+            name="vision.batch_annotate_images",
+            pages=len(images)
+        )
+        return [parse_annotation_response(r) for r in response.responses]
+    
+    def extract_text_from_pdf_pages(self, pdf_bytes: bytes, pages: List[int]):
+        """
+        OCR up to VISION_MAX_FILE_PAGES pages (1-based) of a PDF by sending the
+        original PDF bytes through file annotation, without rasterizing it.
+        Returns a list of (text, confidence) in the same order as pages.
+        """
+        if len(pages) > VISION_MAX_FILE_PAGES:
+            raise ValueError(f"At most {VISION_MAX_FILE_PAGES} pages per file request, got {len(pages)}")
+        
+        file_request = vision.AnnotateFileRequest(
+            input_config=vision.InputConfig(content=pdf_bytes, mime_type="application/pdf"),
+            features=TEXT_DETECTION_FEATURES,
+            pages=pages
+        )
+        
+        response = self._call_with_retries(
+            lambda client: client.batch_annotate_files(
+                requests=[file_request],
+                retry=VISION_RETRY,
+                timeout=VISION_TIMEOUT
+            ),
+            name="vision.batch_annotate_files",
+            pages=len(pages)
+        )
+        
+        file_response = response.responses[0]
+        if file_response.error.message:
+            raise Exception(f"Vision API Error: {file_response.error.message}")
+        return [parse_annotation_response(r) for r in file_response.responses]
+    
+    async def _cached_results(self, keys):
+        """Look every key up in the OCR cache, None where there is no cached result"""
+        results = []
+        for key in keys:
+            cached = await self.cache.get(key) if self.cache is not None else None
+            results.append((cached["text"], cached["confidence"]) if cached else None)
+        return results
+    
+    async def _store_results(self, keys, results):
+        if self.cache is None:
+            return
+        for key, (text, confidence) in zip(keys, results):
+            await self.cache.set(key, {"text": text, "confidence": confidence})
+    
+    async def _extract_chunk(self, chunk, batched: bool):
+        """OCR a chunk of (page, cache_key) pairs, skipping pages that are already cached"""
+        keys = [key for _, key in chunk]
+        results = await self._cached_results(keys) if self.cache is not None else [None] * len(chunk)
+        missing = [idx for idx, result in enumerate(results) if result is None]
+        if not missing:
+            return results
+        
+        missing_pages = [chunk[idx][0] for idx in missing]
+        if batched:
+            ocr_results = await asyncio.to_thread(self.batch_extract_text_from_images, missing_pages)
+        else:
+            ocr_results = [
+                await asyncio.to_thread(self.extract_text_from_image, page)
+                for page in missing_pages
+            ]
+        
+        for idx, result in zip(missing, ocr_results):
+            results[idx] = result
+        if self.cache is not None:
+            await self._store_results([keys[idx] for idx in missing], ocr_results)
+        return results
+    
+    async def extract_text_from_images(self, images, max_concurrency=None, batch_size=1, semaphore=None):
+        """
+        OCR many pages concurrently without blocking the event loop.
+        images is a list or a lazy iterator of pages (encoded bytes or PIL Images).
+        Pages are pulled from it only once a concurrency slot is free, so at most
+        about max_concurrency * batch_size pages are held in memory at a time.
+        Pages already in the OCR cache are not sent to Vision again.
+        With batch_size > 1 pages are packed into batch_annotate_images calls,
+        otherwise each page is its own text_detection call.
+        Results come back in the same order as images.
+        """
+        semaphore = semaphore or asyncio.Semaphore(max_concurrency or OCR_CONCURRENCY)
+        batch_size = max(1, min(batch_size, VISION_MAX_BATCH_IMAGES))
+        page_iter = iter(images)
+        tasks = []
+        
+        async def _run(chunk):
+            try:
+                return await self._extract_chunk(chunk, batch_size > 1)
+            finally:
+                semaphore.release()
+        
+        try:
+            while True:
+                await semaphore.acquire()
+                try:
+                    chunk = await asyncio.to_thread(_take_pages, page_iter, batch_size, self.cache is not None)
+                except BaseException:
+                    semaphore.release()
+                    raise
+                if not chunk:
+                    semaphore.release()
+                    break
+                tasks.append(asyncio.ensure_future(_run(chunk)))
+            
+            chunks = await asyncio.gather(*tasks)
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            raise
+        
+        return [page_result for chunk in chunks for page_result in chunk]
+    
+    async def extract_text_from_pdf(self, pdf_bytes: bytes, page_count: int = None, max_concurrency=None, semaphore=None, pages: List[int] = None):
+        """
+        OCR a PDF through file annotation, VISION_MAX_FILE_PAGES pages per call,
+        with the calls running concurrently. Only the given 1-based pages are
+        OCR'd (all page_count pages by default). Pages already in the OCR cache
+        are skipped. Results are in page order.
+        """
+        semaphore = semaphore or asyncio.Semaphore(max_concurrency or OCR_CONCURRENCY)
+        if pages is None:
+            pages = list(range(1, page_count + 1))
+        
+        keys = []
+        if self.cache is not None:
+            pdf_hash = await asyncio.to_thread(content_hash, pdf_bytes)
+            keys = [content_hash("pdf", pdf_hash, str(page)) for page in pages]
+        results = await self._cached_results(keys) if keys else [None] * len(pages)
+        missing = [idx for idx, result in enumerate(results) if result is None]
+        missing_pages = [pages[idx] for idx in missing]
+        
+        async def _extract_pages(chunk):
+            async with semaphore:
+                return await asyncio.to_thread(self.extract_text_from_pdf_pages, pdf_bytes, chunk)
+        
+        tasks = [
+            _extract_pages(missing_pages[i:i + VISION_MAX_FILE_PAGES])
+            for i in range(0, len(missing_pages), VISION_MAX_FILE_PAGES)
+        ]
+        chunks = await asyncio.gather(*tasks)
+        ocr_results = [page_result for chunk in chunks for page_result in chunk]
+        for idx, result in zip(missing, ocr_results):
+            results[idx] = result
         
-        return "", 0.0
\ No newline at end of file
+        if keys:
+            await self._store_results([keys[idx] for idx in missing], ocr_results)
+        return results
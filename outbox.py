@@ -0,0 +1,407 @@
+"""
+Notification outbox.
+
+WhatsApp messages and renewal validation calls of a request are written to
+the `outbox` collection once its documents are stored, and delivered by an
+OutboxDispatcher in the background instead of inside the request:
+
+- messages to one phone number are delivered strictly in order
+  (the next one waits until the previous one is sent or given up)
+- heads of up to OUTBOX_BATCH_SIZE phone queues are delivered concurrently
+- failures are retried with exponential backoff and jitter
+- WhatsApp sends are throttled by a token bucket (OUTBOX_RATE_PER_SECOND)
+
+Dispatchers lease items, so several processes can dispatch the same outbox.
+Items have a unique key (request_id, execution, kind), so an execution that
+is retried or taken over queues each notification once.
+Sent and failed items lose their bearer token and expire OUTBOX_TTL_SECONDS
+after they finished.
+Run a standalone dispatcher with:
+
+    python outbox.py
+"""
+from typing import Optional, List, Dict, Any
+from datetime import datetime, timedelta
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+import asyncio
+import os
+import random
+import socket
+import time
+import uuid
+
+from database import CRUDOperations
+from whatsapp_func import (
+    send_text_message, send_insurance_type_selection, call_renewal_validation_api, format_extraction_message
+)
+
+# "outbox" delivers notifications in the background, "inline" sends them during the request
+NOTIFICATION_MODE = os.getenv("NOTIFICATION_MODE", "outbox").lower()
+OUTBOX_DISPATCHER_ENABLED = os.getenv("OUTBOX_DISPATCHER_ENABLED", "true").lower() == "true"
+OUTBOX_BATCH_SIZE = int(os.getenv("OUTBOX_BATCH_SIZE", "20"))
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "8"))
+# Retry delay is OUTBOX_BACKOFF_BASE * 2^(attempt - 1) seconds, capped and jittered
+OUTBOX_BACKOFF_BASE = float(os.getenv("OUTBOX_BACKOFF_BASE", "2"))
+OUTBOX_BACKOFF_MAX = float(os.getenv("OUTBOX_BACKOFF_MAX", "300"))
+# WhatsApp messages per second across the dispatcher, and the allowed burst
+OUTBOX_RATE_PER_SECOND = float(os.getenv("OUTBOX_RATE_PER_SECOND", "20"))
+OUTBOX_RATE_BURST = int(os.getenv("OUTBOX_RATE_BURST", "40"))
+# An item whose lease is not released within this time is picked up again
+OUTBOX_LEASE_SECONDS = int(os.getenv("OUTBOX_LEASE_SECONDS", "120"))
+OUTBOX_POLL_INTERVAL = float(os.getenv("OUTBOX_POLL_INTERVAL", "1.0"))
+# How long sent and failed items are kept (delivery status of a request)
+OUTBOX_TTL_SECONDS = int(os.getenv("OUTBOX_TTL_SECONDS", str(7 * 24 * 3600)))
+
+# Item kinds that are WhatsApp messages (rate limited)
+WHATSAPP_KINDS = {"text", "insurance_selection"}
+
+
+class RateLimiter:
+    """Async token bucket"""
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+        self.waits = 0
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                self.waits += 1
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+def backoff_delay(attempt: int) -> float:
+    """Exponential backoff with full jitter in the upper half"""
+    delay = min(OUTBOX_BACKOFF_MAX, OUTBOX_BACKOFF_BASE * 2 ** (attempt - 1))
+    return delay / 2 + random.uniform(0, delay / 2)
+
+
+class Outbox:
+    """MongoDB outbox of notifications, ordered per phone number"""
+
+    def __init__(self, crud: CRUDOperations):
+        self.crud = crud
+
+    async def ensure_indexes(self):
+        await self.crud.collection.create_index([("status", 1), ("phone_number", 1), ("created_at", 1), ("seq", 1)])
+        await self.crud.collection.create_index("request_id")
+        # Items queued before keys existed have none
+        await self.crud.collection.create_index("key", unique=True, sparse=True)
+        await self.crud.collection.create_index("completed_at", expireAfterSeconds=OUTBOX_TTL_SECONDS)
+        # Items finished before completed_at and the token removal existed expire one TTL from now
+        await self.crud.collection.update_many(
+            {"status": {"$in": ["sent", "failed"]}, "completed_at": {"$exists": False}},
+            self._finished({}, datetime.utcnow())
+        )
+
+    @staticmethod
+    def _finished(update: Dict[str, Any], now: datetime) -> Dict[str, Any]:
+        """Update operators of an item reaching sent or failed: expires later, credentials go now"""
+        update["completed_at"] = now
+        return {"$set": update, "$unset": {"payload.bearer_token": ""}}
+
+    async def enqueue(
+        self,
+        items: List[Dict[str, Any]],
+        after: Optional[Dict[str, Any]] = None,
+        execution_id: Optional[str] = None
+    ) -> List[Dict[str, Any]]:
+        """
+        Queue notifications, delivered in the given order for each phone number.
+        Items are dicts with request_id, phone_number, kind and payload.
+        Follow-ups of an outbox item are queued right behind it with after.
+        An item already queued by the same execution (of the item after) is
+        left as it is. Returns the items queued now.
+        """
+        now = datetime.utcnow()
+        created_at = after["created_at"] if after else now
+        first_seq = after["seq"] + 1 if after else 0
+        if after:
+            execution_id = after.get("execution_id") or str(after["_id"])
+        execution_id = execution_id or uuid.uuid4().hex
+        documents = []
+        for seq, item in enumerate(items, start=first_seq):
+            documents.append({
+                "key": f"{item['request_id']}:{execution_id}:{item['kind']}",
+                "execution_id": execution_id,
+                "request_id": item["request_id"],
+                "phone_number": item["phone_number"],
+                "kind": item["kind"],
+                "payload": item.get("payload", {}),
+                "seq": seq,
+                "status": "pending",
+                "attempts": 0,
+                "next_attempt_at": now,
+                "lease_owner": None,
+                "lease_expires_at": None,
+                "last_error": None,
+                "created_at": created_at,
+                "updated_at": now
+            })
+        queued = []
+        for document in documents:
+            try:
+                result = await self.crud.collection.update_one(
+                    {"key": document["key"]}, {"$setOnInsert": document}, upsert=True
+                )
+            except DuplicateKeyError:
+                # Upserted by a concurrent run of the same execution in the meantime
+                continue
+            if result.upserted_id is not None:
+                document["_id"] = str(result.upserted_id)
+                queued.append(document)
+        return queued
+
+    async def for_request(self, request_id: str) -> List[Dict[str, Any]]:
+        """Delivery status of the notifications of a request (payloads left out)"""
+        items = []
+        async for item in self.crud.stream(
+            {"request_id": request_id},
+            projection={"payload": 0, "lease_owner": 0, "lease_expires_at": 0},
+            sort=[("created_at", 1), ("seq", 1)]
+        ):
+            items.append(item)
+            for field in ("next_attempt_at", "created_at", "updated_at", "sent_at", "completed_at"):
+                if item.get(field):
+                    item[field] = item[field].isoformat()
+        return items
+
+    async def claim_batch(self, owner: str, limit: int = OUTBOX_BATCH_SIZE) -> List[Dict[str, Any]]:
+        """Lease the head item of up to limit phone queues that are due"""
+        now = datetime.utcnow()
+        heads = await self.crud.collection.aggregate([
+            {"$match": {"status": {"$in": ["pending", "processing"]}}},
+            {"$sort": {"phone_number": 1, "created_at": 1, "seq": 1}},
+            {"$group": {"_id": "$phone_number", "head": {"$first": "$$ROOT"}}},
+            {"$replaceRoot": {"newRoot": "$head"}},
+            {"$match": {"$or": [
+                {"status": "pending", "next_attempt_at": {"$lte": now}},
+                {"status": "processing", "lease_expires_at": {"$lt": now}}
+            ]}},
+            {"$sort": {"next_attempt_at": 1}},
+            {"$limit": limit}
+        ]).to_list(length=limit)
+
+        claimed = []
+        for head in heads:
+            if head["attempts"] >= OUTBOX_MAX_ATTEMPTS:
+                # Lost its lease on the last attempt
+                await self.crud.collection.update_one(
+                    {"_id": head["_id"], "status": head["status"], "attempts": head["attempts"]},
+                    self._finished({"status": "failed", "last_error": "Lease expired on the last attempt", "updated_at": now}, now)
+                )
+                continue
+            # Only one dispatcher wins an item: it must be unchanged since it was read
+            item = await self.crud.collection.find_one_and_update(
+                {"_id": head["_id"], "status": head["status"], "attempts": head["attempts"]},
+                {
+                    "$set": {
+                        "status": "processing",
+                        "lease_owner": owner,
+                        "lease_expires_at": now + timedelta(seconds=OUTBOX_LEASE_SECONDS),
+                        "updated_at": now
+                    },
+                    "$inc": {"attempts": 1}
+                },
+                return_document=ReturnDocument.AFTER
+            )
+            if item:
+                claimed.append(item)
+        return claimed
+
+    async def mark_sent(self, item: Dict[str, Any], result: Any = None):
+        now = datetime.utcnow()
+        await self.crud.collection.update_one(
+            {"_id": item["_id"], "lease_owner": item["lease_owner"]},
+            self._finished(
+                {"status": "sent", "result": result, "sent_at": now, "updated_at": now, "lease_owner": None, "lease_expires_at": None},
+                now
+            )
+        )
+
+    async def mark_failed(self, item: Dict[str, Any], error: str, retryable: bool = True) -> bool:
+        """Schedule a retry, or give up on the item. Returns True if it will be retried."""
+        now = datetime.utcnow()
+        retry = retryable and item["attempts"] < OUTBOX_MAX_ATTEMPTS
+        update = {"last_error": error, "updated_at": now, "lease_owner": None, "lease_expires_at": None}
+        if retry:
+            update["status"] = "pending"
+            update["next_attempt_at"] = now + timedelta(seconds=backoff_delay(item["attempts"]))
+            operations = {"$set": update}
+        else:
+            update["status"] = "failed"
+            operations = self._finished(update, now)
+        await self.crud.collection.update_one(
+            {"_id": item["_id"], "lease_owner": item["lease_owner"]},
+            operations
+        )
+        return retry
+
+
+class OutboxDispatcher:
+    """Background delivery of outbox items"""
+
+    def __init__(self, outbox: Outbox, batch_size: int = OUTBOX_BATCH_SIZE, rate_limiter: Optional[RateLimiter] = None):
+        self.outbox = outbox
+        self.batch_size = batch_size
+        self.rate_limiter = rate_limiter or RateLimiter(OUTBOX_RATE_PER_SECOND, OUTBOX_RATE_BURST)
+        self.owner = f"{socket.gethostname()}-{os.getpid()}-outbox"
+        self._task = None
+        self._stopping = asyncio.Event()
+        self.sent = 0
+        self.retried = 0
+        self.failed = 0
+        self.batches = 0
+
+    def start(self):
+        self._stopping.clear()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Stop claiming new items and wait for the current batch"""
+        self._stopping.set()
+        if self._task:
+            await asyncio.gather(self._task, return_exceptions=True)
+        self._task = None
+
+    async def join(self):
+        if self._task:
+            await self._task
+
+    async def _run(self):
+        while not self._stopping.is_set():
+            try:
+                delivered = await self.dispatch_once()
+            except Exception as e:
+                print(f"Error dispatching outbox: {e}")
+                delivered = 0
+            if not delivered:
+                try:
+                    await asyncio.wait_for(self._stopping.wait(), timeout=OUTBOX_POLL_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+
+    async def dispatch_once(self) -> int:
+        """Deliver one batch. Returns the number of items attempted."""
+        items = await self.outbox.claim_batch(self.owner, self.batch_size)
+        if items:
+            self.batches += 1
+            await asyncio.gather(*(self._deliver(item) for item in items))
+        return len(items)
+
+    async def _deliver(self, item: Dict[str, Any]):
+        try:
+            if item["kind"] in WHATSAPP_KINDS:
+                await self.rate_limiter.acquire()
+            result = await self._send(item)
+        except Exception as e:
+            result = {"success": False, "error": str(e), "retryable": True}
+
+        if result.get("success"):
+            await self.outbox.mark_sent(item, result.get("response"))
+            self.sent += 1
+            if item["kind"] == "renewal_validation":
+                await self._after_validation(item, result.get("response", {}))
+            return
+
+        retried = await self.outbox.mark_failed(item, result.get("error"), result.get("retryable", True))
+        if retried:
+            self.retried += 1
+        else:
+            self.failed += 1
+            print(f"Giving up on outbox item {item['_id']} ({item['kind']}) for request {item['request_id']}: {result.get('error')}")
+
+    async def _send(self, item: Dict[str, Any]) -> Dict[str, Any]:
+        payload = item["payload"]
+        if item["kind"] == "text":
+            return await send_text_message(item["phone_number"], payload["message"])
+        if item["kind"] == "insurance_selection":
+            return await send_insurance_type_selection(item["phone_number"])
+        if item["kind"] == "renewal_validation":
+            return await call_renewal_validation_api(item["request_id"], payload["chassis_no"], payload["bearer_token"])
+        return {"success": False, "error": f"Unknown outbox item kind: {item['kind']}", "retryable": False}
+
+    async def _after_validation(self, item: Dict[str, Any], validation_response: Dict[str, Any]):
+        if validation_response.get("status") == "success" and validation_response.get("responseCode") == "1":
+            print(f"Renewal validation successful for request_id: {item['request_id']}")
+            await self.outbox.enqueue([{
+                "request_id": item["request_id"],
+                "phone_number": item["phone_number"],
+                "kind": "insurance_selection"
+            }], after=item)
+        else:
+            print(f"Renewal validation failed: {validation_response}")
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "sent": self.sent,
+            "retried": self.retried,
+            "failed": self.failed,
+            "batches": self.batches,
+            "rate_limit_waits": self.rate_limiter.waits
+        }
+
+
+def notification_items(
+    request_id: str,
+    client_name: str,
+    phone_number: str,
+    structured_data: Dict[str, Any],
+    authorization: Optional[str] = None
+) -> List[Dict[str, Any]]:
+    """
+    Outbox items for a processed request: the extraction summary, then renewal
+    validation (the insurance selection message is queued when validation passes)
+    """
+    qatar_id_data = dict(structured_data.get("qatar_id", {}))
+    istimara_data = dict(structured_data.get("istimara", {}))
+    items = [{
+        "request_id": request_id,
+        "phone_number": phone_number,
+        "kind": "text",
+        "payload": {"message": format_extraction_message(request_id, client_name, qatar_id_data, istimara_data)}
+    }]
+
+    chassis_no = istimara_data.get("vehicle_chassis_no")
+    if chassis_no and authorization:
+        bearer_token = authorization.replace("Bearer ", "") if authorization.startswith("Bearer ") else authorization
+        items.append({
+            "request_id": request_id,
+            "phone_number": phone_number,
+            "kind": "renewal_validation",
+            "payload": {"chassis_no": chassis_no, "bearer_token": bearer_token}
+        })
+    return items
+
+
+async def run_dispatcher():
+    """Run a standalone dispatcher until interrupted"""
+    from resources import build_registry
+
+    resources = build_registry(["mongo", "http"])
+    await resources.start()
+    from pipeline import outbox
+
+    dispatcher = OutboxDispatcher(outbox)
+    dispatcher.start()
+    print("Started outbox dispatcher")
+    try:
+        await dispatcher.join()
+    finally:
+        await dispatcher.stop()
+        await resources.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(run_dispatcher())
@@ -0,0 +1,107 @@
+"""
+Keyword and layout classifier for OCR'd pages.
+
+Each page is labelled Qatar ID front, Qatar ID back, Istimara or other from the
+labels and number formats Vision read on it, so every document type can be
+extracted with its own schema from only its own pages.
+"""
+from typing import List, Dict, Any, Tuple
+import os
+import re
+
+from compaction import normalize_line
+from rule_extractor import QID, VIN, DATE
+
+# "split" extracts each document type from its own pages with its own schema,
+# "combined" sends every page in one call with the combined schema
+EXTRACTION_CALLS = os.getenv("EXTRACTION_CALLS", "split").lower()
+# Min score for a page to count as a document type, below it the page is "other"
+PAGE_CLASSIFIER_MIN_SCORE = int(os.getenv("PAGE_CLASSIFIER_MIN_SCORE", "3"))
+
+# Page type and the document it belongs to
+PAGE_TYPES = {
+    "qatar_id_front": "qatar_id",
+    "qatar_id_back": "qatar_id",
+    "istimara": "istimara",
+}
+
+# Labels and titles printed on each side of the cards. Each distinct one found counts once.
+PAGE_KEYWORDS = {
+    "qatar_id_front": [
+        "residency permit", "رخصة إقامة", "id no", "id.no", "d.o.b", "date of birth", "تاريخ الميلاد",
+        "الرقم الشخصي", "occupation", "المهنة", "الصلاحية",
+    ],
+    "qatar_id_back": [
+        "passport number", "passport no", "passport expiry", "رقم الجواز", "تاريخ انتهاء الجواز",
+        "serial no", "serial number", "الرقم التسلسلي", "employer", "صاحب العمل", "director general of passports",
+    ],
+    "istimara": [
+        "vehicle registration", "رخصة سير", "plate no", "رقم اللوحة", "chassis", "رقم الشاصي", "engine no",
+        "رقم المحرك", "make", "model", "cylinders", "seats", "body type", "owner", "المالك",
+        "general directorate of traffic", "الإدارة العامة للمرور", "policy",
+    ],
+}
+
+KEYWORD_PATTERNS = {
+    page_type: re.compile(
+        r"(?<!\w)(" + "|".join(re.escape(keyword) for keyword in sorted(keywords, key=len, reverse=True)) + r")(?!\w)",
+        re.IGNORECASE
+    )
+    for page_type, keywords in PAGE_KEYWORDS.items()
+}
+
+QID_PATTERN = re.compile(rf"(?<![A-Za-z0-9]){QID}(?![A-Za-z0-9])")
+VIN_PATTERN = re.compile(rf"(?<![A-Za-z0-9]){VIN}(?![A-Za-z0-9])")
+DATE_PATTERN = re.compile(DATE)
+
+
+def page_scores(text: str) -> Dict[str, int]:
+    """Distinct keywords of each page type found on the page, plus layout cues"""
+    lines = [normalize_line(line) for line in text.splitlines()]
+    page = "\n".join(line for line in lines if line)
+    scores = {
+        page_type: len({match.casefold() for match in pattern.findall(page)})
+        for page_type, pattern in KEYWORD_PATTERNS.items()
+    }
+    # A 17-character VIN only appears on the Istimara; a QID with two or more
+    # dates (birth, expiry) is the layout of the ID front
+    if VIN_PATTERN.search(page):
+        scores["istimara"] += 2
+    if QID_PATTERN.search(page) and len(DATE_PATTERN.findall(page)) >= 2:
+        scores["qatar_id_front"] += 1
+    return scores
+
+
+def classify_page(text: str, min_score: int = PAGE_CLASSIFIER_MIN_SCORE) -> Dict[str, Any]:
+    """
+    Label a page with its best scoring type, or "other" when no type reaches
+    min_score. A page goes to every document with a type reaching min_score,
+    so a scan of both cards on one page is given to both extractions.
+    """
+    scores = page_scores(text)
+    page_type = max(scores, key=scores.get)
+    if scores[page_type] < min_score:
+        page_type = "other"
+    documents = []
+    for candidate, score in sorted(scores.items(), key=lambda item: item[1], reverse=True):
+        document = PAGE_TYPES[candidate]
+        if score >= min_score and document not in documents:
+            documents.append(document)
+    return {"type": page_type, "documents": documents, "scores": scores}
+
+
+def group_pages(files: List[Tuple[str, List[str]]]) -> Tuple[Dict[str, List[str]], List[Dict[str, Any]]]:
+    """
+    Classify the OCR text of every page of every file, given as (file_name, page_texts).
+    Returns the page texts of each document (pages of other types are dropped)
+    and the per-page classification.
+    """
+    documents = {document: [] for document in set(PAGE_TYPES.values())}
+    pages = []
+    for file_name, page_texts in files:
+        for page_number, text in enumerate(page_texts, 1):
+            page = classify_page(text)
+            for document in page["documents"]:
+                documents[document].append(text)
+            pages.append({"file_name": file_name, "page": page_number, **page})
+    return documents, pages
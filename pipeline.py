@@ -0,0 +1,512 @@
+from fastapi import HTTPException
+from typing import Optional, List, Dict, Any
+from datetime import datetime
+
+from dotenv import load_dotenv
+import os
+import asyncio
+import uuid
+
+from ocr import GCPHelper, vision_client_pool, choose_ocr_mode, OCR_CONCURRENCY, OCR_BATCH_SIZE
+from llm_response import extract_document_info_memoized, extract_documents_memoized
+from pymongo import IndexModel
+from pymongo.errors import DuplicateKeyError
+from database import MongoDB, CRUDOperations
+from cache import ResultCache
+from preprocessing import PREPROCESS_ENABLED, pdf_render_scale
+from cpu_pool import cpu_pool
+from card_detection import CARD_DETECTION_ENABLED
+from triage import TRIAGE_ENABLED, PageTriage
+from jobs import JobQueue
+from stages import Stage, StageGraph, StageSkipped
+from outbox import NOTIFICATION_MODE, Outbox, notification_items
+from idempotency import IdempotencyStore
+from uploads import RssSampler, document_source, document_size, read_document
+from metrics import span, pages_processed
+from compaction import COMPACTION_ENABLED, compact_texts
+from rule_extractor import EXTRACTION_MODE, extract_document_info_fast
+from page_classifier import EXTRACTION_CALLS, group_pages
+from helper_functions import *
+from whatsapp_func import *
+
+load_dotenv()
+# Initialize database connection
+mongo_connection = os.getenv("MONGO_DB_URI")
+mongo_db_name = os.getenv("MONGO_DB_NAME")
+BACKEND_BASEURL = os.getenv("BACKEND_BASEURL")
+
+mongodb = MongoDB(mongo_connection, mongo_db_name)
+
+# Initialize CRUD operations for different collections, with the indexes
+# created at startup for the fields they are queried by (one document per
+# request_id, see upsert_by_request_id)
+documents_crud = CRUDOperations(mongodb, "documents", indexes=[IndexModel("request_id", unique=True)])
+qatar_ids_crud = CRUDOperations(mongodb, "qatar_ids", indexes=[IndexModel("request_id", unique=True), IndexModel("id_no")])
+istimaras_crud = CRUDOperations(mongodb, "istimaras", indexes=[
+    IndexModel("request_id", unique=True),
+    IndexModel("owner_qid"),
+    IndexModel("vehicle_chassis_no")
+])
+requests_crud = CRUDOperations(mongodb, "requests", indexes=[IndexModel("request_id")])
+
+# OCR results cache, keyed by page content (memory LRU in front of MongoDB)
+ocr_cache = ResultCache(
+    "ocr",
+    max_entries=int(os.getenv("OCR_CACHE_MAX_ENTRIES", "2048")),
+    ttl_seconds=int(os.getenv("OCR_CACHE_TTL_SECONDS", str(30 * 24 * 3600))),
+    crud=CRUDOperations(mongodb, "ocr_cache"),
+    bypass=os.getenv("OCR_CACHE_BYPASS", "false").lower() == "true"
+)
+
+# Structured extraction cache, keyed by normalized OCR text, model and schema version
+extraction_cache = ResultCache(
+    "extraction",
+    max_entries=int(os.getenv("EXTRACTION_CACHE_MAX_ENTRIES", "1024")),
+    ttl_seconds=int(os.getenv("EXTRACTION_CACHE_TTL_SECONDS", str(30 * 24 * 3600))),
+    crud=CRUDOperations(mongodb, "extraction_cache"),
+    bypass=os.getenv("EXTRACTION_CACHE_BYPASS", "false").lower() == "true"
+)
+
+# Shared GCP OCR helper (uses the process-wide Vision client pool)
+gcp_helper = GCPHelper(cache=ocr_cache)
+
+# Queue for async /ocr-processing jobs (kept in the requests collection)
+job_queue = JobQueue(requests_crud)
+
+# WhatsApp messages and renewal validation calls waiting for the dispatcher
+outbox = Outbox(CRUDOperations(mongodb, "outbox"))
+
+# Running and completed /ocr-processing requests, for duplicates of a request_id
+idempotency = IdempotencyStore(CRUDOperations(mongodb, "idempotency"))
+
+
+async def read_stage(ctx: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """
+    Open every uploaded file: page count and OCR mode, card detection and
+    preprocessing of photos, triage. PDF pages are rasterized lazily, while
+    the OCR stage consumes them.
+    """
+    # Triage state is shared by every file, so duplicates are found across files
+    page_triage = PageTriage() if TRIAGE_ENABLED else None
+    
+    # Collect pages from every uploaded file first, so that all of them
+    # can be OCR'd concurrently instead of one page after another
+    files_pages = []
+    for document in ctx["documents"]:
+        # Spooled uploads are opened from their path, small ones from memory
+        file_content = document_source(document)
+        file_name = document["file_name"]
+        file_size = document_size(document)
+        mime_type = document["mime_type"]
+        
+        pages = []
+        pdf_pages = None
+        page_stats = []
+        triage_decisions = []
+        
+        # Check if PDF or image
+        if mime_type == "application/pdf":
+            # Counted at admission already for synchronous requests
+            page_count = document.get("page_count") or await asyncio.to_thread(get_pdf_page_count, file_content)
+            ocr_mode = choose_ocr_mode(mime_type, page_count, file_size)
+            if ocr_mode != "pdf":
+                # Pages are rasterized lazily, one at a time, as OCR consumes them
+                # (in the CPU pool, a few pages ahead of OCR)
+                print(f"Converting PDF to images: {file_name}")
+                pages = cpu_pool.pdf_pages(
+                    file_content,
+                    page_count,
+                    scale=pdf_render_scale() if PREPROCESS_ENABLED else PDF_RENDER_SCALE,
+                    preprocess=PREPROCESS_ENABLED,
+                    page_stats=page_stats
+                )
+        else:
+            # Assume it's an image. Each card found in the photo becomes its own page.
+            try:
+                with span("read.prepare_image", request_id=ctx["request_id"], file_name=file_name):
+                    pages, page_stats = await cpu_pool.prepare_image(
+                        file_content,
+                        detect_cards=CARD_DETECTION_ENABLED,
+                        preprocess=PREPROCESS_ENABLED
+                    )
+            except Exception as e:
+                print(f"Error opening image {file_name}: {e}")
+                continue
+            page_count = len(pages)
+            ocr_mode = choose_ocr_mode(mime_type, page_count, file_size)
+        
+        # Drop blank and duplicate pages (and flag blurry ones) before OCR
+        if page_triage is not None:
+            if ocr_mode == "pdf":
+                pdf_pages = await asyncio.to_thread(
+                    page_triage.triage_pdf, file_content, file_name, triage_decisions
+                )
+            else:
+                pages = page_triage.filter_pages(pages, file_name, triage_decisions)
+        
+        files_pages.append({
+            "file_name": file_name,
+            "file_size": file_size,
+            "mime_type": mime_type,
+            "ocr_mode": ocr_mode,
+            "page_count": page_count,
+            "document": document,
+            "pages": pages,
+            "pdf_pages": pdf_pages,
+            "page_stats": page_stats,
+            "triage": triage_decisions
+        })
+    
+    return files_pages
+
+
+async def ocr_stage(ctx: Dict[str, Any]) -> Dict[str, Any]:
+    """OCR the pages of every file. Returns the combined text and the files info."""
+    files_pages = ctx["read"]
+    
+    # Process all files with GCP OCR concurrently, sharing one
+    # OCR_CONCURRENCY bound across every Vision call of the request
+    ocr_semaphore = asyncio.Semaphore(OCR_CONCURRENCY)
+    ocr_tasks = []
+    for file_pages in files_pages:
+        print(f"Processing {file_pages['page_count']} pages from {file_pages['file_name']} ({file_pages['ocr_mode']} mode)")
+        if file_pages["ocr_mode"] == "pdf":
+            # Vision takes the PDF bytes, read only now (native PDFs are the small ones)
+            pdf_bytes = await asyncio.to_thread(read_document, file_pages["document"])
+            ocr_tasks.append(gcp_helper.extract_text_from_pdf(
+                pdf_bytes, file_pages["page_count"],
+                semaphore=ocr_semaphore, pages=file_pages["pdf_pages"]
+            ))
+        else:
+            batch_size = OCR_BATCH_SIZE if file_pages["ocr_mode"] == "batch" else 1
+            ocr_tasks.append(gcp_helper.extract_text_from_images(
+                file_pages["pages"], batch_size=batch_size, semaphore=ocr_semaphore
+            ))
+    files_ocr_results = await asyncio.gather(*ocr_tasks)
+    
+    # Reassemble results in the original file and page order
+    all_extracted_text = ""
+    file_texts = []
+    page_texts = []
+    processed_files_info = []
+    for file_pages, file_results in zip(files_pages, files_ocr_results):
+        file_text = ""
+        for extracted_text, confidence in file_results:
+            file_text += extracted_text + "\n"
+        
+        all_extracted_text += file_text + "\n\n"
+        file_texts.append(file_text)
+        pages_processed.inc(len(file_results), mode=file_pages["ocr_mode"])
+        page_texts.append([extracted_text for extracted_text, confidence in file_results])
+        
+        # Store file info
+        file_info = {
+            "file_name": file_pages["file_name"],
+            "file_size": file_pages["file_size"],
+            "mime_type": file_pages["mime_type"],
+            "ocr_mode": file_pages["ocr_mode"],
+            "pages_processed": len(file_results),
+            "extracted_text_length": len(file_text)
+        }
+        cards = [stats["card"] for stats in file_pages["page_stats"] if stats.get("card")]
+        if cards:
+            file_info["cards_detected"] = len(cards)
+        if file_pages["page_stats"]:
+            file_info["upload_bytes"] = sum(stats["upload_bytes"] for stats in file_pages["page_stats"])
+            saved = [stats.get("bytes_saved") for stats in file_pages["page_stats"]]
+            if None not in saved:
+                file_info["bytes_saved"] = sum(saved)
+            file_info["preprocessing"] = file_pages["page_stats"]
+        if file_pages["triage"]:
+            file_info["pages_skipped"] = sum(1 for decision in file_pages["triage"] if decision["action"] == "skipped")
+            file_info["triage"] = file_pages["triage"]
+        processed_files_info.append(file_info)
+    
+    print(f"Total extracted text length: {len(all_extracted_text)}")
+    return {"text": all_extracted_text, "texts": file_texts, "page_texts": page_texts, "files_info": processed_files_info}
+
+
+async def classify_stage(ctx: Dict[str, Any]) -> Dict[str, List[str]]:
+    """Sort the OCR'd pages into Qatar ID and Istimara pages, dropping the rest"""
+    if EXTRACTION_CALLS != "split":
+        raise StageSkipped("combined extraction")
+    files = [
+        (file_info["file_name"], texts)
+        for file_info, texts in zip(ctx["ocr"]["files_info"], ctx["ocr"]["page_texts"])
+    ]
+    documents, pages = group_pages(files)
+    if not any(documents.values()):
+        raise StageSkipped("no page classified")
+    print(f"Classified pages: {[page['type'] for page in pages]}")
+    ctx["response"]["classification"] = [
+        {key: page[key] for key in ("file_name", "page", "type", "documents")} for page in pages
+    ]
+    return documents
+
+
+async def compact_stage(ctx: Dict[str, Any]):
+    """
+    Shrink the OCR text to what the extraction prompt needs.
+    Once pages are classified, the text of each document is compacted on its own.
+    """
+    if not COMPACTION_ENABLED:
+        raise StageSkipped("compaction disabled")
+    if ctx.get("classify"):
+        compacted, compaction_stats = {}, {}
+        for document, texts in ctx["classify"].items():
+            compacted[document], compaction_stats[document] = compact_texts(texts)
+        ctx["response"]["compaction"] = compaction_stats
+        return compacted
+    compacted_text, compaction_stats = compact_texts(ctx["ocr"]["texts"])
+    print(f"Compacted OCR text: {compaction_stats['tokens_before']} -> {compaction_stats['tokens_after']} estimated tokens")
+    ctx["response"]["compaction"] = compaction_stats
+    return compacted_text
+
+
+async def extract_stage(ctx: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Structured extraction of the OCR text, with the rules first (EXTRACTION_MODE=rules)
+    or ChatGPT only. Classified pages give one text and one call per document type.
+    """
+    if ctx.get("classify"):
+        context = ctx.get("compact") or {document: "\n".join(texts) for document, texts in ctx["classify"].items()}
+    else:
+        context = ctx.get("compact") or ctx["ocr"]["text"]
+    if EXTRACTION_MODE == "rules":
+        print("Extracting structured data with rules...")
+        structured_data, extraction_report = await extract_document_info_fast(context, cache=extraction_cache)
+    elif isinstance(context, dict):
+        print("Extracting structured data using ChatGPT, one call per document type...")
+        structured_data = await extract_documents_memoized(context, cache=extraction_cache)
+        extraction_report = {"mode": "llm", "llm_called": True, "calls": sum(1 for text in context.values() if text)}
+    else:
+        print("Extracting structured data using ChatGPT...")
+        structured_data = await extract_document_info_memoized(context, cache=extraction_cache)
+        extraction_report = {"mode": "llm", "llm_called": True, "calls": 1}
+    ctx["response"]["extraction"] = extraction_report
+    
+    # Check for errors in extraction
+    if "error" in structured_data:
+        raise HTTPException(
+            status_code=500, 
+            detail=f"ChatGPT extraction failed: {structured_data.get('refusal_message', 'Unknown error')}"
+        )
+    return structured_data
+
+
+async def upsert_by_request_id(crud: CRUDOperations, request_id: str, data: Dict[str, Any]) -> str:
+    """Store the document of a request, replacing the fields of an earlier run of the same request_id"""
+    update = {"$set": {**data, "request_id": request_id, "updated_at": datetime.utcnow().isoformat()}}
+    try:
+        document = await crud.find_one_and_update({"request_id": request_id}, update, upsert=True)
+    except DuplicateKeyError:
+        # A concurrent run inserted it first (request_id is unique), update that one
+        document = await crud.find_one_and_update({"request_id": request_id}, update)
+    return document["_id"]
+
+
+async def persist_qatar_id_stage(ctx: Dict[str, Any]) -> str:
+    qatar_id_data = dict(ctx["extract"].get("qatar_id", {}))
+    qatar_id_id = await upsert_by_request_id(qatar_ids_crud, ctx["request_id"], qatar_id_data)
+    print(f"Qatar ID stored with ID: {qatar_id_id}")
+    return qatar_id_id
+
+
+async def persist_istimara_stage(ctx: Dict[str, Any]) -> str:
+    istimara_data = dict(ctx["extract"].get("istimara", {}))
+    istimara_id = await upsert_by_request_id(istimaras_crud, ctx["request_id"], istimara_data)
+    print(f"Istimara stored with ID: {istimara_id}")
+    return istimara_id
+
+
+async def notify_stage(ctx: Dict[str, Any]) -> Dict[str, Any]:
+    """Send the extracted information to the client on WhatsApp"""
+    response = ctx["response"]
+    phone_number = ctx["phone_number"]
+    try:
+        whatsapp_message = format_extraction_message(
+            request_id=ctx["request_id"],
+            client_name=ctx["client_name"],
+            qatar_id_data=dict(ctx["extract"].get("qatar_id", {})),
+            istimara_data=dict(ctx["extract"].get("istimara", {}))
+        )
+        whatsapp_result = await send_text_message(phone_number, whatsapp_message)
+    except Exception as e:
+        print(f"Error sending WhatsApp message: {e}")
+        response["whatsapp_sent"] = False
+        response["whatsapp_error"] = str(e)
+        raise
+    
+    if not whatsapp_result.get("success"):
+        print(f"Failed to send WhatsApp message: {whatsapp_result.get('error')}")
+        response["whatsapp_sent"] = False
+        response["whatsapp_error"] = whatsapp_result.get("error")
+        raise RuntimeError(f"Failed to send WhatsApp message: {whatsapp_result.get('error')}")
+    
+    print(f"WhatsApp message sent successfully to {phone_number}")
+    response["whatsapp_sent"] = True
+    return whatsapp_result
+
+
+async def validate_stage(ctx: Dict[str, Any]) -> bool:
+    """Call renewal validation once the documents are stored. Returns True when validation passed."""
+    response = ctx["response"]
+    request_id = ctx["request_id"]
+    authorization = ctx["authorization"]
+    chassis_no = dict(ctx["extract"].get("istimara", {})).get("vehicle_chassis_no")
+    
+    if not chassis_no or not authorization:
+        if not chassis_no:
+            print("Chassis number not found in extracted data")
+            response["renewal_validation"] = "skipped_no_chassis"
+        if not authorization:
+            print("Authorization header not provided")
+            response["renewal_validation"] = "skipped_no_auth"
+        raise StageSkipped(response["renewal_validation"])
+    
+    # Extract bearer token from Authorization header
+    bearer_token = authorization.replace("Bearer ", "") if authorization.startswith("Bearer ") else authorization
+    
+    print(f"Calling renewal validation API with request_id: {request_id}, chassis_no: {chassis_no}")
+    validation_result = await call_renewal_validation_api(request_id, chassis_no, bearer_token)
+    
+    if not validation_result.get("success"):
+        print(f"Error calling renewal validation API: {validation_result.get('error')}")
+        response["renewal_validation"] = "error"
+        response["renewal_validation_error"] = validation_result.get("error")
+        raise RuntimeError(f"Error calling renewal validation API: {validation_result.get('error')}")
+    
+    validation_response = validation_result.get("response", {})
+    if validation_response.get("status") == "success" and validation_response.get("responseCode") == "1":
+        print(f"Renewal validation successful for request_id: {request_id}")
+        response["renewal_validation"] = "success"
+        return True
+    
+    print(f"Renewal validation failed: {validation_response}")
+    response["renewal_validation"] = "failed"
+    response["renewal_validation_response"] = validation_response
+    return False
+
+
+async def insurance_selection_stage(ctx: Dict[str, Any]) -> Dict[str, Any]:
+    """Ask for the insurance type, after the summary message and a successful validation"""
+    if not ctx["validate"]:
+        raise StageSkipped("renewal validation failed")
+    
+    response = ctx["response"]
+    phone_number = ctx["phone_number"]
+    insurance_selection_result = await send_insurance_type_selection(phone_number)
+    
+    if not insurance_selection_result.get("success"):
+        print(f"Failed to send insurance selection message: {insurance_selection_result.get('error')}")
+        response["insurance_selection_sent"] = False
+        response["insurance_selection_error"] = insurance_selection_result.get("error")
+        raise RuntimeError(f"Failed to send insurance selection message: {insurance_selection_result.get('error')}")
+    
+    print(f"Insurance type selection message sent to {phone_number}")
+    response["insurance_selection_sent"] = True
+    return insurance_selection_result
+
+
+async def enqueue_notifications_stage(ctx: Dict[str, Any]) -> List[str]:
+    """Queue the WhatsApp messages and renewal validation in the outbox"""
+    items = notification_items(
+        ctx["request_id"], ctx["client_name"], ctx["phone_number"], ctx["extract"], ctx["authorization"]
+    )
+    # Keyed on the execution: an execution taken over after its worker died
+    # does not queue them twice, a new request with the same request_id does
+    queued = await outbox.enqueue(items, execution_id=ctx["execution_id"])
+    if len(queued) < len(items):
+        print(f"Notifications of request {ctx['request_id']} already queued by this execution")
+    ctx["response"]["notifications"] = {
+        "mode": "outbox",
+        "queued": [item["kind"] for item in queued],
+        "status_url": f"/requests/{ctx['request_id']}/notifications"
+    }
+    return [item["_id"] for item in queued]
+
+
+# Stages of one request. Each starts when the stages it requires are done,
+# e.g. both inserts and the WhatsApp summary run at the same time.
+PIPELINE_STAGES = [
+    Stage("read", read_stage),
+    Stage("ocr", ocr_stage, requires=["read"]),
+    Stage("classify", classify_stage, requires=["ocr"], critical=False),
+    Stage("compact", compact_stage, requires=["ocr"], critical=False, after=["classify"]),
+    # Falls back to one combined call when classification fails, and to the
+    # raw OCR text when compaction fails
+    Stage("extract", extract_stage, requires=["ocr"], after=["classify", "compact"]),
+    Stage("persist_qatar_id", persist_qatar_id_stage, requires=["extract"]),
+    Stage("persist_istimara", persist_istimara_stage, requires=["extract"]),
+]
+if NOTIFICATION_MODE == "inline":
+    # Notification and validation stages are not critical: when one fails, only
+    # the stages that depend on it are skipped
+    PIPELINE_STAGES += [
+        Stage("notify", notify_stage, requires=["extract"], critical=False),
+        Stage("validate", validate_stage, requires=["persist_qatar_id", "persist_istimara"], critical=False),
+        Stage("insurance_selection", insurance_selection_stage, requires=["notify", "validate"], critical=False),
+    ]
+else:
+    # Queued once the documents are stored, delivered by the outbox dispatcher
+    PIPELINE_STAGES.append(
+        Stage("enqueue_notifications", enqueue_notifications_stage, requires=["persist_qatar_id", "persist_istimara"])
+    )
+PIPELINE = StageGraph(PIPELINE_STAGES)
+
+
+async def process_documents(
+    request_id: str,
+    client_name: str,
+    phone_number: str,
+    documents: List[Dict[str, Any]],
+    authorization: Optional[str] = None,
+    execution_id: Optional[str] = None
+) -> Dict[str, Any]:
+    """
+    Run the whole OCR pipeline for one request:
+    - documents are dicts with file_name, mime_type and content (bytes) or
+      path (spooled upload, see uploads.spool_form)
+    - execution_id identifies this run of the request across retries of it
+      (the idempotency execution or the job id), a new one when not given
+    - OCR with GCP Vision, structured extraction with ChatGPT
+    - stores Qatar ID and Istimara in MongoDB
+    - sends WhatsApp messages and calls renewal validation (or queues them in the outbox)
+    Returns the response data, with per-stage timings. Raises HTTPException
+    on client or extraction errors.
+    """
+    if not documents:
+        raise HTTPException(status_code=400, detail="No files uploaded")
+    
+    ctx = {
+        "request_id": request_id,
+        "client_name": client_name,
+        "phone_number": phone_number,
+        "documents": documents,
+        "authorization": authorization,
+        "execution_id": execution_id or uuid.uuid4().hex,
+        # Filled in by the notification stages
+        "response": {}
+    }
+    with span("pipeline", request_id=request_id):
+        async with RssSampler() as rss_sampler:
+            stage_timings = await PIPELINE.run(ctx)
+    
+    structured_data = ctx["extract"]
+    response_data = {
+        "success": True,
+        "request_id": request_id,
+        "client_name": client_name,
+        "phone_number": phone_number,
+        "files_processed": len(documents),
+        "files_info": ctx["ocr"]["files_info"],
+        "extracted_data": {
+            "qatar_id": dict(structured_data.get("qatar_id", {})),
+            "istimara": dict(structured_data.get("istimara", {}))
+        }
+    }
+    response_data.update(ctx["response"])
+    response_data["stage_timings"] = stage_timings
+    response_data["memory"] = rss_sampler.report()
+    
+    return response_data
@@ -0,0 +1,248 @@
+from pydantic import BaseModel, Field
+from typing import Dict, Any, List, Tuple, Union
+from PIL import Image, ImageOps, ImageStat
+import cv2
+import fitz
+import io
+import numpy as np
+import os
+import time
+
+from helper_functions import VISION_IMAGE_FORMATS, image_upload_bytes, open_image, read_image_bytes
+from card_detection import split_cards
+
+
+class PreprocessProfile(BaseModel):
+    """How a page is resized and encoded before it is uploaded to Vision"""
+    target_long_edge: int = Field(default=1600, description="Downscale so the long edge is at most this many pixels (0 = keep size)")
+    pdf_dpi: int = Field(default=150, description="Render resolution for rasterized PDF pages")
+    grayscale: str = Field(default="auto", description="auto (only when colour carries no text contrast), always or never")
+    codec: str = Field(default="auto", description="auto (PNG for line art, JPEG otherwise), jpeg, webp or png")
+    jpeg_quality: int = Field(default=85, description="JPEG quality")
+    webp_quality: int = Field(default=80, description="WebP quality")
+
+
+# Profiles per document type. Card-sized documents (Qatar ID, Istimara) keep
+# ~30 px high body text at a 1600 px long edge, which is plenty for Vision.
+PREPROCESS_PROFILES = {
+    "image": PreprocessProfile(
+        target_long_edge=int(os.getenv("PREPROCESS_IMAGE_LONG_EDGE", "1600")),
+        codec=os.getenv("PREPROCESS_IMAGE_CODEC", "auto"),
+        jpeg_quality=int(os.getenv("PREPROCESS_JPEG_QUALITY", "85"))
+    ),
+    "pdf": PreprocessProfile(
+        pdf_dpi=int(os.getenv("PREPROCESS_PDF_DPI", "150")),
+        codec=os.getenv("PREPROCESS_PDF_CODEC", "png")
+    )
+}
+
+PREPROCESS_ENABLED = os.getenv("PREPROCESS_ENABLED", "true").lower() == "true"
+
+# Below this mean saturation (0-255) a page is treated as colourless
+GRAYSCALE_MAX_SATURATION = 40
+# Above this luminance spread the grayscale page still has enough text contrast
+GRAYSCALE_MIN_CONTRAST = 45
+# Pages with at most this many distinct colours are treated as line art
+LINE_ART_MAX_COLORS = 64
+
+
+def _grayscale_is_safe(img: Image.Image) -> bool:
+    """Grayscale is safe when the page is nearly colourless, or still has strong luminance contrast"""
+    thumb = img.copy()
+    thumb.thumbnail((256, 256))
+    saturation = ImageStat.Stat(thumb.convert("HSV")).mean[1]
+    if saturation <= GRAYSCALE_MAX_SATURATION:
+        return True
+    return ImageStat.Stat(thumb.convert("L")).stddev[0] >= GRAYSCALE_MIN_CONTRAST
+
+
+def _is_line_art(img: Image.Image) -> bool:
+    thumb = img.copy()
+    thumb.thumbnail((256, 256))
+    return thumb.getcolors(LINE_ART_MAX_COLORS) is not None
+
+
+def _encode(img: Image.Image, codec: str, profile: PreprocessProfile) -> bytes:
+    output = io.BytesIO()
+    if codec == "jpeg":
+        img.save(output, format="JPEG", quality=profile.jpeg_quality, optimize=True)
+    elif codec == "webp":
+        img.save(output, format="WEBP", quality=profile.webp_quality, method=4)
+    else:
+        img.save(output, format="PNG", optimize=False)
+    return output.getvalue()
+
+
+def preprocess_pixels(img: Image.Image, profile: PreprocessProfile = None, original_bytes: bytes = None) -> Tuple[bytes, Dict[str, Any]]:
+    """
+    Resize and re-encode an already decoded (and upright) page for OCR:
+    - downscales to profile.target_long_edge (never upscales)
+    - converts to grayscale where that is safe
+    - encodes with a compact codec (JPEG/WebP for photos, PNG for line art)
+    When original_bytes are given and the result is not smaller, they are uploaded instead.
+    Returns (upload_bytes, stats).
+    """
+    profile = profile or PREPROCESS_PROFILES["image"]
+    started = time.perf_counter()
+
+    if img.mode not in ("RGB", "L"):
+        img = img.convert("RGB")
+
+    long_edge = max(img.size)
+    if profile.target_long_edge and long_edge > profile.target_long_edge:
+        ratio = profile.target_long_edge / long_edge
+        img = img.resize(
+            (max(1, round(img.width * ratio)), max(1, round(img.height * ratio))),
+            Image.LANCZOS
+        )
+
+    grayscale = img.mode == "L" or profile.grayscale == "always" or (
+        profile.grayscale == "auto" and _grayscale_is_safe(img)
+    )
+    if grayscale and img.mode != "L":
+        img = img.convert("L")
+
+    codec = profile.codec
+    if codec == "auto":
+        codec = "png" if _is_line_art(img) else "jpeg"
+
+    output = _encode(img, codec, profile)
+    kept_original = original_bytes is not None and len(output) >= len(original_bytes)
+    if kept_original:
+        output = original_bytes
+
+    original_size = len(original_bytes) if original_bytes is not None else None
+    stats = {
+        "original_bytes": original_size,
+        "upload_bytes": len(output),
+        "bytes_saved": original_size - len(output) if original_size is not None else None,
+        "width": img.width,
+        "height": img.height,
+        "grayscale": grayscale,
+        "codec": "original" if kept_original else codec,
+        "encode_ms": round((time.perf_counter() - started) * 1000, 2)
+    }
+    return output, stats
+
+
+def _original_usable(image_bytes: Union[bytes, str]) -> bool:
+    """The uploaded bytes can be sent as-is if Vision reads the format and no EXIF rotation is needed"""
+    with open_image(image_bytes) as original:
+        return original.format in VISION_IMAGE_FORMATS and original.getexif().get(0x0112, 1) == 1
+
+
+def preprocess_image(image_bytes: Union[bytes, str], profile: PreprocessProfile = None) -> Tuple[bytes, Dict[str, Any]]:
+    """
+    Decode an uploaded image, given as bytes or a file path (applying EXIF
+    orientation) and preprocess it with preprocess_pixels. Returns (upload_bytes, stats).
+    """
+    with open_image(image_bytes) as original:
+        img = ImageOps.exif_transpose(original)
+        img.load()
+    original_bytes = read_image_bytes(image_bytes) if _original_usable(image_bytes) else None
+    return preprocess_pixels(img, profile, original_bytes)
+
+
+def _encoded_buffer(image_bytes: Union[bytes, str]) -> np.ndarray:
+    """The encoded image as a uint8 array for cv2.imdecode, memory-mapped when given a file path"""
+    if isinstance(image_bytes, str):
+        return np.memmap(image_bytes, dtype=np.uint8, mode="r")
+    return np.frombuffer(image_bytes, dtype=np.uint8)
+
+
+def prepare_image(
+    image_bytes: Union[bytes, str],
+    profile: PreprocessProfile = None,
+    detect_cards: bool = True,
+    preprocess: bool = True
+) -> Tuple[List[bytes], List[Dict[str, Any]]]:
+    """
+    Turn one uploaded photo (bytes or file path) into upload-ready pages:
+    every card found in the frame is perspective-corrected and cropped into
+    its own page, otherwise the full frame is used. Each page is preprocessed (or PNG-encoded when
+    preprocess is False) exactly once. Returns (pages, per-page stats).
+    """
+    if detect_cards:
+        # cv2 applies EXIF orientation while decoding
+        frame = cv2.imdecode(_encoded_buffer(image_bytes), cv2.IMREAD_COLOR)
+        cards = split_cards(frame) if frame is not None else []
+        if cards:
+            pages, pages_stats = [], []
+            for card_number, card in enumerate(cards, start=1):
+                img = Image.fromarray(cv2.cvtColor(card, cv2.COLOR_BGR2RGB))
+                if preprocess:
+                    page, stats = preprocess_pixels(img, profile)
+                else:
+                    page = _encode(img, "png", profile or PREPROCESS_PROFILES["image"])
+                    stats = {"upload_bytes": len(page), "codec": "png"}
+                stats["card"] = card_number
+                pages.append(page)
+                pages_stats.append(stats)
+            return pages, pages_stats
+
+    if preprocess:
+        page, stats = preprocess_image(image_bytes, profile)
+    else:
+        with open_image(image_bytes) as img:
+            passthrough = img.format in VISION_IMAGE_FORMATS
+        page = image_upload_bytes(image_bytes)
+        stats = {"upload_bytes": len(page), "codec": "original" if passthrough else "png"}
+    if detect_cards:
+        stats["card"] = None  # no card found, full frame
+    return [page], [stats]
+
+
+def pixmap_encoder(profile: PreprocessProfile = None, page_stats: list = None):
+    """
+    Build an encode_page callback for helper_functions.iter_pdf_pages.
+    The rendered pixmap is converted to grayscale where that is safe and
+    encoded once with the profile codec. Per-page stats are appended to page_stats,
+    bytes_saved against the raw size of the rendered page.
+    """
+    profile = profile or PREPROCESS_PROFILES["pdf"]
+
+    def encode_page(pix) -> bytes:
+        started = time.perf_counter()
+        raw_size = pix.stride * pix.height
+        mode = "L" if pix.n == 1 else "RGB"
+        img = Image.frombytes(mode, (pix.width, pix.height), pix.samples)
+
+        grayscale = mode == "L" or profile.grayscale == "always" or (
+            profile.grayscale == "auto" and _grayscale_is_safe(img)
+        )
+        codec = profile.codec
+        if codec == "auto":
+            codec = "png" if _is_line_art(img) else "jpeg"
+
+        if grayscale and mode != "L":
+            pix = fitz.Pixmap(fitz.csGRAY, pix)
+
+        if codec == "png":
+            output = pix.tobytes("png")
+        elif codec == "jpeg":
+            output = pix.tobytes("jpg", jpg_quality=profile.jpeg_quality)
+        else:
+            # fitz has no WebP writer, encode from the raw samples instead
+            img = Image.frombytes("L" if pix.n == 1 else "RGB", (pix.width, pix.height), pix.samples)
+            output = _encode(img, codec, profile)
+
+        if page_stats is not None:
+            page_stats.append({
+                "original_bytes": raw_size,
+                "upload_bytes": len(output),
+                "bytes_saved": raw_size - len(output),
+                "width": pix.width,
+                "height": pix.height,
+                "grayscale": grayscale,
+                "codec": codec,
+                "encode_ms": round((time.perf_counter() - started) * 1000, 2)
+            })
+        return output
+
+    return encode_page
+
+
+def pdf_render_scale(profile: PreprocessProfile = None) -> float:
+    """fitz render scale for the profile DPI (PDF user space is 72 DPI)"""
+    profile = profile or PREPROCESS_PROFILES["pdf"]
+    return profile.pdf_dpi / 72
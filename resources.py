@@ -0,0 +1,258 @@
+"""
+Process-wide resources (Mongo, Vision, OpenAI, CPU pool, outbound HTTP)
+owned by one registry, warmed in parallel and closed on shutdown.
+
+Nothing here connects or imports the heavy libraries (fitz, OpenCV, Vision,
+OpenAI) at import time: each warm-up imports what it needs in a thread, so
+the imports overlap with each other and with the network warm-ups, and the
+app answers /healthz while they run. /readyz only turns 200 once every
+critical resource is warm.
+
+    registry = build_registry()
+    await registry.start()      # warm everything, retrying critical failures
+    registry.ready, registry.report()
+    await registry.close()
+"""
+from typing import Optional, Dict, Any, Callable, Awaitable, List
+import asyncio
+import importlib
+import os
+import time
+
+from metrics import registry as metrics_registry
+
+# Critical resources that fail to warm up are retried this often
+RESOURCE_RETRY_SECONDS = float(os.getenv("RESOURCE_RETRY_SECONDS", "5"))
+# How long a request arriving during warm-up waits for readiness before a 503
+RESOURCE_READY_TIMEOUT = float(os.getenv("RESOURCE_READY_TIMEOUT", "30"))
+
+
+async def import_module(name: str):
+    """Import a module in a thread, so heavy imports do not block the event loop"""
+    return await asyncio.to_thread(importlib.import_module, name)
+
+
+class Resource:
+    def __init__(
+        self,
+        name: str,
+        warm: Callable[[], Awaitable[Any]],
+        close: Optional[Callable[[], Awaitable[Any]]] = None,
+        critical: bool = True
+    ):
+        self.name = name
+        self.warm = warm
+        self.close = close
+        # The app is not ready until a critical resource is warm, a failed
+        # non-critical one is reported but does not hold readiness back
+        self.critical = critical
+        self.status = "pending"
+        self.warm_ms = None
+        self.attempts = 0
+        self.error = None
+        self.details = None
+
+
+class ResourceRegistry:
+    """Named resources with an async warm-up and close each"""
+
+    def __init__(self):
+        self.resources = {}
+        self.started_at = None
+        self.ready_ms = None
+        self._ready = asyncio.Event()
+
+    def add(
+        self,
+        name: str,
+        warm: Callable[[], Awaitable[Any]],
+        close: Optional[Callable[[], Awaitable[Any]]] = None,
+        critical: bool = True
+    ):
+        self.resources[name] = Resource(name, warm, close, critical)
+
+    @property
+    def ready(self) -> bool:
+        return self._ready.is_set()
+
+    async def _warm(self, resource: Resource):
+        while True:
+            resource.status = "warming"
+            resource.attempts += 1
+            started = time.perf_counter()
+            try:
+                resource.details = await resource.warm()
+                resource.status = "ready"
+                resource.error = None
+                return
+            except Exception as e:
+                resource.status = "failed"
+                resource.error = f"{type(e).__name__}: {e}"
+                print(f"Resource {resource.name} failed to warm up: {resource.error}")
+                if not resource.critical:
+                    return
+                await asyncio.sleep(RESOURCE_RETRY_SECONDS)
+            finally:
+                resource.warm_ms = round((time.perf_counter() - started) * 1000, 1)
+
+    async def start(self):
+        """Warm every resource concurrently; returns once the critical ones are ready"""
+        self.started_at = time.perf_counter()
+        await asyncio.gather(*(self._warm(resource) for resource in self.resources.values()))
+        self.ready_ms = round((time.perf_counter() - self.started_at) * 1000, 1)
+        self._ready.set()
+        print(f"Resources ready in {self.ready_ms}ms: " + ", ".join(
+            f"{resource.name} {resource.status} {resource.warm_ms}ms" for resource in self.resources.values()
+        ))
+
+    async def wait_ready(self, timeout: float = RESOURCE_READY_TIMEOUT) -> bool:
+        try:
+            await asyncio.wait_for(self._ready.wait(), timeout)
+        except asyncio.TimeoutError:
+            return False
+        return True
+
+    async def close(self):
+        """Close the resources in reverse order, those whose warm-up was started"""
+        for resource in reversed(list(self.resources.values())):
+            if resource.close is None or not resource.attempts:
+                continue
+            try:
+                await resource.close()
+            except Exception as e:
+                print(f"Error closing {resource.name}: {e}")
+            resource.status = "closed"
+
+    def report(self) -> Dict[str, Any]:
+        return {
+            "ready": self.ready,
+            "ready_ms": self.ready_ms,
+            "resources": {
+                resource.name: {
+                    "status": resource.status,
+                    "critical": resource.critical,
+                    "warm_ms": resource.warm_ms,
+                    "attempts": resource.attempts,
+                    "error": resource.error,
+                    "details": resource.details
+                }
+                for resource in self.resources.values()
+            }
+        }
+
+
+# ---------------------------------------------------------------------------
+# Warm-ups
+# ---------------------------------------------------------------------------
+
+async def warm_mongo() -> Dict[str, Any]:
+    """Connect, then create the declared indexes (pipeline holds the collections)"""
+    pipeline = await import_module("pipeline")
+    await pipeline.mongodb.client.admin.command("ping")
+    indexed_collections = (
+        ("documents", pipeline.documents_crud), ("qatar ids", pipeline.qatar_ids_crud),
+        ("istimaras", pipeline.istimaras_crud), ("requests", pipeline.requests_crud),
+        ("ocr cache", pipeline.ocr_cache), ("extraction cache", pipeline.extraction_cache),
+        ("job queue", pipeline.job_queue), ("outbox", pipeline.outbox), ("idempotency", pipeline.idempotency)
+    )
+    index_errors = 0
+    for name, indexed in indexed_collections:
+        try:
+            await indexed.ensure_indexes()
+        except Exception as e:
+            print(f"Error creating {name} indexes: {e}")
+            index_errors += 1
+    metrics_registry.register_stats("ocr_cache", pipeline.ocr_cache.stats)
+    metrics_registry.register_stats("extraction_cache", pipeline.extraction_cache.stats)
+    metrics_registry.register_stats("idempotency", pipeline.idempotency.stats)
+    return {"index_errors": index_errors}
+
+
+async def close_mongo():
+    pipeline = await import_module("pipeline")
+    await pipeline.mongodb.close()
+
+
+async def warm_vision() -> Dict[str, Any]:
+    """Open the Vision channels and check they connect"""
+    ocr = await import_module("ocr")
+    await asyncio.to_thread(ocr.vision_client_pool.start)
+    healthy = await asyncio.to_thread(ocr.vision_client_pool.health_check)
+    metrics_registry.register_stats("vision_pool", ocr.vision_client_pool.stats)
+    if not healthy:
+        raise ConnectionError("Vision channels did not connect")
+    return ocr.vision_client_pool.stats()
+
+
+async def close_vision():
+    ocr = await import_module("ocr")
+    await asyncio.to_thread(ocr.vision_client_pool.close)
+
+
+async def warm_openai() -> Dict[str, Any]:
+    """Import the OpenAI SDK, and create the shared client when the service has its own key"""
+    llm_response = await import_module("llm_response")
+    rule_extractor = await import_module("rule_extractor")
+    # Without OPENAI_API_KEY the clients are created per bearer key on first use
+    default_client = bool(os.getenv("OPENAI_API_KEY"))
+    if default_client:
+        await asyncio.to_thread(llm_response.llm_client.client)
+    metrics_registry.register_stats("llm", llm_response.llm_client.stats)
+    metrics_registry.register_stats("llm_admission", llm_response.llm_client.limiter.stats)
+    metrics_registry.register_stats("fast_path", rule_extractor.fast_path_stats.stats)
+    return {"model": llm_response.EXTRACTION_MODEL, "default_client": default_client}
+
+
+async def close_openai():
+    llm_response = await import_module("llm_response")
+    await llm_response.llm_client.close()
+
+
+async def warm_cpu_pool() -> Dict[str, Any]:
+    """Import the imaging libraries here, then start and warm the worker processes"""
+    for name in ("helper_functions", "preprocessing", "card_detection", "triage"):
+        await import_module(name)
+    from cpu_pool import cpu_pool
+
+    await asyncio.to_thread(cpu_pool.start)
+    metrics_registry.register_stats("cpu_pool", cpu_pool.stats)
+    return {"workers": cpu_pool.workers, "warm_ms": cpu_pool.warm_ms}
+
+
+async def close_cpu_pool():
+    from cpu_pool import cpu_pool
+
+    await asyncio.to_thread(cpu_pool.close)
+
+
+async def warm_http() -> Dict[str, Any]:
+    """Keep-alive connection pools for the Graph API and the backend"""
+    from http_client import http_client
+    from whatsapp_func import WHATSAPP_API_URL, BACKEND_BASEURL
+
+    http_client.start(WHATSAPP_API_URL, BACKEND_BASEURL)
+    metrics_registry.register_stats("http_client", http_client.stats)
+    return {"hosts": len(http_client.stats().get("hosts", {}))}
+
+
+async def close_http():
+    from http_client import http_client
+
+    await http_client.close()
+
+
+def build_registry(names: List[str] = None) -> ResourceRegistry:
+    """The registry of the app (or of the named resources only, e.g. for job workers)"""
+    available = {
+        "mongo": (warm_mongo, close_mongo, True),
+        # Every request needs OCR: not ready while the Vision channels are down
+        "vision": (warm_vision, close_vision, True),
+        "openai": (warm_openai, close_openai, False),
+        "cpu_pool": (warm_cpu_pool, close_cpu_pool, True),
+        "http": (warm_http, close_http, False),
+    }
+    registry = ResourceRegistry()
+    for name in names or available:
+        warm, close, critical = available[name]
+        registry.add(name, warm, close, critical=critical)
+    return registry
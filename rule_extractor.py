@@ -0,0 +1,335 @@
+"""
+Rule-based fast path for structured extraction.
+
+Most Qatar ID and Istimara fields have rigid formats (11-digit QID, 17-character
+VIN, dd/mm/yyyy dates, plate and passport numbers) next to fixed labels, so
+they can be read from the Vision text with label anchors and regexes. The LLM
+is only called when a required field stays empty or fails validation, and then
+only for the fields the rules left empty.
+"""
+from typing import Optional, List, Dict, Any, Tuple, Union
+from datetime import datetime
+import asyncio
+import os
+import re
+import threading
+
+from compaction import normalize_line
+from llm_response import QatarID, Istimara, extract_missing_fields_memoized
+from cache import ResultCache
+
+# "rules" tries the rules first, "llm" always runs the full LLM extraction
+EXTRACTION_MODE = os.getenv("EXTRACTION_MODE", "rules").lower()
+
+QID = r"[23]\d{10}"
+VIN = r"[A-HJ-NPR-Z0-9]{17}"
+DATE = r"\d{1,2}[/.-]\d{1,2}[/.-]\d{4}"
+LATIN_TEXT = r"[A-Za-z][A-Za-z0-9 &.,'()/-]*"
+LATIN_NAME = r"[A-Za-z][A-Za-z.'-]*(?: [A-Za-z][A-Za-z.'-]*)+"
+ARABIC_TEXT = r"[؀-ۿ][؀-ۿ ]*"
+
+
+class FieldRule:
+    def __init__(self, labels: List[str], pattern: str, anywhere: bool = False):
+        self.labels = labels
+        self.pattern = re.compile(pattern, re.IGNORECASE)
+        # Also look for the pattern without a label (only for unmistakable formats)
+        self.anywhere = anywhere
+
+    def validate(self, value: str) -> bool:
+        return bool(value) and bool(self.pattern.fullmatch(value))
+
+
+RULES = {
+    "qatar_id": {
+        "id_no": FieldRule(["id no", "id number", "id", "qid", "الرقم الشخصي"], QID, anywhere=True),
+        "name": FieldRule(["name", "الاسم"], LATIN_NAME),
+        "dob": FieldRule(["d.o.b", "dob", "date of birth", "birth date", "تاريخ الميلاد"], DATE),
+        "expiry_date": FieldRule(["expiry", "expiry date", "expiry date of id", "الصلاحية", "تاريخ الانتهاء"], DATE),
+        "nationality": FieldRule(["nationality", "الجنسية"], LATIN_TEXT),
+        "occupation": FieldRule(["occupation", "المهنة"], LATIN_TEXT),
+        "passport_number": FieldRule(["passport number", "passport no", "رقم الجواز"], r"[A-Z]{0,2}\d{6,9}"),
+        "passport_expiry": FieldRule(["passport expiry", "passport expiry date", "تاريخ انتهاء الجواز"], DATE),
+        "serial_no": FieldRule(["serial no", "serial number", "الرقم التسلسلي"], r"\d{6,12}"),
+        "employer": FieldRule(["employer", "صاحب العمل"], LATIN_TEXT),
+    },
+    "istimara": {
+        "vehicle_number": FieldRule(["plate no", "plate number", "vehicle number", "رقم اللوحة"], r"\d{1,6}"),
+        "vehicle_type": FieldRule(["vehicle type", "type", "نوع المركبة"], LATIN_TEXT),
+        "owner_en": FieldRule(["owner", "owner name"], LATIN_NAME),
+        "owner_ar": FieldRule(["المالك", "اسم المالك"], ARABIC_TEXT),
+        "owner_qid": FieldRule(["owner id", "owner qid", "owner's id", "owner id no", "الرقم الشخصي للمالك"], QID),
+        "nationality": FieldRule(["nationality", "الجنسية"], LATIN_TEXT),
+        "vehicle_expiry_date": FieldRule(["expiry", "expiry date", "registration expiry", "تاريخ الانتهاء"], DATE),
+        "vehicle_renewal_date": FieldRule(["renewal date", "تاريخ التجديد"], DATE),
+        "vehicle_registration_date": FieldRule(["reg. date", "reg date", "registration date", "first registration", "تاريخ التسجيل"], DATE),
+        "vehicle_make": FieldRule(["make", "manufacturer", "الصنع"], LATIN_TEXT),
+        "vehicle_model": FieldRule(["model", "الطراز"], r"[A-Za-z0-9][A-Za-z0-9 .-]*"),
+        "vehicle_body_type": FieldRule(["body type", "body", "نوع الهيكل"], LATIN_TEXT),
+        "vehicle_year": FieldRule(["year", "model year", "year of manufacture", "سنة الصنع"], r"(19[5-9]\d|20\d\d)"),
+        "vehicle_shape": FieldRule(["shape", "الشكل"], LATIN_TEXT),
+        "vehicle_cylinder": FieldRule(["cylinders", "cylinder", "no. of cylinders", "عدد السلندرات"], r"\d{1,2}"),
+        "vehicle_seat": FieldRule(["seats", "seat", "no. of seats", "عدد المقاعد"], r"\d{1,2}"),
+        "vehicle_weight": FieldRule(["weight", "gross weight", "الوزن"], r"\d{2,6}( ?kg)?"),
+        "vehicle_net_weight": FieldRule(["net weight", "الوزن الصافي"], r"\d{2,6}( ?kg)?"),
+        "vehicle_color": FieldRule(["color", "colour", "اللون"], LATIN_TEXT),
+        "vehicle_chassis_no": FieldRule(["chassis no", "chassis number", "chassis", "vin", "رقم الشاصي"], VIN, anywhere=True),
+        "vehicle_engine_no": FieldRule(["engine no", "engine number", "رقم المحرك"], r"[A-Z0-9][A-Z0-9-]{4,19}"),
+        "vehicle_insurance_company": FieldRule(["insurance", "insurance company", "insurer", "شركة التأمين"], LATIN_TEXT),
+        "vehicle_policy_number": FieldRule(["policy", "policy no", "policy number", "رقم الوثيقة"], r"(?=.*\d)[A-Z0-9][A-Z0-9/-]{3,}"),
+        "vehicle_expiry": FieldRule(["insurance expiry", "policy expiry", "تاريخ انتهاء التأمين"], DATE),
+        "vehicle_policy_type": FieldRule(["policy type", "insurance type", "نوع التأمين"], LATIN_TEXT),
+    },
+}
+
+# Without these the request falls back to the LLM
+REQUIRED_FIELDS = {
+    "qatar_id": ["id_no", "name", "dob", "expiry_date", "nationality"],
+    "istimara": ["vehicle_number", "owner_qid", "vehicle_make", "vehicle_model", "vehicle_year", "vehicle_chassis_no", "vehicle_expiry_date"],
+}
+
+# Lines that tell which card the following text belongs to
+SECTION_ANCHORS = {
+    "qatar_id": re.compile(r"residency permit|رخصة إقامة|id\.? ?no\b|passport (number|expiry)|employer", re.IGNORECASE),
+    "istimara": re.compile(r"vehicle registration|رخصة سير|plate no|رقم اللوحة|chassis|engine no|owner", re.IGNORECASE),
+}
+
+
+def _label_regex(label: str) -> str:
+    return r"\s*".join(re.escape(word) for word in label.split())
+
+
+# Per document: one regex matching any label at the start of a segment, longest label first,
+# and the field each label belongs to
+LABELS = {}
+for _document, _rules in RULES.items():
+    _labels = sorted(
+        ((label, field) for field, rule in _rules.items() for label in rule.labels),
+        key=lambda item: len(item[0]), reverse=True
+    )
+    LABELS[_document] = (
+        re.compile(
+            r"^(" + "|".join(_label_regex(label) for label, _ in _labels) + r")(?![A-Za-z])\s*[:.\-]?\s*(.*)$",
+            re.IGNORECASE
+        ),
+        {label.replace(" ", "").lower(): field for label, field in _labels},
+        # Labels in the middle of a line only count when followed by a colon
+        re.compile(r"\s(?=(" + "|".join(_label_regex(label) for label, _ in _labels) + r")\s*:)", re.IGNORECASE),
+    )
+
+
+def split_sections(lines: List[str]) -> Dict[str, List[str]]:
+    """
+    Assign lines to the Qatar ID or the Istimara by their anchors (titles and
+    card-specific labels). Text with no anchor at all goes to both.
+    """
+    sections = {"qatar_id": [], "istimara": []}
+    current = None
+    leading = []
+    for line in lines:
+        for document, anchor in SECTION_ANCHORS.items():
+            if anchor.search(line):
+                current = document
+                break
+        if current is None:
+            leading.append(line)
+        else:
+            sections[current].append(line)
+    if not sections["qatar_id"] and not sections["istimara"]:
+        return {"qatar_id": leading, "istimara": leading}
+    # Text before the first anchor belongs to the first card
+    first = "qatar_id" if any(SECTION_ANCHORS["qatar_id"].search(line) for line in lines[:len(leading) + 1]) else "istimara"
+    sections[first] = leading + sections[first]
+    return sections
+
+
+def _segments(lines: List[str], document: str) -> List[str]:
+    """Split lines holding several labelled values ("Make: TOYOTA  Model: LAND CRUISER")"""
+    label_regex, _, inline = LABELS[document]
+    segments = []
+    for line in lines:
+        while True:
+            match = label_regex.match(line)
+            split = inline.search(line, match.start(2)) if match else None
+            if not split:
+                segments.append(line)
+                break
+            segments.append(line[:split.start()].strip())
+            line = line[split.end():].strip()
+    return segments
+
+
+def _label_field(segment: str, document: str) -> Tuple[Optional[str], str]:
+    label_regex, label_fields, _ = LABELS[document]
+    match = label_regex.match(segment)
+    if not match:
+        return None, ""
+    label = re.sub(r"\s+", "", match.group(1)).lower()
+    return label_fields.get(label), match.group(2).strip()
+
+
+def extract_document(lines: List[str], document: str) -> Dict[str, str]:
+    """Fill the fields of one document from its lines. Unfound fields are empty strings."""
+    rules = RULES[document]
+    values = {}
+    segments = _segments(lines, document)
+    for idx, segment in enumerate(segments):
+        field, rest = _label_field(segment, document)
+        if field is None or field in values:
+            continue
+        rule = rules[field]
+        candidates = [rest] if rest else []
+        # Vision often puts the value on the next line, sometimes after its Arabic label
+        for following in segments[idx + 1:idx + 3]:
+            if _label_field(following, document)[0] is not None:
+                break
+            candidates.append(following)
+        for candidate in candidates:
+            candidate = candidate.strip(" :")
+            if rule.validate(candidate):
+                values[field] = candidate
+                break
+
+    for field, rule in rules.items():
+        if field not in values and rule.anywhere:
+            for segment in segments:
+                match = re.search(rf"(?<![A-Za-z0-9])({rule.pattern.pattern})(?![A-Za-z0-9])", segment)
+                if match:
+                    values[field] = match.group(1)
+                    break
+
+    return {field: values.get(field, "") for field in rules}
+
+
+def _valid_date(value: str) -> bool:
+    for separator in "/.-":
+        try:
+            datetime.strptime(value, f"%d{separator}%m{separator}%Y")
+            return True
+        except ValueError:
+            continue
+    return False
+
+
+def invalid_fields(document: str, data: Dict[str, str]) -> List[str]:
+    """Filled fields whose value does not pass validation"""
+    invalid = []
+    for field, value in data.items():
+        if not value:
+            continue
+        rule = RULES[document][field]
+        if not rule.validate(value) or (rule.pattern.pattern == DATE and not _valid_date(value)):
+            invalid.append(field)
+    return invalid
+
+
+def _lines(text: str) -> List[str]:
+    lines = (normalize_line(line) for line in text.splitlines())
+    return [line for line in lines if line]
+
+
+def rule_extract(context: Union[str, Dict[str, str]]) -> Tuple[Dict[str, Dict[str, str]], Dict[str, List[str]]]:
+    """
+    Run the rules over OCR text, or over the text of each document once the
+    pages are classified. Returns the documents (same fields as the QatarID
+    and Istimara models) and, per document, the fields that are empty or
+    failed validation.
+    """
+    if isinstance(context, dict):
+        sections = {document: _lines(context.get(document, "")) for document in RULES}
+    else:
+        sections = split_sections(_lines(context))
+    result = {}
+    missing = {}
+    for document, model in (("qatar_id", QatarID), ("istimara", Istimara)):
+        data = extract_document(sections[document], document)
+        for field in invalid_fields(document, data):
+            data[field] = ""
+        result[document] = model(**data).model_dump()
+        missing[document] = [field for field, value in result[document].items() if not value]
+    return result, missing
+
+
+class FastPathStats:
+    """How often extraction was answered by the rules alone"""
+
+    def __init__(self):
+        self.requests = 0
+        self.llm_skipped = 0
+        self.fields_from_rules = 0
+        self.fields_from_llm = 0
+        self._lock = threading.Lock()
+
+    def record(self, report: Dict[str, Any]):
+        with self._lock:
+            self.requests += 1
+            self.llm_skipped += not report["llm_called"]
+            self.fields_from_rules += report["fields_from_rules"]
+            self.fields_from_llm += report["fields_from_llm"]
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "requests": self.requests,
+            "llm_skipped": self.llm_skipped,
+            "llm_skip_rate": round(self.llm_skipped / self.requests, 3) if self.requests else 0.0,
+            "fields_from_rules": self.fields_from_rules,
+            "fields_from_llm": self.fields_from_llm
+        }
+
+
+fast_path_stats = FastPathStats()
+
+
+async def extract_document_info_fast(
+    context: Union[str, Dict[str, str]],
+    cache: ResultCache = None,
+    api_key: str = None
+) -> Tuple[dict, Dict[str, Any]]:
+    """
+    Rules first, LLM only when a required field is missing, and then only for
+    the fields the rules left empty. With the text of each document (classified
+    pages), only documents missing a required field are sent, one call each.
+    Returns the extraction (or error and refusal_message, like
+    extract_document_info) and a report of what was filled by which path.
+    """
+    result, missing = rule_extract(context)
+    required_missing = {
+        document: [field for field in REQUIRED_FIELDS[document] if field in missing[document]]
+        for document in REQUIRED_FIELDS
+    }
+    if isinstance(context, dict):
+        requests = [
+            (context[document], {document: missing[document]})
+            for document, fields in required_missing.items() if fields and context.get(document)
+        ]
+    elif any(required_missing.values()):
+        requests = [(context, missing)]
+    else:
+        requests = []
+    report = {
+        "mode": "rules",
+        "llm_called": bool(requests),
+        "calls": len(requests),
+        "required_missing": {document: fields for document, fields in required_missing.items() if fields},
+        "fields_from_rules": sum(1 for fields in result.values() for value in fields.values() if value),
+        "fields_from_llm": 0
+    }
+
+    llm_results = await asyncio.gather(*(
+        extract_missing_fields_memoized(text, fields, cache=cache, api_key=api_key) for text, fields in requests
+    ))
+    for llm_result in llm_results:
+        if "error" in llm_result:
+            return llm_result, report
+        for document, fields in llm_result.items():
+            for field, value in fields.items():
+                if value and not result[document][field]:
+                    result[document][field] = value
+                    report["fields_from_llm"] += 1
+
+    fast_path_stats.record(report)
+    print(
+        f"Rule extraction: {report['fields_from_rules']} fields from rules, "
+        f"{report['fields_from_llm']} from LLM (LLM {'called' if report['llm_called'] else 'skipped'})"
+    )
+    return result, report
@@ -0,0 +1,120 @@
+from typing import Callable, Awaitable, Dict, Any, List, Iterable
+import asyncio
+import time
+
+from metrics import span
+
+
+class StageSkipped(Exception):
+    """Raised by a stage that has nothing to do. Stages depending on it are skipped too."""
+
+
+class Stage:
+    def __init__(
+        self,
+        name: str,
+        func: Callable[[Dict[str, Any]], Awaitable[Any]],
+        requires: Iterable[str] = (),
+        critical: bool = True,
+        after: Iterable[str] = ()
+    ):
+        self.name = name
+        self.func = func
+        self.requires = tuple(requires)
+        # Stages that must have finished first, whether they completed or not
+        self.after = tuple(after)
+        # A failed critical stage fails the whole run, a failed non-critical
+        # stage only skips the stages that depend on it
+        self.critical = critical
+
+
+class StageGraph:
+    """
+    A small dependency graph of async pipeline stages.
+    Each stage starts as soon as every stage it requires has completed, so
+    independent stages run concurrently. Stages share one context dict and
+    their return values are stored in it under the stage name.
+    """
+
+    def __init__(self, stages: List[Stage]):
+        self.stages = {}
+        for stage in stages:
+            for required in stage.requires + stage.after:
+                if required not in self.stages:
+                    raise ValueError(f"Stage {stage.name} requires unknown or later stage {required}")
+            self.stages[stage.name] = stage
+
+    async def run(self, context: Dict[str, Any]) -> Dict[str, Dict[str, Any]]:
+        """
+        Run every stage and return per-stage status and timings
+        (status is completed, failed or skipped).
+        Re-raises the error of the first failed critical stage once the stages
+        already running have finished.
+        """
+        started = time.perf_counter()
+        timings = {}
+        pending = dict(self.stages)
+        running = {}
+        critical_error = None
+
+        async def run_stage(stage: Stage):
+            stage_started = time.perf_counter()
+            timing = {"start_ms": round((stage_started - started) * 1000, 1)}
+            with span(f"stage.{stage.name}", request_id=context.get("request_id")) as stage_span:
+                try:
+                    context[stage.name] = await stage.func(context)
+                    timing["status"] = "completed"
+                except StageSkipped as e:
+                    timing["status"] = "skipped"
+                    timing["reason"] = str(e)
+                    stage_span.set_status("skipped")
+                except Exception as e:
+                    timing["status"] = "failed"
+                    timing["error"] = str(e)
+                    raise
+                finally:
+                    timing["duration_ms"] = round((time.perf_counter() - stage_started) * 1000, 1)
+                    timings[stage.name] = timing
+
+        try:
+            while pending or running:
+                if critical_error is None:
+                    # Requirements always come earlier in the graph, so one
+                    # pass settles every stage whose requirements are settled
+                    for name, stage in list(pending.items()):
+                        statuses = [timings.get(required, {}).get("status") for required in stage.requires]
+                        if any(status in ("failed", "skipped") for status in statuses):
+                            del pending[name]
+                            timings[name] = {"status": "skipped", "reason": "requirement not completed"}
+                        elif all(status == "completed" for status in statuses) and all(
+                            "status" in timings.get(previous, {}) for previous in stage.after
+                        ):
+                            del pending[name]
+                            running[asyncio.create_task(run_stage(stage))] = stage
+                else:
+                    for name in pending:
+                        timings[name] = {"status": "skipped", "reason": "pipeline failed"}
+                    pending = {}
+
+                if not running:
+                    break
+
+                done, _ = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    stage = running.pop(task)
+                    error = task.exception()
+                    if error is None:
+                        continue
+                    if not stage.critical:
+                        print(f"Stage {stage.name} failed: {error}")
+                    elif critical_error is None:
+                        critical_error = error
+        finally:
+            for task in running:
+                task.cancel()
+
+        timings["total"] = {"duration_ms": round((time.perf_counter() - started) * 1000, 1)}
+        context["stage_timings"] = timings
+        if critical_error is not None:
+            raise critical_error
+        return timings
@@ -0,0 +1,91 @@
+"""
+Local fake of the WhatsApp Graph API (and the backend renewal validation
+endpoint) for exercising the notification outbox without sending anything.
+
+    python stubs/fake_graph_api.py --port 9100 --fail-rate 0.2 --rate-limit 10
+
+then run the app or outbox dispatcher with
+GRAPH_API_BASE_URL=http://localhost:9100/v18.0 and BACKEND_BASEURL=http://localhost:9100.
+Received messages are listed at GET /messages, in arrival order.
+"""
+import argparse
+import asyncio
+import random
+import time
+import uuid
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
+import uvicorn
+
+app = FastAPI()
+app.state.fail_rate = 0.0
+app.state.rate_limit = 0
+app.state.latency = 0.0
+app.state.messages = []
+app.state.validations = []
+app.state.window = []
+
+
+def _throttled() -> bool:
+    if not app.state.rate_limit:
+        return False
+    now = time.monotonic()
+    app.state.window = [sent_at for sent_at in app.state.window if now - sent_at < 1.0]
+    if len(app.state.window) >= app.state.rate_limit:
+        return True
+    app.state.window.append(now)
+    return False
+
+
+@app.post("/{version}/{phone_number_id}/messages")
+async def send_message(version: str, phone_number_id: str, request: Request):
+    payload = await request.json()
+    if app.state.latency:
+        await asyncio.sleep(app.state.latency)
+    if _throttled():
+        return JSONResponse(status_code=400, content={"error": {
+            "message": "(#130429) Rate limit hit", "type": "OAuthException", "code": 130429
+        }})
+    if random.random() < app.state.fail_rate:
+        return JSONResponse(status_code=503, content={"error": {"message": "Service temporarily unavailable", "code": 2}})
+
+    message_id = f"wamid.{uuid.uuid4().hex}"
+    app.state.messages.append({"id": message_id, "received_at": time.time(), "payload": payload})
+    return {
+        "messaging_product": "whatsapp",
+        "contacts": [{"input": payload.get("to"), "wa_id": payload.get("to")}],
+        "messages": [{"id": message_id}]
+    }
+
+
+@app.post("/api/portal/transactions/renewalValidation")
+async def renewal_validation(request: Request):
+    payload = await request.json()
+    app.state.validations.append(payload)
+    return {"status": "success", "responseCode": "1", "requestId": payload.get("requestId")}
+
+
+@app.get("/messages")
+async def list_messages():
+    return {"messages": app.state.messages, "validations": app.state.validations}
+
+
+@app.delete("/messages")
+async def clear_messages():
+    app.state.messages = []
+    app.state.validations = []
+    return {"success": True}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fake WhatsApp Graph API")
+    parser.add_argument("--port", type=int, default=9100)
+    parser.add_argument("--fail-rate", type=float, default=0.0, help="fraction of sends answered with 503")
+    parser.add_argument("--rate-limit", type=int, default=0, help="messages per second before 130429 errors (0 = no limit)")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds to wait before answering")
+    args = parser.parse_args()
+    app.state.fail_rate = args.fail_rate
+    app.state.rate_limit = args.rate_limit
+    app.state.latency = args.latency
+    uvicorn.run(app, host="0.0.0.0", port=args.port)
@@ -0,0 +1,109 @@
+"""
+Local fake of the OpenAI chat completions API for load-testing structured
+extraction offline.
+
+    python stubs/fake_openai.py --port 9200 --latency 0.8 --error-rate 0.1
+
+then run with OPENAI_BASE_URL=http://localhost:9200/v1 and any OPENAI_API_KEY.
+Answers follow the requested JSON schema: every string field is empty except
+a few filled from the prompt by regex (Qatar ID number, chassis number).
+Token usage is estimated at 4 characters per token.
+"""
+import argparse
+import asyncio
+import json
+import random
+import re
+import time
+import uuid
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
+import uvicorn
+
+app = FastAPI()
+app.state.latency = 0.0
+app.state.error_rate = 0.0
+app.state.requests = 0
+
+FIELD_PATTERNS = {
+    "id_no": re.compile(r"\b(\d{11})\b"),
+    "owner_qid": re.compile(r"\b(\d{11})\b"),
+    "vehicle_chassis_no": re.compile(r"\b([A-HJ-NPR-Z0-9]{17})\b"),
+}
+
+
+def _fill(schema, defs, text):
+    if "$ref" in schema:
+        schema = defs[schema["$ref"].split("/")[-1]]
+    if schema.get("type") == "object":
+        result = {}
+        for name, prop in schema.get("properties", {}).items():
+            value = _fill(prop, defs, text)
+            pattern = FIELD_PATTERNS.get(name)
+            if value == "" and pattern:
+                match = pattern.search(text)
+                value = match.group(1) if match else ""
+            result[name] = value
+        return result
+    if schema.get("type") == "array":
+        return []
+    return ""
+
+
+@app.post("/v1/chat/completions")
+async def chat_completions(request: Request):
+    body = await request.json()
+    app.state.requests += 1
+    if app.state.latency:
+        await asyncio.sleep(random.uniform(0.5, 1.5) * app.state.latency)
+    if random.random() < app.state.error_rate:
+        status_code = random.choice([429, 500, 503])
+        return JSONResponse(
+            status_code=status_code,
+            headers={"retry-after": "0.2"} if status_code == 429 else {},
+            content={"error": {"message": "Fake transient error", "type": "server_error", "code": None}}
+        )
+
+    text = "\n".join(message.get("content", "") for message in body.get("messages", []))
+    response_format = body.get("response_format", {})
+    if response_format.get("type") == "json_schema":
+        schema = response_format["json_schema"]["schema"]
+        content = json.dumps(_fill(schema, schema.get("$defs", {}), text))
+    else:
+        content = "ok"
+
+    prompt_tokens = len(text) // 4
+    completion_tokens = len(content) // 4
+    return {
+        "id": f"chatcmpl-{uuid.uuid4().hex}",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": body.get("model"),
+        "choices": [{
+            "index": 0,
+            "finish_reason": "stop",
+            "message": {"role": "assistant", "content": content, "refusal": None}
+        }],
+        "usage": {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens
+        }
+    }
+
+
+@app.get("/stats")
+async def stats():
+    return {"requests": app.state.requests}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fake OpenAI chat completions API")
+    parser.add_argument("--port", type=int, default=9200)
+    parser.add_argument("--latency", type=float, default=0.0, help="mean seconds per completion")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of calls answered with 429/500/503")
+    args = parser.parse_args()
+    app.state.latency = args.latency
+    app.state.error_rate = args.error_rate
+    uvicorn.run(app, host="0.0.0.0", port=args.port)
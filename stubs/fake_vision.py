@@ -0,0 +1,128 @@
+"""
+Local fake of the Google Cloud Vision gRPC API (ImageAnnotator) for running
+GCPHelper offline.
+
+    python stubs/fake_vision.py --port 9300 --latency 0.2 --error-rate 0.05
+
+then run with VISION_API_ENDPOINT=localhost:9300 (plaintext, no credentials).
+BatchAnnotateImages and BatchAnnotateFiles answer every image / PDF page with
+text from benchmarks/ocr_samples.json, chosen by a hash of the content so the
+same page always gets the same text, with one word annotation per token.
+Errors are returned as UNAVAILABLE, which GCPHelper retries.
+"""
+import argparse
+import hashlib
+import json
+import os
+import random
+import threading
+import time
+from concurrent import futures
+
+import grpc
+from google.cloud import vision
+
+SERVICE = "google.cloud.vision.v1.ImageAnnotator"
+SAMPLES_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "benchmarks", "ocr_samples.json")
+
+
+def _sample_texts() -> list:
+    try:
+        with open(SAMPLES_PATH, encoding="utf-8") as f:
+            return [text for sample in json.load(f) for text in sample["files"]]
+    except OSError:
+        return ["State of Qatar\nResidency Permit"]
+
+
+class FakeVision:
+    """The ImageAnnotator methods GCPHelper uses, with configurable latency and errors"""
+
+    def __init__(self, latency: float = 0.0, error_rate: float = 0.0):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.texts = _sample_texts()
+        self.requests = 0
+        self.images = 0
+        self._lock = threading.Lock()
+
+    def _text(self, content: bytes, page: int = 0) -> str:
+        digest = hashlib.sha256(content).digest()
+        return self.texts[(int.from_bytes(digest[:4], "big") + page) % len(self.texts)]
+
+    @staticmethod
+    def _annotate(text: str) -> vision.AnnotateImageResponse:
+        words = [
+            vision.EntityAnnotation(description=word, confidence=0.97)
+            for word in text.split()
+        ]
+        return vision.AnnotateImageResponse(
+            text_annotations=[vision.EntityAnnotation(description=text, locale="en")] + words,
+            full_text_annotation=vision.TextAnnotation(text=text)
+        )
+
+    def _handle(self, context, images: int):
+        with self._lock:
+            self.requests += 1
+            self.images += images
+        if self.latency:
+            time.sleep(random.uniform(0.5, 1.5) * self.latency)
+        if random.random() < self.error_rate:
+            context.abort(grpc.StatusCode.UNAVAILABLE, "fake Vision: service unavailable")
+
+    def batch_annotate_images(self, request, context):
+        self._handle(context, len(request.requests))
+        return vision.BatchAnnotateImagesResponse(
+            responses=[self._annotate(self._text(item.image.content)) for item in request.requests]
+        )
+
+    def batch_annotate_files(self, request, context):
+        responses = []
+        for file_request in request.requests:
+            content = file_request.input_config.content
+            pages = list(file_request.pages) or [1]
+            responses.append(vision.AnnotateFileResponse(
+                input_config=file_request.input_config,
+                responses=[self._annotate(self._text(content, page)) for page in pages],
+                total_pages=len(pages)
+            ))
+        self._handle(context, sum(len(response.responses) for response in responses))
+        return vision.BatchAnnotateFilesResponse(responses=responses)
+
+    def handler(self) -> grpc.GenericRpcHandler:
+        return grpc.method_handlers_generic_handler(SERVICE, {
+            "BatchAnnotateImages": grpc.unary_unary_rpc_method_handler(
+                self.batch_annotate_images,
+                request_deserializer=vision.BatchAnnotateImagesRequest.deserialize,
+                response_serializer=vision.BatchAnnotateImagesResponse.serialize
+            ),
+            "BatchAnnotateFiles": grpc.unary_unary_rpc_method_handler(
+                self.batch_annotate_files,
+                request_deserializer=vision.BatchAnnotateFilesRequest.deserialize,
+                response_serializer=vision.BatchAnnotateFilesResponse.serialize
+            ),
+        })
+
+
+def serve(port: int = 9300, latency: float = 0.0, error_rate: float = 0.0, max_workers: int = 32):
+    """Start the fake server in the background. Returns (server, fake, bound port)."""
+    fake = FakeVision(latency, error_rate)
+    # Vision takes images of up to 20MB, gRPC stops at 4MB by default
+    server = grpc.server(
+        futures.ThreadPoolExecutor(max_workers=max_workers),
+        options=[("grpc.max_receive_message_length", 64 * 1024 * 1024)]
+    )
+    server.add_generic_rpc_handlers((fake.handler(),))
+    bound_port = server.add_insecure_port(f"127.0.0.1:{port}")
+    server.start()
+    return server, fake, bound_port
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fake Google Cloud Vision gRPC API")
+    parser.add_argument("--port", type=int, default=9300)
+    parser.add_argument("--latency", type=float, default=0.0, help="mean seconds per call")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of calls answered with UNAVAILABLE")
+    args = parser.parse_args()
+    server, _, port = serve(args.port, args.latency, args.error_rate)
+    print(f"Fake Vision listening on 127.0.0.1:{port}")
+    server.wait_for_termination()
@@ -0,0 +1,166 @@
+from typing import Dict, Any, Iterator, List, Union
+import cv2
+import fitz
+import numpy as np
+import os
+import threading
+
+from helper_functions import open_pdf
+
+TRIAGE_ENABLED = os.getenv("TRIAGE_ENABLED", "true").lower() == "true"
+
+# Fraction of ink pixels below which a page counts as blank
+TRIAGE_BLANK_INK_RATIO = float(os.getenv("TRIAGE_BLANK_INK_RATIO", "0.002"))
+# Max Hamming distance between perceptual hashes of duplicate pages (out of 64 bits)
+TRIAGE_DUPLICATE_DISTANCE = int(os.getenv("TRIAGE_DUPLICATE_DISTANCE", "4"))
+# Variance of the Laplacian below which a page is flagged as blurry
+TRIAGE_MIN_SHARPNESS = float(os.getenv("TRIAGE_MIN_SHARPNESS", "60"))
+# Blurry pages are only flagged by default, set to true to skip them too
+TRIAGE_SKIP_BLURRY = os.getenv("TRIAGE_SKIP_BLURRY", "false").lower() == "true"
+
+# Pages are analysed at this width so thresholds do not depend on resolution
+ANALYSIS_WIDTH = 800
+# A pixel is ink when it is this much darker than the page background
+INK_CONTRAST = 40
+# Render scale for triaging PDF pages that are OCR'd natively (54 DPI)
+PDF_TRIAGE_SCALE = 0.75
+# Width of the thumbnails compared pixel by pixel to confirm a duplicate
+DUPLICATE_THUMB_WIDTH = 256
+# Max fraction of thumbnail pixels that may differ between duplicates. Keeps
+# two cards on the same template (e.g. two Istimaras) from being merged.
+DUPLICATE_MAX_DIFF = 0.001
+
+
+def _normalize(gray: np.ndarray) -> np.ndarray:
+    height, width = gray.shape[:2]
+    if width == ANALYSIS_WIDTH:
+        return gray
+    new_height = max(1, round(height * ANALYSIS_WIDTH / width))
+    interpolation = cv2.INTER_AREA if width > ANALYSIS_WIDTH else cv2.INTER_LINEAR
+    return cv2.resize(gray, (ANALYSIS_WIDTH, new_height), interpolation=interpolation)
+
+
+def ink_density(gray: np.ndarray) -> float:
+    """Fraction of pixels clearly darker than the page background"""
+    background = np.median(gray)
+    return float(np.count_nonzero(gray < background - INK_CONTRAST)) / gray.size
+
+
+def sharpness(gray: np.ndarray) -> float:
+    """Variance of the Laplacian, low values mean a blurry page"""
+    return float(cv2.Laplacian(gray, cv2.CV_64F).var())
+
+
+def _thumbnail(gray: np.ndarray) -> np.ndarray:
+    height = max(1, round(gray.shape[0] * DUPLICATE_THUMB_WIDTH / gray.shape[1]))
+    return cv2.resize(gray, (DUPLICATE_THUMB_WIDTH, height), interpolation=cv2.INTER_AREA)
+
+
+def _same_content(thumb: np.ndarray, other: np.ndarray) -> bool:
+    if thumb.shape != other.shape:
+        return False
+    changed = np.count_nonzero(cv2.absdiff(thumb, other) > INK_CONTRAST)
+    return changed / thumb.size <= DUPLICATE_MAX_DIFF
+
+
+def perceptual_hash(gray: np.ndarray) -> int:
+    """64-bit difference hash (dHash)"""
+    small = cv2.resize(gray, (9, 8), interpolation=cv2.INTER_AREA)
+    bits = (small[:, 1:] > small[:, :-1]).flatten()
+    return int(np.packbits(bits).view(">u8")[0])
+
+
+class PageTriage:
+    """
+    Pre-OCR triage for one request. Drops near-blank pages and duplicates
+    (across every file of the request) and flags pages too blurry to read.
+    Every decision is kept so it can be reported in files_info.
+    Safe to use from the worker threads that pull pages.
+    """
+
+    def __init__(
+        self,
+        blank_ink_ratio: float = TRIAGE_BLANK_INK_RATIO,
+        duplicate_distance: int = TRIAGE_DUPLICATE_DISTANCE,
+        min_sharpness: float = TRIAGE_MIN_SHARPNESS,
+        skip_blurry: bool = TRIAGE_SKIP_BLURRY
+    ):
+        self.blank_ink_ratio = blank_ink_ratio
+        self.duplicate_distance = duplicate_distance
+        self.min_sharpness = min_sharpness
+        self.skip_blurry = skip_blurry
+        self._seen = []  # (hash, thumbnail, "file_name#page")
+        self._lock = threading.Lock()
+
+    def inspect(self, gray: np.ndarray, page_ref: str) -> Dict[str, Any]:
+        """Decide whether a grayscale page should be OCR'd"""
+        gray = _normalize(gray)
+        decision = {
+            "ink_density": round(ink_density(gray), 4),
+            "sharpness": round(sharpness(gray), 1),
+            "action": "ocr",
+        }
+        decision["blurry"] = decision["sharpness"] < self.min_sharpness
+
+        if decision["ink_density"] < self.blank_ink_ratio:
+            decision["action"] = "skipped"
+            decision["reason"] = "blank"
+            return decision
+
+        # The perceptual hash finds candidates, the thumbnail diff confirms them
+        page_hash = perceptual_hash(gray)
+        thumb = _thumbnail(gray)
+        with self._lock:
+            for seen_hash, seen_thumb, seen_ref in self._seen:
+                if bin(page_hash ^ seen_hash).count("1") <= self.duplicate_distance and _same_content(thumb, seen_thumb):
+                    decision["action"] = "skipped"
+                    decision["reason"] = "duplicate"
+                    decision["duplicate_of"] = seen_ref
+                    return decision
+            if not (decision["blurry"] and self.skip_blurry):
+                self._seen.append((page_hash, thumb, page_ref))
+
+        if decision["blurry"] and self.skip_blurry:
+            decision["action"] = "skipped"
+            decision["reason"] = "blurry"
+        return decision
+
+    def inspect_encoded(self, page_bytes: bytes, page_ref: str) -> Dict[str, Any]:
+        buffer = np.frombuffer(page_bytes, dtype=np.uint8)
+        # Large photos are decoded at half resolution, plenty for triage
+        flag = cv2.IMREAD_REDUCED_GRAYSCALE_2 if len(page_bytes) > 1_000_000 else cv2.IMREAD_GRAYSCALE
+        gray = cv2.imdecode(buffer, flag)
+        if gray is None:
+            # Let Vision decide on pages OpenCV cannot decode
+            return {"action": "ocr", "reason": "undecodable"}
+        return self.inspect(gray, page_ref)
+
+    def filter_pages(self, pages, file_name: str, decisions: List[Dict[str, Any]]) -> Iterator[bytes]:
+        """
+        Lazily triage a stream of encoded pages, yielding only the ones to OCR.
+        A decision per page is appended to decisions.
+        """
+        for page_number, page in enumerate(pages, start=1):
+            decision = self.inspect_encoded(page, f"{file_name}#{page_number}")
+            decision["page"] = page_number
+            decisions.append(decision)
+            if decision["action"] == "ocr":
+                yield page
+
+    def triage_pdf(self, pdf_bytes: Union[bytes, str], file_name: str, decisions: List[Dict[str, Any]]) -> List[int]:
+        """
+        Triage a PDF that is OCR'd natively, from low resolution grayscale renders.
+        Returns the 1-based page numbers to OCR.
+        """
+        pages_to_ocr = []
+        with open_pdf(pdf_bytes) as pdf_document:
+            mat = fitz.Matrix(PDF_TRIAGE_SCALE, PDF_TRIAGE_SCALE)
+            for page_number, page in enumerate(pdf_document, start=1):
+                pix = page.get_pixmap(matrix=mat, colorspace=fitz.csGRAY)
+                gray = np.frombuffer(pix.samples, dtype=np.uint8).reshape(pix.height, pix.stride)[:, :pix.width]
+                decision = self.inspect(gray, f"{file_name}#{page_number}")
+                decision["page"] = page_number
+                decisions.append(decision)
+                if decision["action"] == "ocr":
+                    pages_to_ocr.append(page_number)
+        return pages_to_ocr
@@ -0,0 +1,310 @@
+"""
+Spooled, size-capped ingestion of /ocr-processing uploads.
+
+The multipart body is parsed as it arrives (spool_form) and each uploaded
+file is written once, straight into its spool: small files stay in memory,
+the rest go to a temp file that PyMuPDF, PIL and OpenCV open by path, so the
+request holds neither the whole body nor a bytes copy of every upload.
+Files over UPLOAD_MAX_FILE_BYTES and bodies over UPLOAD_MAX_REQUEST_BYTES
+(chunked ones included) are rejected with 413 as soon as the limit is crossed.
+"""
+from fastapi import HTTPException, Request
+from python_multipart import MultipartParser
+from python_multipart.exceptions import MultipartParseError
+from python_multipart.multipart import parse_options_header
+from typing import Optional, List, Dict, Any, Union, Tuple
+import asyncio
+import hashlib
+import os
+import resource
+import shutil
+import tempfile
+
+from metrics import upload_bytes, uploads_rejected
+
+UPLOAD_MAX_FILE_BYTES = int(os.getenv("UPLOAD_MAX_FILE_BYTES", str(25 * 1024 * 1024)))
+UPLOAD_MAX_REQUEST_BYTES = int(os.getenv("UPLOAD_MAX_REQUEST_BYTES", str(60 * 1024 * 1024)))
+# Form fields other than files are kept in memory, up to this size each
+UPLOAD_MAX_FIELD_BYTES = int(os.getenv("UPLOAD_MAX_FIELD_BYTES", str(64 * 1024)))
+# Files up to this size are kept in memory, larger ones are spooled to disk
+UPLOAD_SPOOL_MAX_MEMORY = int(os.getenv("UPLOAD_SPOOL_MAX_MEMORY", str(1024 * 1024)))
+# Where spooled uploads are written (system temp dir by default)
+UPLOAD_SPOOL_DIR = os.getenv("UPLOAD_SPOOL_DIR") or None
+# Resident memory is sampled this often while a request runs
+RSS_SAMPLE_INTERVAL = float(os.getenv("RSS_SAMPLE_INTERVAL", "0.05"))
+
+
+def _too_large(detail: str):
+    uploads_rejected.inc()
+    return HTTPException(status_code=413, detail=detail)
+
+
+class _Spool:
+    """One uploaded file being received, hashed on the way"""
+
+    def __init__(self, file_name: str, mime_type: Optional[str]):
+        self.file_name = file_name
+        self.mime_type = mime_type
+        self.digest = hashlib.sha256()
+        self.buffer = bytearray()
+        self.spool = None
+        self.size = 0
+
+    async def write(self, chunk: bytes):
+        self.size += len(chunk)
+        if self.size > UPLOAD_MAX_FILE_BYTES:
+            raise _too_large(f"File {self.file_name} is larger than {UPLOAD_MAX_FILE_BYTES} bytes")
+        self.digest.update(chunk)
+        if self.spool is None and len(self.buffer) + len(chunk) <= UPLOAD_SPOOL_MAX_MEMORY:
+            self.buffer += chunk
+            return
+        if self.spool is None:
+            self.spool = tempfile.NamedTemporaryFile(prefix="upload-", dir=UPLOAD_SPOOL_DIR, delete=False)
+            await asyncio.to_thread(self.spool.write, self.buffer)
+            self.buffer = bytearray()
+        await asyncio.to_thread(self.spool.write, chunk)
+
+    def finish(self) -> Dict[str, Any]:
+        """The document dict (file_name, mime_type, file_size, sha256 and either content or a spooled path)"""
+        upload_bytes.inc(self.size)
+        document = {
+            "file_name": self.file_name,
+            "mime_type": self.mime_type,
+            "file_size": self.size,
+            "sha256": self.digest.hexdigest(),
+            "content": None,
+            "path": None
+        }
+        if self.spool is None:
+            document["content"] = bytes(self.buffer)
+        else:
+            self.spool.close()
+            document["path"] = self.spool.name
+            document["spooled"] = True
+        return document
+
+    def discard(self):
+        if self.spool is not None:
+            self.spool.close()
+            try:
+                os.unlink(self.spool.name)
+            except FileNotFoundError:
+                pass
+
+
+class _FormReader:
+    """
+    python-multipart callbacks: fields are collected, file data is queued for
+    spool_form to write (the callbacks cannot await)
+    """
+
+    def __init__(self, file_field: str, charset: str):
+        self.file_field = file_field
+        self.charset = charset
+        self.fields = {}
+        self.files = []
+        self.spools = []
+        self.pending = []  # (spool, data) to write
+        self._header_name = b""
+        self._header_value = b""
+        self._headers = {}
+        self._name = None
+        self._spool = None
+        self._skip = False
+        self._data = bytearray()
+
+    def callbacks(self) -> Dict[str, Any]:
+        return {
+            "on_part_begin": self.on_part_begin,
+            "on_header_field": self.on_header_field,
+            "on_header_value": self.on_header_value,
+            "on_header_end": self.on_header_end,
+            "on_headers_finished": self.on_headers_finished,
+            "on_part_data": self.on_part_data,
+            "on_part_end": self.on_part_end
+        }
+
+    def _decode(self, value: bytes) -> str:
+        return value.decode(self.charset, errors="replace")
+
+    def on_part_begin(self):
+        self._headers = {}
+        self._name = None
+        self._spool = None
+        self._skip = False
+        self._data = bytearray()
+
+    def on_header_field(self, data: bytes, start: int, end: int):
+        self._header_name += data[start:end]
+
+    def on_header_value(self, data: bytes, start: int, end: int):
+        self._header_value += data[start:end]
+
+    def on_header_end(self):
+        self._headers[self._header_name.lower()] = self._header_value
+        self._header_name = b""
+        self._header_value = b""
+
+    def on_headers_finished(self):
+        _, options = parse_options_header(self._headers.get(b"content-disposition"))
+        if b"name" not in options:
+            raise HTTPException(status_code=400, detail="A form part has no name")
+        self._name = self._decode(options[b"name"])
+        if b"filename" not in options:
+            return
+        # Files of other fields, and empty file inputs, are not read
+        file_name = self._decode(options[b"filename"])
+        if self._name != self.file_field or not file_name:
+            self._skip = True
+            return
+        content_type = self._headers.get(b"content-type")
+        self._spool = _Spool(file_name, content_type.decode("latin-1") if content_type else None)
+        self.spools.append(self._spool)
+
+    def on_part_data(self, data: bytes, start: int, end: int):
+        if self._skip:
+            return
+        if self._spool is not None:
+            self.pending.append((self._spool, data[start:end]))
+            return
+        if len(self._data) + end - start > UPLOAD_MAX_FIELD_BYTES:
+            raise _too_large(f"Form field {self._name} is larger than {UPLOAD_MAX_FIELD_BYTES} bytes")
+        self._data += data[start:end]
+
+    def on_part_end(self):
+        if self._spool is not None:
+            self.files.append(self._spool)
+        elif not self._skip:
+            self.fields[self._name] = self._decode(self._data)
+
+
+async def spool_form(request: Request, file_field: str = "files") -> Tuple[Dict[str, str], List[Dict[str, Any]]]:
+    """
+    Read a multipart/form-data body as it arrives. Returns the text fields and
+    a document dict per file of file_field (see _Spool.finish, release them
+    with release_uploads). Raises 413 past the size limits, 400 on a body that
+    is not multipart.
+    """
+    content_type, params = parse_options_header(request.headers.get("content-type"))
+    if content_type != b"multipart/form-data" or b"boundary" not in params:
+        raise HTTPException(status_code=400, detail="Expected a multipart/form-data body")
+    form = _FormReader(file_field, params.get(b"charset", b"utf-8").decode("latin-1"))
+    parser = MultipartParser(params[b"boundary"], form.callbacks())
+    received = 0
+    try:
+        async for chunk in request.stream():
+            received += len(chunk)
+            if received > UPLOAD_MAX_REQUEST_BYTES:
+                raise _too_large(f"Uploads are larger than {UPLOAD_MAX_REQUEST_BYTES} bytes in total")
+            parser.write(chunk)
+            for spool, data in form.pending:
+                await spool.write(data)
+            form.pending.clear()
+        parser.finalize()
+        return form.fields, [spool.finish() for spool in form.files]
+    except MultipartParseError as e:
+        for spool in form.spools:
+            spool.discard()
+        raise HTTPException(status_code=400, detail=f"Malformed multipart body: {e}")
+    except BaseException:
+        for spool in form.spools:
+            spool.discard()
+        raise
+
+
+def document_source(document: Dict[str, Any]) -> Union[bytes, str]:
+    """What to open a document from: its spooled path, or its bytes when kept in memory"""
+    return document.get("path") or document["content"]
+
+
+def document_size(document: Dict[str, Any]) -> int:
+    if document.get("file_size") is not None:
+        return document["file_size"]
+    if document.get("path"):
+        return os.path.getsize(document["path"])
+    return len(document["content"])
+
+
+def read_document(document: Dict[str, Any]) -> bytes:
+    """The bytes of a document, for calls that need them (e.g. native PDF OCR)"""
+    if document.get("content") is not None:
+        return document["content"]
+    with open(document["path"], "rb") as f:
+        return f.read()
+
+
+def save_document(document: Dict[str, Any], path: str):
+    """Write a document to path without loading a spooled file into memory"""
+    if document.get("path"):
+        shutil.copyfile(document["path"], path)
+    else:
+        with open(path, "wb") as f:
+            f.write(document["content"])
+
+
+def release_uploads(documents: List[Dict[str, Any]]):
+    """Delete the temp files of spooled uploads (files owned by others, e.g. job storage, are kept)"""
+    for document in documents:
+        if document.get("spooled") and document.get("path"):
+            try:
+                os.unlink(document["path"])
+            except FileNotFoundError:
+                pass
+
+
+def current_rss() -> int:
+    """Resident set size of the process in bytes (peak RSS where /proc is not available)"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return peak_rss()
+
+
+def peak_rss() -> int:
+    """Peak resident set size of the process since it started, in bytes"""
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return max_rss if os.uname().sysname == "Darwin" else max_rss * 1024
+
+
+class RssSampler:
+    """
+    Samples the process RSS while a request runs. The process is shared by
+    concurrent requests, so the peak is that of the process during the request.
+
+        async with RssSampler() as sampler:
+            ...
+        sampler.report()
+    """
+
+    def __init__(self, interval: float = RSS_SAMPLE_INTERVAL):
+        self.interval = interval
+        self.start_rss = 0
+        self.peak = 0
+        self.end_rss = 0
+        self._task = None
+
+    async def _sample(self):
+        while True:
+            self.peak = max(self.peak, current_rss())
+            await asyncio.sleep(self.interval)
+
+    async def __aenter__(self):
+        self.start_rss = self.peak = current_rss()
+        self._task = asyncio.create_task(self._sample())
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self._task.cancel()
+        self.end_rss = current_rss()
+        self.peak = max(self.peak, self.end_rss)
+
+    def report(self) -> Dict[str, float]:
+        mb = 1024 * 1024
+        return {
+            "rss_start_mb": round(self.start_rss / mb, 1),
+            "rss_peak_mb": round(self.peak / mb, 1),
+            "rss_growth_mb": round((self.peak - self.start_rss) / mb, 1),
+            "process_peak_rss_mb": round(peak_rss() / mb, 1)
+        }
@@ -1,17 +1,38 @@
 from dotenv import load_dotenv
 import os
-import requests
 from typing import Dict, Any, List
+import httpx
+
+from http_client import http_client
 
 load_dotenv()
 
 GRAPH_API_TOKEN = os.getenv("GRAPH_API_TOKEN")
 PHONE_NUMBER_ID = os.getenv("PHONE_NUMBER_ID")
-WHATSAPP_API_URL = f"https://graph.facebook.com/v18.0/{PHONE_NUMBER_ID}/messages"
+# Overridable to point at a local fake Graph API (stubs/fake_graph_api.py)
+GRAPH_API_BASE_URL = os.getenv("GRAPH_API_BASE_URL", "https://graph.facebook.com/v18.0")
+WHATSAPP_API_URL = f"{GRAPH_API_BASE_URL}/{PHONE_NUMBER_ID}/messages"
 BACKEND_BASEURL = os.getenv("BACKEND_BASEURL")
 
+# Graph API error codes for throttling, worth retrying later
+GRAPH_RATE_LIMIT_CODES = {4, 80007, 130429, 131048, 131056}
+
+
+def _error_result(e: Exception) -> Dict[str, Any]:
+    """Failure result, with whether trying again later may succeed"""
+    result = {"success": False, "error": str(e), "retryable": True}
+    if isinstance(e, httpx.HTTPStatusError):
+        status_code = e.response.status_code
+        result["status_code"] = status_code
+        try:
+            error_code = e.response.json().get("error", {}).get("code")
+        except Exception:
+            error_code = None
+        result["retryable"] = status_code == 429 or status_code >= 500 or error_code in GRAPH_RATE_LIMIT_CODES
+    return result
+
 
-def send_text_message(phone_number: str, message: str) -> Dict[str, Any]:
+async def send_text_message(phone_number: str, message: str) -> Dict[str, Any]:
     """
     Send a text message to WhatsApp user
     """
@@ -32,7 +53,7 @@ def send_text_message(phone_number: str, message: str) -> Dict[str, Any]:
             }
         }
         
-        response = requests.post(WHATSAPP_API_URL, headers=headers, json=payload)
+        response = await http_client.post(WHATSAPP_API_URL, headers=headers, json=payload)
         response.raise_for_status()
         
         print(f"Text message sent to {phone_number}: {message[:50]}...")
@@ -40,10 +61,10 @@ def send_text_message(phone_number: str, message: str) -> Dict[str, Any]:
         
     except Exception as e:
         print(f"Error sending text message: {e}")
-        return {"success": False, "error": str(e)}
+        return _error_result(e)
 
 
-def call_renewal_validation_api(request_id: str, chassis_no: str, bearer_token: str) -> Dict[str, Any]:
+async def call_renewal_validation_api(request_id: str, chassis_no: str, bearer_token: str) -> Dict[str, Any]:
     """
     Call the renewal validation API endpoint
     """
@@ -62,7 +83,7 @@ def call_renewal_validation_api(request_id: str, chassis_no: str, bearer_token:
             "validationStage": 4
         }
         
-        response = requests.post(url, headers=headers, json=payload)
+        response = await http_client.post(url, headers=headers, json=payload)
         response.raise_for_status()
         
         result = response.json()
@@ -72,10 +93,10 @@ def call_renewal_validation_api(request_id: str, chassis_no: str, bearer_token:
         
     except Exception as e:
         print(f"Error calling renewal validation API: {e}")
-        return {"success": False, "error": str(e)}
+        return _error_result(e)
 
 
-def send_insurance_type_selection(phone_number: str) -> Dict[str, Any]:
+async def send_insurance_type_selection(phone_number: str) -> Dict[str, Any]:
     """
     Send insurance type selection message with interactive buttons to WhatsApp user
     """
@@ -116,7 +137,7 @@ def send_insurance_type_selection(phone_number: str) -> Dict[str, Any]:
             }
         }
         
-        response = requests.post(WHATSAPP_API_URL, headers=headers, json=payload)
+        response = await http_client.post(WHATSAPP_API_URL, headers=headers, json=payload)
         response.raise_for_status()
         
         print(f"Insurance type selection buttons sent to {phone_number}")
@@ -124,7 +145,7 @@ def send_insurance_type_selection(phone_number: str) -> Dict[str, Any]:
         
     except Exception as e:
         print(f"Error sending insurance type selection: {e}")
-        return {"success": False, "error": str(e)}
+        return _error_result(e)
 
 
 def format_extraction_message(